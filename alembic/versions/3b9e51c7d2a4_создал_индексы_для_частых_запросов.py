@@ -0,0 +1,49 @@
+"""Создал индексы для частых запросов
+
+Revision ID: 3b9e51c7d2a4
+Revises: 6147db0e4343
+Create Date: 2026-10-18 10:12:03.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e51c7d2a4'
+down_revision = '6147db0e4343'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_regions_courier_id', 'regions', ['courier_id'])
+    op.create_index('ix_working_hours_courier_id',
+                    'working_hours', ['courier_id'])
+    op.create_index('ix_working_hours_working_hours', 'working_hours',
+                    ['working_hours'], postgresql_using='gist')
+    op.create_index('ix_delivery_hours_order_id',
+                    'delivery_hours', ['order_id'])
+    op.create_index('ix_delivery_hours_delivery_hours', 'delivery_hours',
+                    ['delivery_hours'], postgresql_using='gist')
+    op.create_index('ix_orders_untaken_region_weight', 'orders',
+                    ['region', 'weight'],
+                    postgresql_where=sa.text('taken = false'))
+    op.create_index('ix_couriers_orders_order_id',
+                    'couriers_orders', ['order_id'])
+    op.create_index('ix_couriers_orders_courier_id_complete_time',
+                    'couriers_orders', ['courier_id', 'complete_time'])
+
+
+def downgrade():
+    op.drop_index('ix_couriers_orders_courier_id_complete_time',
+                  table_name='couriers_orders')
+    op.drop_index('ix_couriers_orders_order_id', table_name='couriers_orders')
+    op.drop_index('ix_orders_untaken_region_weight', table_name='orders')
+    op.drop_index('ix_delivery_hours_delivery_hours',
+                  table_name='delivery_hours')
+    op.drop_index('ix_delivery_hours_order_id', table_name='delivery_hours')
+    op.drop_index('ix_working_hours_working_hours',
+                  table_name='working_hours')
+    op.drop_index('ix_working_hours_courier_id', table_name='working_hours')
+    op.drop_index('ix_regions_courier_id', table_name='regions')
@@ -0,0 +1,27 @@
+"""Добавил версию курьера
+
+Revision ID: 5e8b1d0c7a93
+Revises: c41a7e9f05d6
+Create Date: 2026-10-18 12:31:07.214583
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8b1d0c7a93'
+down_revision = 'c41a7e9f05d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Версия растет при каждом изменении курьера и отдается как ETag
+    # в GET /couriers/{courier_id}
+    op.add_column('couriers', sa.Column(
+        'version', sa.BigInteger(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('couriers', 'version')
@@ -0,0 +1,34 @@
+"""Создал таблицу courier_stats
+
+Revision ID: 8d2f4a61b7c3
+Revises: 3b9e51c7d2a4
+Create Date: 2026-10-18 11:40:27.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2f4a61b7c3'
+down_revision = '3b9e51c7d2a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Заполнить таблицу по уже завершенным заказам:
+    # python manage.py backfill-stats
+    op.create_table('courier_stats',
+    sa.Column('courier_id', sa.Integer(), nullable=False),
+    sa.Column('region', sa.Integer(), nullable=False),
+    sa.Column('completed', sa.Integer(), nullable=False),
+    sa.Column('delivery_time_sum', sa.BigInteger(), nullable=False),
+    sa.Column('earnings', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['courier_id'], ['couriers.courier_id'], ),
+    sa.PrimaryKeyConstraint('courier_id', 'region')
+    )
+
+
+def downgrade():
+    op.drop_table('courier_stats')
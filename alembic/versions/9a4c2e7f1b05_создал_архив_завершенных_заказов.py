@@ -0,0 +1,43 @@
+"""Создал архив завершенных заказов
+
+Revision ID: 9a4c2e7f1b05
+Revises: 5e8b1d0c7a93
+Create Date: 2026-10-18 12:52:41.603318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4c2e7f1b05'
+down_revision = '5e8b1d0c7a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Перенести уже завершенные назначения: python manage.py archive
+    op.create_table('couriers_orders_archive',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('courier_id', sa.Integer(), nullable=False),
+    sa.Column('assign_time', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('complete_time', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('delivery_time', sa.Integer(), nullable=True),
+    sa.Column('weight', sa.Float(), nullable=True),
+    sa.Column('region', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_couriers_orders_archive_order_id',
+                    'couriers_orders_archive', ['order_id'])
+    op.create_index('ix_couriers_orders_archive_courier_id',
+                    'couriers_orders_archive', ['courier_id'])
+
+
+def downgrade():
+    op.drop_index('ix_couriers_orders_archive_courier_id',
+                  table_name='couriers_orders_archive')
+    op.drop_index('ix_couriers_orders_archive_order_id',
+                  table_name='couriers_orders_archive')
+    op.drop_table('couriers_orders_archive')
@@ -0,0 +1,52 @@
+"""Перевел время заказов в timestamptz
+
+Revision ID: c41a7e9f05d6
+Revises: 8d2f4a61b7c3
+Create Date: 2026-10-18 12:25:48.904133
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41a7e9f05d6'
+down_revision = '8d2f4a61b7c3'
+branch_labels = None
+depends_on = None
+
+# Формат, в котором время хранилось строкой
+TIME_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"'
+
+
+def upgrade():
+    op.alter_column('couriers_orders', 'assign_time',
+                    type_=sa.DateTime(timezone=True),
+                    postgresql_using='assign_time::timestamptz')
+    op.alter_column('couriers_orders', 'complete_time',
+                    type_=sa.DateTime(timezone=True),
+                    postgresql_using='complete_time::timestamptz')
+
+    op.add_column('couriers', sa.Column(
+        'last_complete_time', sa.DateTime(timezone=True), nullable=True))
+    op.execute('''
+        UPDATE couriers SET last_complete_time = last.complete_time
+        FROM (
+            SELECT courier_id, max(complete_time) AS complete_time
+            FROM couriers_orders
+            WHERE complete_time IS NOT NULL
+            GROUP BY courier_id
+        ) AS last
+        WHERE last.courier_id = couriers.courier_id
+    ''')
+
+
+def downgrade():
+    op.drop_column('couriers', 'last_complete_time')
+
+    op.alter_column('couriers_orders', 'complete_time',
+                    type_=sa.String(),
+                    postgresql_using=f"to_char(complete_time AT TIME ZONE 'UTC', '{TIME_FORMAT}')")
+    op.alter_column('couriers_orders', 'assign_time',
+                    type_=sa.String(),
+                    postgresql_using=f"to_char(assign_time AT TIME ZONE 'UTC', '{TIME_FORMAT}')")
@@ -0,0 +1,38 @@
+"""Добавил ключи идемпотентности
+
+Revision ID: d7f3a8c26e41
+Revises: 9a4c2e7f1b05
+Create Date: 2026-10-18 15:07:19.284561
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7f3a8c26e41'
+down_revision = '9a4c2e7f1b05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('route', sa.String(), nullable=False),
+    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('media_type', sa.String(), nullable=True),
+    sa.Column('body', sa.LargeBinary(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True),
+              server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('key', 'route')
+    )
+    op.create_index('ix_idempotency_keys_created_at', 'idempotency_keys',
+                    ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_created_at',
+                  table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
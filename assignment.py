@@ -0,0 +1,181 @@
+"""
+Стратегии выбора заказов, которые назначаются курьеру.
+
+Стратегия получает подходящие курьеру заказы (по региону, весу и графику)
+и оставшуюся грузоподъемность и решает, какие из них взять. Стратегия
+выбирается при запуске переменной окружения ASSIGN_STRATEGY.
+
+Для назначения сразу нескольким курьерам есть match_batch.
+"""
+import decimal
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Sequence
+
+import numpy as np
+from sqlalchemy import Numeric, cast, func
+from sqlalchemy.orm import Query
+
+import models
+
+# Вес заказа задан с точностью до 0.01 кг
+WEIGHT_SCALE = 100
+
+
+def to_units(weight: float) -> int:
+    return int(round(weight * WEIGHT_SCALE))
+
+
+class AssignStrategy:
+    name = None
+    # Сколько легчайших кандидатов стратегия готова рассмотреть
+    max_items = None
+
+    def prepare(self, query: Query, capacity: float) -> Query:
+        # Позволяет стратегии сузить выборку кандидатов еще в базе
+        return query
+
+    def select(self, candidates: Sequence, capacity: float) -> List:
+        # candidates — строки с полями order_id и weight
+        raise NotImplementedError
+
+
+class GreedyStrategy(AssignStrategy):
+    """Берет заказы по возрастанию веса, пока они помещаются."""
+    name = 'greedy'
+
+    def prepare(self, query: Query, capacity: float) -> Query:
+        # Накопленный вес считаем оконной функцией прямо в запросе,
+        # чтобы из базы приходили только заказы, которые войдут
+        candidates = query.add_columns(
+            func.sum(cast(models.Order.weight, Numeric)).over(
+                order_by=(models.Order.weight, models.Order.order_id)
+            ).label('total_weight')
+        ).subquery()
+
+        return query.session.query(candidates.c.order_id, candidates.c.weight).filter(
+            candidates.c.total_weight <= decimal.Decimal(str(capacity))
+        ).order_by(candidates.c.total_weight)
+
+    def select(self, candidates: Sequence, capacity: float) -> List:
+        answer = []
+        left = to_units(capacity)
+        for i in sorted(candidates, key=lambda i: (i.weight, i.order_id)):
+            weight = to_units(i.weight)
+            if weight > left:
+                break
+            answer.append(i)
+            left -= weight
+        return answer
+
+
+class KnapsackStrategy(AssignStrategy):
+    """
+    Точное решение задачи о рюкзаке динамикой по весу в сотых долях кг.
+    Если решение не укладывается в time_budget секунд, возвращает
+    результат жадной стратегии.
+    """
+    name = 'knapsack'
+
+    def __init__(self, objective: str = 'weight', time_budget: float = 0.05,
+                 max_items: int = 2000):
+        if objective not in ('weight', 'count'):
+            raise ValueError(f'Unknown knapsack objective: {objective}')
+        self.objective = objective
+        self.time_budget = time_budget
+        self.max_items = max_items
+        self.fallback = GreedyStrategy()
+
+    def prepare(self, query: Query, capacity: float) -> Query:
+        # Размер таблицы динамики ограничен max_items легчайшими заказами
+        return query.order_by(
+            models.Order.weight, models.Order.order_id
+        ).limit(self.max_items)
+
+    def select(self, candidates: Sequence, capacity: float) -> List:
+        started = time.perf_counter()
+
+        capacity = to_units(capacity)
+        candidates = [i for i in candidates if to_units(i.weight) <= capacity]
+        if not candidates:
+            return []
+
+        weights = np.array([to_units(i.weight) for i in candidates])
+        if self.objective == 'weight':
+            values = weights
+        else:
+            # Сначала максимизируем число заказов, при равенстве — вес
+            values = weights + (capacity + 1)
+
+        # best[c] — лучшая ценность при суммарном весе не больше c
+        best = np.zeros(capacity + 1, dtype=np.int64)
+        taken = np.zeros((len(candidates), capacity + 1), dtype=bool)
+
+        for i, (weight, value) in enumerate(zip(weights, values)):
+            if time.perf_counter() - started > self.time_budget:
+                return self.fallback.select(candidates, capacity / WEIGHT_SCALE)
+
+            with_item = best[:capacity + 1 - weight] + value
+            better = with_item > best[weight:]
+            taken[i, weight:] = better
+            best[weight:] = np.where(better, with_item, best[weight:])
+
+        # Восстанавливаем набор заказов
+        answer = []
+        left = capacity
+        for i in range(len(candidates) - 1, -1, -1):
+            if taken[i, left]:
+                answer.append(candidates[i])
+                left -= weights[i]
+
+        return sorted(answer, key=lambda i: (i.weight, i.order_id))
+
+
+def match_batch(candidates: Sequence, capacities: Dict[int, float]) -> Dict[int, List]:
+    """
+    Распределяет заказы между несколькими курьерами сразу.
+
+    candidates — пары с полями courier_id, order_id и weight: какой заказ
+    подходит какому курьеру. Заказы раздаются по возрастанию веса, а при
+    равном весе первыми идут те, которые подходят меньшему числу курьеров.
+    Заказ отдается курьеру, у которого после него останется меньше всего
+    свободного места (best fit): просторные курьеры остаются для заказов,
+    которые никто другой не возьмет.
+    """
+    eligible = defaultdict(list)
+    orders = {}
+    for i in candidates:
+        if to_units(i.weight) <= to_units(capacities[i.courier_id]):
+            eligible[i.order_id].append(i.courier_id)
+            orders[i.order_id] = i
+
+    left = {k: to_units(v) for k, v in capacities.items()}
+    answer = {k: [] for k in capacities}
+
+    for order_id in sorted(orders, key=lambda i: (
+            orders[i].weight, len(eligible[i]), i)):
+        weight = to_units(orders[order_id].weight)
+        fits = [i for i in eligible[order_id] if left[i] >= weight]
+        if not fits:
+            continue
+        courier_id = min(fits, key=lambda i: (left[i] - weight, i))
+        left[courier_id] -= weight
+        answer[courier_id].append(orders[order_id])
+
+    return answer
+
+
+def get_strategy(name: str) -> AssignStrategy:
+    time_budget = float(os.environ.get('ASSIGN_TIME_BUDGET', 0.05))
+    strategies = {
+        'greedy': GreedyStrategy,
+        'knapsack-weight': lambda: KnapsackStrategy('weight', time_budget),
+        'knapsack-count': lambda: KnapsackStrategy('count', time_budget),
+    }
+    if name not in strategies:
+        raise ValueError(f'Unknown assign strategy: {name}')
+    return strategies[name]()
+
+
+strategy = get_strategy(os.environ.get('ASSIGN_STRATEGY', 'greedy'))
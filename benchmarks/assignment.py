@@ -0,0 +1,94 @@
+"""
+Сравнение стратегий назначения: заполнение грузоподъемности и время решения.
+
+Для каждой грузоподъемности и числа кандидатов генерирует случайные наборы
+заказов и решает их всеми стратегиями из assignment.py.
+
+    python -m benchmarks.assignment --candidates 10 100 1000 --out assignment.md
+"""
+import argparse
+import statistics
+import time
+from collections import namedtuple
+from random import Random
+
+import assignment
+from crud import carrying_capacity
+
+Candidate = namedtuple('Candidate', ['order_id', 'weight'])
+
+
+def generate_candidates(rnd: Random, n: int, capacity: float):
+    # Вперемешку мелкие и крупные заказы, вес с точностью до 0.01 кг
+    return [
+        Candidate(i, round(rnd.choice([
+            rnd.uniform(0.01, 2),
+            rnd.uniform(0.01, capacity),
+        ]), 2))
+        for i in range(1, n + 1)
+    ]
+
+
+def run(strategy, problems, capacity):
+    fill, counts, timings = [], [], []
+    for candidates in problems:
+        started = time.perf_counter()
+        answer = strategy.select(candidates, capacity)
+        timings.append((time.perf_counter() - started) * 1000)
+
+        fill.append(sum(i.weight for i in answer) / capacity)
+        counts.append(len(answer))
+
+    timings.sort()
+    return {
+        'fill': statistics.mean(fill) * 100,
+        'orders': statistics.mean(counts),
+        'p50': statistics.median(timings),
+        'p95': timings[int(len(timings) * 0.95) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--candidates', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--time-budget', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='Файл для отчета')
+    args = parser.parse_args()
+
+    strategies = [
+        assignment.GreedyStrategy(),
+        assignment.KnapsackStrategy('weight', args.time_budget),
+        assignment.KnapsackStrategy('count', args.time_budget),
+    ]
+
+    lines = [
+        'Стратегия | Тип курьера | Кандидатов | Заполнение, % | Заказов | p50, мс | p95, мс',
+        '------------- | ------------- | ------------- | ------------- | ------------- | ------------- | -------------',
+    ]
+    rnd = Random(args.seed)
+    for courier_type, capacity in carrying_capacity.items():
+        for n in args.candidates:
+            problems = [generate_candidates(rnd, n, capacity)
+                        for _ in range(args.runs)]
+            for strategy in strategies:
+                name = strategy.name
+                if isinstance(strategy, assignment.KnapsackStrategy):
+                    name = f'{name}-{strategy.objective}'
+                result = run(strategy, problems, capacity)
+                lines.append(
+                    '{} | {} | {} | {:.1f} | {:.1f} | {:.2f} | {:.2f}'.format(
+                        name, courier_type, n, result['fill'],
+                        result['orders'], result['p50'], result['p95']))
+
+    text = '\n'.join(lines) + '\n'
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
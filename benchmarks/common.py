@@ -0,0 +1,84 @@
+"""
+Общее для бенчмарков: отдельная база и заполнение ее данными.
+"""
+import os
+from random import randint
+
+import psycopg2.extras
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy_utils import create_database, database_exists, drop_database
+
+import crud
+import models
+import schemas
+from tests.utils import generate_courier, generate_order
+
+SQLALCHEMY_DATABASE_URL = "postgresql://{}:{}@localhost:5432/{}".format(
+    os.environ.get('USERNAME'),
+    os.environ.get('DBPW'),
+    os.environ.get('BENCH_DB_NAME', 'bench'),
+)
+
+# Сколько заказов генерировать и загружать за раз
+SEED_CHUNK = 50000
+
+
+def create_session():
+    if database_exists(SQLALCHEMY_DATABASE_URL):
+        drop_database(SQLALCHEMY_DATABASE_URL)
+    create_database(SQLALCHEMY_DATABASE_URL)
+
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    with engine.connect() as conn:
+        conn.execute('create type timerange as range (subtype = time);')
+
+    conn = engine.raw_connection()
+    cur = conn.cursor()
+    psycopg2.extras.register_range(
+        'timerange', models.TimeRange, cur, globally=True)
+    cur.close()
+    conn.close()
+
+    models.Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+
+def seed(db, orders: int, couriers: int, regions: int):
+    couriers_data = [
+        generate_courier(
+            courier_id=i,
+            regions=[randint(1, regions) for _ in range(4)])
+        for i in range(1, couriers + 1)
+    ]
+    crud.add_couriers(
+        db, schemas.CouriersPostRequest(data=couriers_data))
+
+    for start in range(1, orders + 1, SEED_CHUNK):
+        chunk = [
+            schemas.OrderBase.construct(**generate_order(
+                order_id=i, region=randint(1, regions)))
+            for i in range(start, min(start + SEED_CHUNK, orders + 1))
+        ]
+        crud._copy_orders(db, chunk, SEED_CHUNK)
+        db.commit()
+
+    # Каждый десятый заказ уже назначен, половина из них доставлена
+    db.execute('''
+        INSERT INTO couriers_orders
+            (order_id, courier_id, assign_time, complete_time, delivery_time)
+        SELECT order_id,
+               order_id % :couriers + 1,
+               '2021-01-10T09:32:14.42Z'::timestamptz,
+               CASE WHEN order_id % 20 = 0
+                    THEN '2021-01-10T10:32:14.42Z'::timestamptz END,
+               CASE WHEN order_id % 20 = 0 THEN 3600 ELSE 0 END
+        FROM orders WHERE order_id % 10 = 0
+    ''', {'couriers': couriers})
+    db.execute('UPDATE orders SET taken = true WHERE order_id % 10 = 0')
+
+    # Статистика по доставленным заказам для GET /couriers. Вес курьеров
+    # не пересчитываем, чтобы заказы, назначенные при заполнении, не
+    # мешали назначать новые
+    crud.backfill_courier_stats(db)
+    db.commit()
@@ -0,0 +1,124 @@
+"""
+Сравнение планов и времени горячих запросов без индексов и с индексами.
+
+Создает отдельную базу, заполняет ее заказами и курьерами, снимает
+EXPLAIN ANALYZE и задержки запросов из crud.py сначала без индексов,
+затем с индексами из models.py, и печатает отчет в markdown.
+
+    python -m benchmarks.indexes --orders 1000000 --out indexes.md
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy_utils import drop_database
+
+import crud
+import models
+
+from .common import SQLALCHEMY_DATABASE_URL, create_session, seed
+
+
+def hot_queries(db, orders: int, couriers: int):
+    courier_id = couriers // 2
+    order_id = orders // 2
+
+    assign = crud._fitting_orders_query(db, courier_id, 10).statement.compile(
+        dialect=db.bind.dialect, compile_kwargs={'literal_binds': True})
+
+    return {
+        'assign candidates': str(assign),
+        'regions by courier': f'SELECT * FROM regions WHERE courier_id = {courier_id}',
+        'working hours by courier': f'SELECT * FROM working_hours WHERE courier_id = {courier_id}',
+        'delivery hours by order': f'SELECT * FROM delivery_hours WHERE order_id = {order_id}',
+        'delivery hours overlap': "SELECT count(*) FROM delivery_hours WHERE delivery_hours && timerange('10:00', '10:15')",
+        'open assignments of courier': f'SELECT * FROM couriers_orders WHERE courier_id = {courier_id} AND complete_time IS NULL',
+        'assignment by order': f'SELECT * FROM couriers_orders WHERE order_id = {order_id}',
+    }
+
+
+def measure(db, queries, repeat: int):
+    results = {}
+    for name, sql in queries.items():
+        plan = '\n'.join(
+            i[0] for i in db.execute('EXPLAIN ANALYZE ' + sql).fetchall())
+
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            db.execute(sql).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+
+        results[name] = {
+            'plan': plan,
+            'p50': statistics.median(timings),
+            'p95': timings[int(len(timings) * 0.95) - 1],
+        }
+    return results
+
+
+def set_indexes(db, enabled: bool):
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if enabled:
+                index.create(bind=db.connection())
+            else:
+                index.drop(bind=db.connection())
+    db.commit()
+    db.execute('ANALYZE')
+
+
+def report(before, after, args) -> str:
+    lines = [
+        f'# Индексы: {args.orders} заказов, {args.couriers} курьеров',
+        '',
+        'Запрос | p50 без индексов, мс | p50 с индексами, мс | p95 без индексов, мс | p95 с индексами, мс',
+        '------------- | ------------- | ------------- | ------------- | -------------',
+    ]
+    for name in before:
+        lines.append('{} | {:.2f} | {:.2f} | {:.2f} | {:.2f}'.format(
+            name, before[name]['p50'], after[name]['p50'],
+            before[name]['p95'], after[name]['p95']))
+
+    for name in before:
+        lines += [
+            '', f'## {name}', '',
+            'Без индексов:', '```', before[name]['plan'], '```',
+            'С индексами:', '```', after[name]['plan'], '```',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--couriers', type=int, default=1000)
+    parser.add_argument('--regions', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--out', help='Файл для отчета')
+    args = parser.parse_args()
+
+    db = create_session()
+    seed(db, args.orders, args.couriers, args.regions)
+
+    queries = hot_queries(db, args.orders, args.couriers)
+
+    set_indexes(db, enabled=False)
+    before = measure(db, queries, args.repeat)
+
+    set_indexes(db, enabled=True)
+    after = measure(db, queries, args.repeat)
+
+    text = report(before, after, args)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    print(text)
+
+    db.close()
+    drop_database(SQLALCHEMY_DATABASE_URL)
+
+
+if __name__ == '__main__':
+    main()
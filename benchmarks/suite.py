@@ -0,0 +1,299 @@
+"""
+Время обработчиков из main.py и ключевых функций crud на заполненной базе.
+
+run — создает отдельную базу, заполняет ее набором данных, замеряет каждый
+обработчик (через TestClient, со всем стеком FastAPI) и функции crud и
+пишет p50/p95/p99 в JSON. compare — сравнивает два таких файла и
+завершается с кодом 1, если что-то стало медленнее.
+
+    python -m benchmarks.suite run --dataset small --out base.json
+    python -m benchmarks.suite run --dataset small --out new.json
+    python -m benchmarks.suite compare base.json new.json
+"""
+import argparse
+import datetime
+import json
+import math
+import subprocess
+import sys
+import time
+from random import Random
+
+from fastapi.testclient import TestClient
+from sqlalchemy_utils import drop_database
+
+import crud
+from main import app, get_db
+from tests.utils import generate_courier, generate_order
+
+from .common import SQLALCHEMY_DATABASE_URL, create_session, seed
+
+# Наборы данных: (заказов, курьеров)
+DATASETS = {
+    'small': (10000, 1000),
+    'medium': (100000, 10000),
+    'large': (1000000, 10000),
+}
+
+
+def percentile(timings, q: float) -> float:
+    # Ближайший ранг: значение, не меньше которого q-я доля замеров
+    timings = sorted(timings)
+    return timings[max(math.ceil(q * len(timings)) - 1, 0)]
+
+
+def summary(timings) -> dict:
+    return {
+        'n': len(timings),
+        'p50': percentile(timings, 0.50) * 1000,
+        'p95': percentile(timings, 0.95) * 1000,
+        'p99': percentile(timings, 0.99) * 1000,
+    }
+
+
+class Suite:
+    def __init__(self, db, client: TestClient, args):
+        self.db = db
+        self.client = client
+        self.args = args
+        self.rnd = Random(args.seed)
+        self.next_courier_id = args.couriers + 1
+        self.next_order_id = args.orders + 1
+        # Назначенные при замерах пары курьер-заказ, их потом завершаем
+        self.assigned = []
+
+    def courier_id(self) -> int:
+        return self.rnd.randint(1, self.args.couriers)
+
+    def request(self, method: str, url: str, body=None) -> float:
+        started = time.perf_counter()
+        response = self.client.request(
+            method, url, data=None if body is None else json.dumps(body))
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            raise RuntimeError(
+                f'{method} {url}: {response.status_code} {response.text}')
+        self.last_response = response
+        return elapsed
+
+    def timed(self, fn, *args) -> float:
+        started = time.perf_counter()
+        fn(*args)
+        return time.perf_counter() - started
+
+    # Обработчики
+
+    def post_couriers(self):
+        ids = range(self.next_courier_id, self.next_courier_id + self.args.batch)
+        self.next_courier_id += self.args.batch
+        return self.request('POST', '/couriers', {'data': [
+            generate_courier(courier_id=i,
+                             regions=[self.rnd.randint(1, self.args.regions)
+                                      for _ in range(4)])
+            for i in ids]})
+
+    def post_orders(self):
+        ids = range(self.next_order_id, self.next_order_id + self.args.batch)
+        self.next_order_id += self.args.batch
+        return self.request('POST', '/orders', {'data': [
+            generate_order(order_id=i,
+                           region=self.rnd.randint(1, self.args.regions))
+            for i in ids]})
+
+    def get_courier(self):
+        return self.request('GET', f'/couriers/{self.courier_id()}')
+
+    def patch_courier(self):
+        return self.request(
+            'PATCH', f'/couriers/{self.courier_id()}',
+            {'working_hours': generate_courier()['working_hours']})
+
+    def orders_assign(self):
+        courier_id = self.courier_id()
+        elapsed = self.request(
+            'POST', '/orders/assign', {'courier_id': courier_id})
+        self.assigned += [(courier_id, i['id'])
+                          for i in self.last_response.json()['orders']]
+        return elapsed
+
+    def orders_assign_batch(self):
+        courier_ids = sorted({self.courier_id() for _ in range(self.args.batch)})
+        return self.request(
+            'POST', '/orders/assign/batch', {'courier_ids': courier_ids})
+
+    def orders_complete(self):
+        # Завершаем заказы, назначенные в orders_assign; если их не
+        # осталось, назначаем еще (это в замер не входит)
+        while not self.assigned:
+            self.orders_assign()
+        courier_id, order_id = self.assigned.pop()
+        return self.request('POST', '/orders/complete', {
+            'courier_id': courier_id,
+            'order_id': order_id,
+            'complete_time': crud.format_time(
+                datetime.datetime.now(datetime.timezone.utc)),
+        })
+
+    # Функции crud
+
+    def crud_get_courier(self):
+        return self.timed(crud.get_courier, self.db, self.courier_id())
+
+    def crud_fitting_orders(self):
+        query = crud._fitting_orders_query(self.db, self.courier_id(), 10)
+        return self.timed(query.all)
+
+    def crud_existing_order_ids(self):
+        ids = [self.rnd.randint(1, self.args.orders * 2) for _ in range(1000)]
+        return self.timed(crud.get_existing_order_ids, self.db, ids)
+
+    def benchmarks(self):
+        return {
+            'POST /couriers': self.post_couriers,
+            'POST /orders': self.post_orders,
+            'GET /couriers/{courier_id}': self.get_courier,
+            'PATCH /couriers/{courier_id}': self.patch_courier,
+            'POST /orders/assign': self.orders_assign,
+            'POST /orders/complete': self.orders_complete,
+            'POST /orders/assign/batch': self.orders_assign_batch,
+            'crud.get_courier': self.crud_get_courier,
+            'crud._fitting_orders_query': self.crud_fitting_orders,
+            'crud.get_existing_order_ids': self.crud_existing_order_ids,
+        }
+
+    def run(self) -> dict:
+        results = {}
+        for name, fn in self.benchmarks().items():
+            if self.args.only and name not in self.args.only:
+                continue
+            for _ in range(self.args.warmup):
+                fn()
+            results[name] = summary([fn() for _ in range(self.args.repeat)])
+            print('{:<32} p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  p99 {p99:8.2f} ms'.format(
+                name, **results[name]), file=sys.stderr)
+            self.db.rollback()
+        return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(args):
+    if args.dataset:
+        args.orders, args.couriers = DATASETS[args.dataset]
+
+    db = create_session()
+    started = time.perf_counter()
+    seed(db, args.orders, args.couriers, args.regions)
+    print(f'seeded in {time.perf_counter() - started:.1f} s', file=sys.stderr)
+
+    def override_get_db():
+        session = type(db)(bind=db.bind, autocommit=False, autoflush=False)
+        try:
+            yield session
+        finally:
+            session.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    try:
+        with TestClient(app) as client:
+            results = Suite(db, client, args).run()
+    finally:
+        app.dependency_overrides.pop(get_db, None)
+        db.close()
+        db.bind.dispose()
+        drop_database(SQLALCHEMY_DATABASE_URL)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'dataset': args.dataset,
+            'orders': args.orders,
+            'couriers': args.couriers,
+            'regions': args.regions,
+            'batch': args.batch,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = []
+    print('{:<32} {:>10} {:>10} {:>8}'.format(
+        'benchmark', f'base {args.metric}', f'new {args.metric}', 'change'))
+    for name in base['results']:
+        if name not in new['results']:
+            print(f'{name:<32} missing in {args.new}')
+            continue
+        before = base['results'][name][args.metric]
+        after = new['results'][name][args.metric]
+        change = (after - before) / before if before else 0
+        # Мелкие абсолютные отклонения — шум, даже если в процентах много
+        regressed = (change > args.threshold and
+                     after - before > args.min_ms)
+        if regressed:
+            regressions.append(name)
+        print('{:<32} {:>10.2f} {:>10.2f} {:>+7.0%}{}'.format(
+            name, before, after, change, '  REGRESSION' if regressed else ''))
+
+    if regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Замерить и записать JSON')
+    run_parser.add_argument('--dataset', choices=DATASETS,
+                            help='Готовый набор данных вместо --orders/--couriers')
+    run_parser.add_argument('--orders', type=int, default=10000)
+    run_parser.add_argument('--couriers', type=int, default=1000)
+    run_parser.add_argument('--regions', type=int, default=100)
+    run_parser.add_argument('--batch', type=int, default=10,
+                            help='Сколько сущностей в одном POST')
+    run_parser.add_argument('--repeat', type=int, default=100)
+    run_parser.add_argument('--warmup', type=int, default=5)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--only', nargs='+',
+                            help='Замерить только эти бенчмарки')
+    run_parser.add_argument('--out', help='Файл для результатов')
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser(
+        'compare', help='Сравнить два файла с результатами')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--metric', choices=['p50', 'p95', 'p99'],
+                                default='p95')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='Допустимое замедление, доля')
+    compare_parser.add_argument('--min-ms', type=float, default=0.5,
+                                help='Меньшие абсолютные замедления не считаются')
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
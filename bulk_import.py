@@ -0,0 +1,109 @@
+"""
+Потоковый импорт курьеров и заказов: POST /couriers/import и /orders/import.
+
+Обычные POST /couriers и /orders читают тело целиком и строят модель
+pydantic со всеми элементами сразу, так что память растет вместе с
+размером выгрузки. Здесь массив data разбирается по мере чтения тела
+(ijson), каждый элемент проверяется теми же правилами CourierBase/OrderBase,
+а в базу уходят пачки по IMPORT_CHUNK_SIZE элементов. В памяти одновременно
+держится одна пачка и id уже записанных элементов для ответа.
+
+Весь импорт — одна транзакция: если хоть один элемент не прошел проверку
+или его id уже занят, транзакция откатывается, а в ответе перечисляются
+id всех таких элементов, как в ValidationErrorHandler.invalid_post.
+После первой ошибки пачки не записываются, но их id по-прежнему проверяются
+на занятость и повторы: для этого id незаписанных пачек держатся в памяти.
+"""
+import os
+from typing import AsyncIterator, List, Type
+
+import ijson
+from pydantic import BaseModel, ValidationError
+
+# Сколько элементов записывать в базу за раз
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+
+
+class MalformedJSON(Exception):
+    pass
+
+
+class _StreamReader:
+    # ijson читает асинхронно из объекта с методом read(n)
+    def __init__(self, stream: AsyncIterator[bytes]):
+        self._stream = stream.__aiter__()
+        self._buffer = b''
+
+    async def read(self, size: int = -1) -> bytes:
+        while not self._buffer:
+            try:
+                self._buffer = await self._stream.__anext__()
+            except StopAsyncIteration:
+                return b''
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class StreamingImport:
+    def __init__(self, model: Type[BaseModel], id_field: str,
+                 chunk_size: int = None):
+        self.model = model
+        self.id_field = id_field
+        self.chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+        # id элементов, не прошедших проверку
+        self.invalid: List = []
+
+    def _validate(self, item):
+        try:
+            return self.model.parse_obj(item)
+        except ValidationError:
+            self.invalid.append(
+                item.get(self.id_field) if isinstance(item, dict) else None)
+
+    @staticmethod
+    async def _items(stream: AsyncIterator[bytes]) -> AsyncIterator:
+        # Элементы массива data. ijson.items_async молча не находит ничего,
+        # если data нет или это не массив, поэтому собираем элементы из
+        # событий парсера сами и следим, что массив data был
+        events = ijson.parse_async(_StreamReader(stream), use_float=True)
+        builder, in_data, seen_data = None, False, False
+        async for prefix, event, value in events:
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == 'data.item' and event in ('end_map', 'end_array'):
+                    yield builder.value
+                    builder = None
+            elif in_data and prefix == 'data.item':
+                if event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                else:
+                    yield value
+            elif prefix == 'data' and event in ('start_array', 'end_array'):
+                in_data = event == 'start_array'
+                seen_data = True
+        if not seen_data:
+            raise MalformedJSON('expected an object with a data array')
+
+    async def chunks(self, stream: AsyncIterator[bytes]) -> AsyncIterator[List[BaseModel]]:
+        """
+        Отдает пачки проверенных элементов из массива data. Невалидные
+        элементы в пачки не попадают, их id копятся в invalid. Если тело —
+        не объект с массивом data, бросает MalformedJSON.
+        """
+        chunk = []
+        try:
+            async for item in self._items(stream):
+                item = self._validate(item)
+                if item is None:
+                    continue
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+        except ijson.JSONError as e:
+            raise MalformedJSON(str(e)) from e
+        if chunk:
+            yield chunk
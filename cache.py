@@ -0,0 +1,294 @@
+"""
+Кэш ответов GET /couriers/{courier_id} в памяти процесса.
+
+Готовый CourierRating вместе с версией курьера (ETag) хранится в LRU-кэше
+с ограниченным временем жизни записи. Запись сбрасывается после коммита, который меняет курьера: crud
+вызывает courier_changed() внутри транзакции, а обработчик after_commit
+сессии удаляет записи. Если транзакция откатилась, кэш не трогается.
+
+Кэш свой у каждого процесса-воркера. Чтобы остальные воркеры узнали об
+изменении, courier_changed() в той же транзакции отправляет NOTIFY в канал
+courier_changed: Postgres доставит его только после коммита. Каждый воркер
+слушает канал в отдельном потоке (Listener). Включается переменной
+окружения COURIER_CACHE=on.
+
+Те же уведомления нужны для чтения с реплики: измененного курьера какое-то
+время читают с основной базы (см. routing).
+"""
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+import metrics
+import routing
+
+COURIER_CACHE = os.environ.get('COURIER_CACHE', 'off')
+COURIER_CACHE_SIZE = int(os.environ.get('COURIER_CACHE_SIZE', 10000))
+COURIER_CACHE_TTL = float(os.environ.get('COURIER_CACHE_TTL', 60))
+
+CHANNEL = 'courier_changed'
+# Полезная нагрузка NOTIFY ограничена 8000 байт
+NOTIFY_IDS = 500
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (срок жизни, значение), в порядке последнего обращения
+        self._data: OrderedDict = OrderedDict()
+        # Номер последнего сброса каждого ключа и счетчик сбросов всего кэша.
+        # Загрузка, начатая до сброса, не должна положить в кэш старое
+        # значение. Номера ключей хранятся для maxsize последних сброшенных
+        # ключей, у остальных номер — последний вытесненный: он не меньше
+        # любого их сброса, так что старая загрузка не пройдет и после
+        # вытеснения
+        self._versions: OrderedDict = OrderedDict()
+        self._last_version = self._evicted_version = 0
+        self._generation = 0
+        self.hits = self.misses = self.evictions = 0
+        self.expirations = self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= self._clock():
+                del self._data[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def version(self, key) -> Tuple[int, int]:
+        return self._generation, self._versions.get(key, self._evicted_version)
+
+    def put(self, key, value, version: Tuple[int, int] = None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if version is not None and version != self.version(key):
+                return
+            self._data[key] = (self._clock() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def load(self, key, load: Callable[[], Optional[object]]):
+        # Загружает значение мимо get, когда промах уже посчитан, и кладет
+        # его в кэш. None от load не кэшируется: например, курьера нет
+        version = self.version(key)
+        value = load()
+        if value is not None:
+            self.put(key, value, version)
+        return value
+
+    def get_or_load(self, key, load: Callable[[], Optional[object]]):
+        value = self.get(key) if self.enabled else None
+        if value is None:
+            value = self.load(key, load)
+        return value
+
+    def invalidate(self, keys: Iterable):
+        with self._lock:
+            for key in keys:
+                self._last_version += 1
+                self._versions[key] = self._last_version
+                self._versions.move_to_end(key)
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+            while len(self._versions) > max(self.maxsize, 1):
+                _, self._evicted_version = self._versions.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self._versions.clear()
+            self._generation += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
+
+
+couriers = LRUCache(
+    COURIER_CACHE_SIZE if COURIER_CACHE == 'on' else 0, COURIER_CACHE_TTL)
+
+
+def tracking_changes() -> bool:
+    # Об изменениях курьеров нужно знать кэшу или выбору реплики
+    return couriers.enabled or routing.router.enabled
+
+
+def courier_changed(db: Session, courier_ids: Optional[Iterable[int]]):
+    """
+    Отмечает курьеров измененными в текущей транзакции сессии. None —
+    изменились все курьеры. Записи сбрасываются после коммита.
+    """
+    if not tracking_changes():
+        return
+    pending = db.info.setdefault('changed_couriers', set())
+    if courier_ids is None:
+        pending.add(None)
+        payloads = ['*']
+    else:
+        ids = sorted(set(courier_ids))
+        pending.update(ids)
+        payloads = [','.join(map(str, ids[i:i + NOTIFY_IDS]))
+                    for i in range(0, len(ids), NOTIFY_IDS)]
+    for payload in payloads:
+        db.execute(func.pg_notify(CHANNEL, payload))
+
+
+def _changed(courier_ids):
+    if None in courier_ids:
+        couriers.clear()
+        routing.router.written(None)
+    else:
+        couriers.invalidate(courier_ids)
+        routing.router.written(courier_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changed = session.info.pop('changed_couriers', None)
+    if changed:
+        _changed(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('changed_couriers', None)
+
+
+class Listener:
+    """
+    Поток, который слушает канал courier_changed и сбрасывает записи,
+    измененные другими воркерами. Пока подключения нет, уведомления
+    теряются, поэтому после каждого (пере)подключения все курьеры
+    считаются измененными.
+    """
+
+    def __init__(self, engine, poll_interval: float = 1, retry_interval: float = 5):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.listening = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='courier-cache-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _connect(self):
+        # Отдельное подключение вне пула: оно все время занято LISTEN
+        connection = self.engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'LISTEN {CHANNEL}')
+        cursor.close()
+        return dbapi_connection
+
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = self._connect()
+                _changed({None})
+                self.listening.set()
+                while not self._stop.is_set():
+                    if not select.select([connection], [], [], self.poll_interval)[0]:
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.handle(connection.notifies.pop(0).payload)
+            except Exception:
+                logger.exception('courier cache listener failed, reconnecting')
+                _changed({None})
+                self._stop.wait(self.retry_interval)
+            finally:
+                self.listening.clear()
+                if connection is not None:
+                    connection.close()
+
+    @staticmethod
+    def handle(payload: str):
+        if payload == '*':
+            _changed({None})
+        else:
+            _changed([int(i) for i in payload.split(',')])
+
+
+listener: Optional[Listener] = None
+
+
+def start_listener(engine):
+    global listener
+    if tracking_changes() and listener is None:
+        listener = Listener(engine)
+        listener.start()
+
+
+def stop_listener():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+@metrics.collector
+def cache_metrics():
+    stats = couriers.stats()
+
+    def counter(name, help):
+        return (f'courier_cache_{name}_total', 'counter', help,
+                [({}, stats[name])])
+
+    return [
+        ('courier_cache_size', 'gauge', 'Cached courier profiles',
+         [({}, stats['size'])]),
+        counter('hits', 'Courier profile cache hits'),
+        counter('misses', 'Courier profile cache misses'),
+        counter('evictions', 'Entries evicted to stay within COURIER_CACHE_SIZE'),
+        counter('expirations', 'Entries dropped after COURIER_CACHE_TTL'),
+        counter('invalidations', 'Entries dropped because the courier changed'),
+    ]
@@ -1,15 +1,41 @@
+import contextlib
 import datetime
-import operator
-from collections import defaultdict
-from typing import List
-
-from sqlalchemy import func
+import decimal
+import functools
+import io
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import (Numeric, and_, any_, case, cast, delete, event, exists,
+                        func, or_, select, true, union, union_all, update)
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import Session
+from sqlalchemy.util import await_only
 
+import assignment
+import cache
 import models
+import order_index
 import schemas
 from models import TimeRange
 
+logger = logging.getLogger(__name__)
+
+# Сколько строк вставлять одним INSERT при массовом импорте
+BULK_INSERT_CHUNK = 1000
+
+# Способ импорта заказов: 'copy' — пачками через COPY,
+# 'rows' — построчно через ORM (для сравнения)
+ORDERS_IMPORT_MODE = os.environ.get('ORDERS_IMPORT_MODE', 'copy')
+
+# Сколько заказов передавать в одном COPY
+ORDERS_COPY_CHUNK_SIZE = int(os.environ.get('ORDERS_COPY_CHUNK_SIZE', 10000))
+
+# Сколько раз добирать заказы вместо занятых параллельными запросами
+ASSIGN_CLAIM_ATTEMPTS = 3
+
 carrying_capacity = {
     "foot": 10,
     "bike": 15,
@@ -23,6 +49,63 @@ coefficients = {
 }
 
 
+@contextlib.contextmanager
+def deferred_commit(db: Session):
+    # Обработчики назначения и завершения заказов внутри блока только
+    # сбрасывают изменения в базу, а транзакцию фиксирует вызывающий код,
+    # тоже внутри блока. Индекс свободных заказов меняется сразу, поэтому
+    # если транзакция откатилась, затронутые заказы перечитываются из базы
+    db.info['defer_commit'] = True
+    try:
+        yield
+    finally:
+        db.info.pop('defer_commit', None)
+        orders = (db.info.pop('index_orders', set())
+                  | db.info.pop('index_restore', set()))
+        order_index.index.refresh(db, sorted(orders))
+
+
+def _commit(db: Session):
+    if db.info.get('defer_commit'):
+        db.flush()
+    else:
+        db.commit()
+
+
+def _index_changed(db: Session, order_ids: Iterable[int]):
+    # Индекс уже изменен, а транзакция еще не зафиксирована (deferred_commit)
+    if db.info.get('defer_commit'):
+        db.info.setdefault('index_orders', set()).update(order_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _index_committed(session):
+    session.info.pop('index_orders', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _index_rolled_back(session):
+    orders = session.info.pop('index_orders', None)
+    if orders:
+        session.info.setdefault('index_restore', set()).update(orders)
+
+
+def get_existing_courier_ids(db: Session, ids: List[int]) -> List[int]:
+    return [i for i, in db.query(models.Courier.courier_id).filter(
+        models.Courier.courier_id == models.ids_array(ids)
+    ).order_by(models.Courier.courier_id)]
+
+
+def get_existing_order_ids(db: Session, ids: List[int]) -> List[int]:
+    # Занятым считается и id заказа, который уже ушел в архив
+    query = union(*[
+        select([table.order_id]).where(table.order_id == models.ids_array(ids))
+        for table in (models.Order, models.CouriersOrders,
+                      models.CouriersOrdersArchive)
+    ])
+    return sorted(i for i, in db.execute(query))
+
+
 def get_order_by_id(db: Session, id: int):
     return db.query(models.Order).filter(models.Order.order_id == id).first()
 
@@ -35,23 +118,40 @@ def get_courier_by_id(db: Session, id: int) -> models.Courier:
     return db.query(models.Courier).filter(models.Courier.courier_id == id).first()
 
 
+def get_courier_version(db: Session, id: int) -> Optional[int]:
+    return db.query(models.Courier.version).filter(
+        models.Courier.courier_id == id).scalar()
+
+
+def _bulk_insert(db: Session, table, rows: List[dict]):
+    # Вставляем строки пачками: один INSERT ... VALUES на пачку,
+    # без коммита — транзакцию завершает вызывающий код
+    for i in range(0, len(rows), BULK_INSERT_CHUNK):
+        db.execute(table.insert().values(rows[i:i + BULK_INSERT_CHUNK]))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_hours(hours: str) -> TimeRange:
+    start, _, stop = hours.rpartition('-')
+    return TimeRange(
+        datetime.time(*list(map(int, start.split(':')))),
+        datetime.time(*list(map(int, stop.split(':')))),
+        '[]')
+
+
 def _add_regions_for_courier(db: Session, courier_id: int, regions: List[int]):
-    for r in regions:
-        region = models.Region(region_id=r, courier_id=courier_id)
-        db.add(region)
-        db.commit()
-        db.refresh(region)
+    _bulk_insert(db, models.Region.__table__, [
+        {'region_id': r, 'courier_id': courier_id} for r in regions
+    ])
 
 
-def get_actual_courier_weight(db: Session, courier_id: int):
-    # Заказы курьера
-    orders = db.query(models.CouriersOrders, models.Order).filter(
-        models.CouriersOrders.courier_id == courier_id,
-        models.Order.order_id == models.CouriersOrders.order_id
-    ).all()
-    if orders:
-        return round(sum([i[1].weight for i in orders]), 2)
-    return 0
+def _open_orders_weight(courier_id: int):
+    # Суммарный вес невыполненных заказов курьера
+    return select([func.round(func.coalesce(
+        func.sum(cast(models.Order.weight, Numeric)), 0), 2)]).where(and_(
+            models.CouriersOrders.order_id == models.Order.order_id,
+            models.CouriersOrders.courier_id == courier_id,
+            models.CouriersOrders.complete_time == None)).scalar_subquery()
 
 
 def check_orders_after_patch(
@@ -59,106 +159,66 @@ def check_orders_after_patch(
         courier_id: int,
         type: bool,
         regions: bool,
-        working_hours: bool):
+        working_hours: bool) -> List[int]:
+    # Снимает с курьера заказы, которые после изменения ему не подходят
+    # по региону, графику или грузоподъемности. Все проверки — один
+    # DELETE, сколько бы заказов ни было у курьера. Транзакцию не
+    # фиксирует, возвращает id освободившихся заказов
+    if not (type or regions or working_hours):
+        return []
+
+    fits = true()
+    if regions:
+        courier_regions = func.array(select([models.Region.region_id]).where(
+            models.Region.courier_id == courier_id).scalar_subquery())
+        fits = and_(fits, models.Order.region == any_(courier_regions))
+    if working_hours:
+        fits = and_(fits, _fits_schedule(courier_id))
+
+    # Невыполненные заказы курьера и подходят ли они ему
+    open_orders = select([
+        models.CouriersOrders.id,
+        models.Order.order_id,
+        models.Order.weight,
+        fits.label('fits'),
+    ]).where(and_(
+        models.CouriersOrders.order_id == models.Order.order_id,
+        models.CouriersOrders.courier_id == courier_id,
+        models.CouriersOrders.complete_time == None)).subquery()
 
-    # Курьер
-    courier = get_courier_by_id(db=db, id=courier_id)
+    # Из подходящих оставляем самые легкие, пока помещаются:
+    # накопленный вес считаем оконной функцией по возрастанию веса
+    kept_weight = func.sum(case(
+        [(open_orders.c.fits, cast(open_orders.c.weight, Numeric))], else_=0
+    )).over(order_by=(open_orders.c.weight, open_orders.c.order_id))
+    ranked = select([
+        open_orders.c.id, open_orders.c.fits, kept_weight.label('kept_weight')
+    ]).subquery()
 
-    # Заказы курьера
-    orders = db.query(models.CouriersOrders).filter(
-        models.CouriersOrders.courier_id == courier_id,
-        models.CouriersOrders.complete_time == None
-    ).all()
+    courier_type = db.query(models.Courier.courier_type).filter(
+        models.Courier.courier_id == courier_id).scalar()
+    capacity = decimal.Decimal(str(carrying_capacity[courier_type]))
 
-    # Если заказы есть
-    if orders:
-        # Проверка по регионам
-        if regions:
-            courier_regions = [i.region_id for i in db.query(models.Region).filter(
-                models.Region.courier_id == courier_id
-            ).all()]
-
-            for order in orders:
-                order_region = db.query(models.Order).filter(
-                    models.Order.order_id == order.order_id
-                ).first()
-
-                # Если заказ не входит в регионы курьера
-                if order_region.region not in courier_regions:
-                    db.delete(order)
-                    order_region.taken = False
-                    db.flush()
-
-            actual_weight = get_actual_courier_weight(
-                db=db, courier_id=courier_id)
-            courier.orders_weight = actual_weight
-            db.commit()
-
-        # Проверка по графику работы
-        if working_hours:
-            # Обновляем заказы курьера
-            orders = db.query(models.CouriersOrders).filter(
-                models.CouriersOrders.courier_id == courier_id,
-                models.CouriersOrders.complete_time == None
-            ).all()
-
-            courier_wh = db.query(models.WorkingHours).filter(
-                models.WorkingHours.courier_id == courier_id
-            ).all()
-
-            for order in orders:
-                # Уже удаленные заказы
-                deleted_orders = set()
-
-                # Промежутки, в которые клиенту удобно принять заказ
-                order_dh = db.query(models.DeliveryHours).filter(
-                    models.DeliveryHours.order_id == order.order_id
-                ).all()
-
-                for wh in courier_wh:
-                    for dh in order_dh:
-                        if order.order_id not in deleted_orders and not (dh.delivery_hours.lower < wh.working_hours.upper and dh.delivery_hours.upper > wh.working_hours.lower):
-                            db.delete(order)
-                            db.query(models.Order).filter(
-                                models.Order.order_id == order.order_id
-                            ).update(
-                                {'taken': False}
-                            )
-                            deleted_orders.add(order.order_id)
-                            db.flush()
-
-            actual_weight = get_actual_courier_weight(
-                db=db, courier_id=courier_id)
-            courier.orders_weight = actual_weight
-            db.commit()
-
-        if type:
-            # Обновляем заказы курьера
-            orders = db.query(models.CouriersOrders, models.Order).filter(
-                models.CouriersOrders.courier_id == courier_id,
-                models.CouriersOrders.complete_time == None,
-                models.Order.order_id == models.CouriersOrders.order_id
-            ).order_by(models.Order.weight.asc()).all()
+    to_release = select([ranked.c.id]).where(or_(
+        ~ranked.c.fits, ranked.c.kept_weight > capacity))
 
-            max_capacity = carrying_capacity[courier.courier_type]
+    released = [i for i, in db.execute(
+        delete(models.CouriersOrders.__table__).where(
+            models.CouriersOrders.id.in_(to_release)
+        ).returning(models.CouriersOrders.order_id))]
 
-            # Если вес заказов, больше чем курьер может унести
-            while len(orders) > 0 and courier.orders_weight > max_capacity:
-                order = orders.pop()
-                courier.orders_weight = models.Courier.orders_weight - \
-                    order[1].weight
-                db.flush()
+    if released:
+        # Снятые заказы снова свободны
+        db.query(models.Order).filter(
+            models.Order.order_id == models.ids_array(released)
+        ).update({models.Order.taken: False}, synchronize_session=False)
 
-                # Удаляем запись из таблицы couriers_orders
-                db.delete(order[0])
+        db.query(models.Courier).filter(
+            models.Courier.courier_id == courier_id
+        ).update({models.Courier.orders_weight: _open_orders_weight(courier_id)},
+                 synchronize_session=False)
 
-                # Обновляем столбец, в таблице orders
-                db.query(models.Order).filter(
-                    models.Order.order_id == order[1].order_id
-                ).update(
-                    {'taken': False}
-                )
-            db.commit()
+    return released
 
 
 def patch_courier(db: Session, courier_id: int, input: schemas.CourierPatchInput):
@@ -169,11 +229,13 @@ def patch_courier(db: Session, courier_id: int, input: schemas.CourierPatchInput
         'working_hours': False,
     }
 
+    # Версия курьера растет при любом изменении
+    values = {models.Courier.version: models.Courier.version + 1}
     if input.courier_type:
-        print('ok')
-        db.query(models.Courier).filter(models.Courier.courier_id == courier_id).update(
-            {models.Courier.courier_type: input.courier_type}, synchronize_session=False)
+        values[models.Courier.courier_type] = input.courier_type
         changed['type'] = True
+    db.query(models.Courier).filter(models.Courier.courier_id == courier_id).update(
+        values, synchronize_session=False)
 
     if input.regions:
         db.query(models.Region).filter(models.Region.courier_id ==
@@ -189,59 +251,40 @@ def patch_courier(db: Session, courier_id: int, input: schemas.CourierPatchInput
             db=db, courier_id=courier_id, working_hours=input.working_hours)
         changed['working_hours'] = True
 
+    # Изменения курьера и снятие неподходящих заказов — одна транзакция
+    released = check_orders_after_patch(db=db, courier_id=courier_id, **changed)
+    cache.courier_changed(db, [courier_id])
     db.commit()
 
-    check_orders_after_patch(db=db, courier_id=courier_id, **changed)
+    order_index.index.refresh(db, released)
     return get_courier_by_id(db=db, id=courier_id)
 
 
-def _add_courier(db: Session, courier: models.Courier):
-    db.add(courier)
-    db.commit()
-    db.refresh(courier)
-
-
 def _add_order(db: Session, order: models.Order):
+    # Только flush: коммит делает вызывающий код, иначе импорт
+    # не откатится целиком
     db.add(order)
-    db.commit()
-    db.refresh(order)
+    db.flush()
 
 
 def _add_delivery_hours_for_order(db: Session, order_id: int, delivery_hours: List[str]):
     for dh in delivery_hours:
-        start, _, stop = dh.rpartition('-')
-        dh = models.DeliveryHours(
+        db.add(models.DeliveryHours(
             order_id=order_id,
-            delivery_hours=TimeRange(
-                datetime.time(*list(map(int, start.split(':')))),
-                datetime.time(*list(map(int, stop.split(':')))),
-                '[]')
-        )
-        db.add(dh)
-        db.commit()
-        db.refresh(dh)
+            delivery_hours=_parse_hours(dh)
+        ))
+    db.flush()
 
 
 def _add_working_hours_for_courier(db: Session, courier_id: int, working_hours: List[str]):
-    for wh in working_hours:
-        start, _, stop = wh.rpartition('-')
-        wh = models.WorkingHours(
-            courier_id=courier_id,
-            working_hours=TimeRange(
-                datetime.time(*list(map(int, start.split(':')))),
-                datetime.time(*list(map(int, stop.split(':')))),
-                '[]')
-        )
-        db.add(wh)
-        db.commit()
-        db.refresh(wh)
-
+    _bulk_insert(db, models.WorkingHours.__table__, [
+        {'courier_id': courier_id, 'working_hours': _parse_hours(wh)}
+        for wh in working_hours
+    ])
 
-def add_orders(db: Session, orders: schemas.OrdersPostRequest):
-    answer = defaultdict(list)
-    for i in orders.data:
-        id = schemas.OrderId(id=i.order_id)
 
+def _insert_orders(db: Session, orders: List[schemas.OrderBase]):
+    for i in orders:
         order = models.Order(
             order_id=i.order_id,
             weight=i.weight,
@@ -251,173 +294,548 @@ def add_orders(db: Session, orders: schemas.OrdersPostRequest):
         _add_order(db, order)
         _add_delivery_hours_for_order(db, i.order_id, i.delivery_hours)
 
-        answer['orders'].append(id)
-    return answer
 
+def _copy_text(value) -> str:
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, TimeRange):
+        return '{}{},{}{}'.format(
+            '[' if value.lower_inc else '(', value.lower,
+            value.upper, ']' if value.upper_inc else ')')
+    return str(value)
 
-def add_couriers(db: Session, couriers: schemas.CouriersPostRequest):
-    answer = defaultdict(list)
-    for i in couriers.data:
-        id = schemas.CourierId(id=i.courier_id)
 
-        courier = models.Courier(
-            courier_id=i.courier_id,
-            courier_type=i.courier_type,
-        )
-        _add_courier(db, courier)
-        _add_regions_for_courier(db, i.courier_id, i.regions)
-        _add_working_hours_for_courier(db, i.courier_id, i.working_hours)
+def _copy_rows(db: Session, table: str, columns: List[str], rows: List[tuple]):
+    # COPY выполняется в транзакции сессии, коммит делает вызывающий код
+    dialect = db.get_bind().dialect
+    connection = db.connection().connection
 
-        answer['couriers'].append(id)
-    return answer
+    if dialect.driver == 'asyncpg':
+        # Внутри AsyncSession.run_sync корутину драйвера можно дождаться
+        # через await_only
+        to_range = models.TIMERANGE().bind_processor(dialect)
+        await_only(connection.driver_connection.copy_records_to_table(
+            table,
+            records=[tuple(map(to_range, row)) for row in rows],
+            columns=columns))
+        return
 
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(_copy_text, row)) + '\n')
+    buf.seek(0)
 
-def get_max_assigns_for_courier(db: Session, courier_id: int):
-    # Ответ
-    answer = {'orders': []}
+    cursor = connection.cursor()
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), buf)
+    cursor.close()
 
-    # Время назначения заказа
-    assign_time = datetime.datetime.now().isoformat('T') + 'Z'
 
-    # Сколько курьер может унести
-    courier = get_courier_by_id(db, courier_id)
-    capacity = carrying_capacity[courier.courier_type] - courier.orders_weight
-    orders_weight = courier.orders_weight
+def _copy_orders(db: Session, orders: List[schemas.OrderBase], chunk_size: int):
+    started = time.perf_counter()
 
-    # Регионы курьера
-    regions = [i.region_id for i in db.query(models.Region).filter(
-        models.Region.courier_id == courier_id).all()]
+    for start in range(0, len(orders), chunk_size):
+        chunk = orders[start:start + chunk_size]
 
-    # Список, времени работы курьера
-    working_hours = db.query(models.WorkingHours).filter(
-        models.WorkingHours.courier_id == courier_id).all()
+        _copy_rows(db, 'orders', ['order_id', 'weight', 'region', 'taken'], [
+            (i.order_id, i.weight, i.region, False) for i in chunk
+        ])
+        _copy_rows(db, 'delivery_hours', ['order_id', 'delivery_hours'], [
+            (i.order_id, _parse_hours(dh))
+            for i in chunk for dh in i.delivery_hours
+        ])
 
-    # Выбираем orders, с подходящим регионом и весом не больше максимальноного
-    orders = db.query(models.Order).filter(models.Order.region.in_(regions), models.Order.weight <=
-                                           capacity, models.Order.taken == False).order_by(models.Order.weight.asc())
+        logger.info(
+            'orders import: copied %d/%d orders in %.3f s',
+            start + len(chunk), len(orders), time.perf_counter() - started)
 
-    # Список orders которые назначим курьеру
-    to_assign = []
-    assigned_orders = set()
 
-    # Находим заказы, подходящие по времени
-    for order in orders:
-        # Промежутки, в которые клиенту удобно принять заказ
-        delivery_hours = db.query(models.DeliveryHours).filter(
-            models.DeliveryHours.order_id == order.order_id).all()
+def write_orders(
+        db: Session,
+        orders: List[schemas.OrderBase],
+        mode: str = None,
+        chunk_size: int = None):
+    # Записывает заказы в транзакции сессии, коммит делает вызывающий код
+    mode = mode or ORDERS_IMPORT_MODE
+    if mode == 'copy':
+        _copy_orders(db, orders, chunk_size or ORDERS_COPY_CHUNK_SIZE)
+    elif mode == 'rows':
+        _insert_orders(db, orders)
+    else:
+        raise ValueError(f'Unknown orders import mode: {mode}')
 
-        if orders_weight + order.weight > capacity:
-            break
 
-        for dh in delivery_hours:
-            for wh in working_hours:
-                if order.order_id not in assigned_orders and dh.delivery_hours.lower < wh.working_hours.upper and dh.delivery_hours.upper > wh.working_hours.lower:
-                    assigned_orders.add(order.order_id)
+def add_orders(
+        db: Session,
+        orders: schemas.OrdersPostRequest,
+        mode: str = None,
+        chunk_size: int = None):
+    mode = mode or ORDERS_IMPORT_MODE
+    started = time.perf_counter()
 
-                    # Указываем в таблице order, что заказ взят
-                    db.query(models.Order).filter(models.Order.order_id ==
-                                                  order.order_id).update({models.Order.taken: True})
-                    db.commit()
+    write_orders(db, orders.data, mode, chunk_size)
+    db.commit()
 
-                    # Добавляем пару курьер-заказ в таблицу couriers_orders
-                    courier_order = models.CouriersOrders(
-                        order_id=order.order_id,
-                        courier_id=courier_id,
-                        assign_time=assign_time,
-                        #id = order.order_id
-                    )
+    if order_index.index.active:
+        order_index.index.add(
+            order_index.to_open_order(
+                i.order_id, i.weight, i.region, map(_parse_hours, i.delivery_hours))
+            for i in orders.data)
+
+    logger.info(
+        'orders import (%s): %d orders in %.3f s',
+        mode, len(orders.data), time.perf_counter() - started)
+
+    return {'orders': [schemas.OrderId(id=i.order_id) for i in orders.data]}
+
+
+def write_couriers(db: Session, couriers: List[schemas.CourierBase]):
+    # Собираем строки для всех таблиц сразу и вставляем пачками.
+    # Коммит делает вызывающий код
+    couriers_rows, regions_rows, working_hours_rows = [], [], []
+    for i in couriers:
+        couriers_rows.append({
+            'courier_id': i.courier_id,
+            'courier_type': i.courier_type,
+        })
+        regions_rows.extend(
+            {'region_id': r, 'courier_id': i.courier_id} for r in i.regions)
+        working_hours_rows.extend(
+            {'courier_id': i.courier_id, 'working_hours': _parse_hours(wh)}
+            for wh in i.working_hours)
+
+    _bulk_insert(db, models.Courier.__table__, couriers_rows)
+    _bulk_insert(db, models.Region.__table__, regions_rows)
+    _bulk_insert(db, models.WorkingHours.__table__, working_hours_rows)
+    # Новых курьеров, как и измененных, реплика увидит не сразу
+    cache.courier_changed(db, [i.courier_id for i in couriers])
 
-                    to_assign.append(courier_order)
-                    orders_weight += order.weight
 
-                    answer['orders'].append({'id': order.order_id})
+def add_couriers(db: Session, couriers: schemas.CouriersPostRequest):
+    # Весь импорт записываем одной транзакцией: либо все курьеры, либо ни одного
+    write_couriers(db, couriers.data)
+    db.commit()
 
-    # Коммитим заказы в бд
-    if to_assign:
-        db.add_all(to_assign)
+    return {'couriers': [schemas.CourierId(id=i.courier_id) for i in couriers.data]}
+
+
+def _fits_schedule(courier_id):
+    # Хотя бы один промежуток доставки заказа пересекается с графиком
+    # курьера. courier_id — число или колонка внешнего запроса.
+    # График подставляем в запрос массивом: так планировщик ищет заказы
+    # по частичному индексу на (region, weight), а не перебирает все
+    # пересечения графиков через GiST
+    working_hours = func.array(select([models.WorkingHours.working_hours]).where(
+        models.WorkingHours.courier_id == courier_id).scalar_subquery())
+
+    # Промежуток доставки берем открытым, чтобы окна, которые только
+    # касаются границами, не считались пересекающимися
+    delivery_window = func.timerange(
+        func.lower(models.DeliveryHours.delivery_hours),
+        func.upper(models.DeliveryHours.delivery_hours),
+        '()')
+
+    return exists().where(and_(
+        models.DeliveryHours.order_id == models.Order.order_id,
+        delivery_window.op('&&')(any_(working_hours))))
+
+
+def _fitting_orders_query(db: Session, courier_id: int, capacity: float):
+    # Регионы курьера тоже подставляем массивом
+    regions = func.array(select([models.Region.region_id]).where(
+        models.Region.courier_id == courier_id).scalar_subquery())
+
+    # Свободные заказы из регионов курьера, которые он может унести
+    return db.query(models.Order.order_id, models.Order.weight).filter(
+        models.Order.taken == False,
+        models.Order.weight <= capacity,
+        models.Order.region == any_(regions),
+        _fits_schedule(courier_id))
+
+
+def _fitting_pairs_query(db: Session, courier_ids: List[int], capacity: float):
+    # Все пары курьер-заказ, где свободный заказ подходит курьеру по
+    # региону и графику. capacity — наибольшая свободная грузоподъемность
+    # среди курьеров, точнее по весу отбирает match_batch
+    return db.query(
+        models.Region.courier_id, models.Order.order_id, models.Order.weight
+    ).join(
+        models.Order, models.Order.region == models.Region.region_id
+    ).filter(
+        models.Region.courier_id == models.ids_array(courier_ids),
+        models.Order.taken == False,
+        models.Order.weight <= capacity,
+        _fits_schedule(models.Region.courier_id)
+    ).distinct()
+
+
+def _free_capacity(courier: models.Courier) -> float:
+    return round(
+        carrying_capacity[courier.courier_type] - courier.orders_weight, 2)
+
+
+def _lock_couriers(db: Session, courier_ids: List[int]) -> List[models.Courier]:
+    # Блокируем строки курьеров до конца транзакции: параллельные
+    # назначения одному курьеру выполняются по очереди и видят его
+    # актуальный вес. Разным курьерам блокировка не мешает
+    return db.query(models.Courier).filter(
+        models.Courier.courier_id == models.ids_array(courier_ids)
+    ).order_by(models.Courier.courier_id).with_for_update().populate_existing().all()
+
+
+def _claim_orders(db: Session, orders: List) -> List:
+    # Атомарно занимает заказы: берет только те, что еще свободны и не
+    # заблокированы другой транзакцией. Чужие блокировки не ждем —
+    # заказы, которые прямо сейчас назначает другой запрос, пропускаем
+    free = select([models.Order.order_id]).where(and_(
+        models.Order.order_id == models.ids_array([i.order_id for i in orders]),
+        models.Order.taken == False
+    )).with_for_update(skip_locked=True)
+
+    claimed = {i for i, in db.execute(
+        update(models.Order.__table__).where(
+            models.Order.order_id.in_(free)
+        ).values(taken=True).returning(models.Order.order_id))}
+    return [i for i in orders if i.order_id in claimed]
+
+
+def _courier_changed(db: Session, courier: models.Courier):
+    # Версия обновится тем же UPDATE, которым сессия запишет курьера
+    courier.version = models.Courier.version + 1
+    cache.courier_changed(db, [courier.courier_id])
+
+
+def _save_assignment(db: Session, courier: models.Courier, orders: List,
+                     assign_time: datetime.datetime) -> List:
+    # Записывает назначение заказов курьеру, не фиксируя транзакцию.
+    # Возвращает заказы, которые удалось занять
+    orders = _claim_orders(db, orders)
+    if not orders:
+        return orders
+
+    # Добавляем пары курьер-заказ в таблицу couriers_orders
+    _bulk_insert(db, models.CouriersOrders.__table__, [
+        {'order_id': i.order_id, 'courier_id': courier.courier_id,
+            'assign_time': assign_time}
+        for i in orders
+    ])
 
     # Обновляем вес курьера
-    db.query(models.Courier).filter(models.Courier.courier_id ==
-                                    courier_id).update({models.Courier.orders_weight: orders_weight})
-    db.commit()
+    courier.orders_weight = round(
+        courier.orders_weight + sum(i.weight for i in orders), 2)
+    _courier_changed(db, courier)
+    return orders
+
+
+def _assign_from_index(db: Session, courier: models.Courier, capacity: float,
+                       strategy: assignment.AssignStrategy,
+                       assign_time: datetime.datetime):
+    # Кандидаты берутся из индекса свободных заказов в памяти, в базу
+    # идем только за графиком курьера и чтобы записать назначение.
+    # Возвращает None, если индекс разошелся с базой или не нашел заказов:
+    # заказы, загруженные или снятые с курьеров другими процессами, в
+    # индекс этого процесса не попадают, и их ищем запросом к базе
+    index = order_index.index
+    index.ensure_loaded(db)
 
+    regions = [i.region_id for i in courier.regions]
+    working_hours = [(i.working_hours.lower, i.working_hours.upper)
+                     for i in courier.working_hours]
+    to_assign = index.claim(
+        regions, working_hours, capacity,
+        lambda candidates: strategy.select(
+            candidates[:strategy.max_items], capacity))
+    if not to_assign:
+        return None
+
+    order_ids = [i.order_id for i in to_assign]
+    _index_changed(db, order_ids)
+    try:
+        claimed = _save_assignment(db, courier, to_assign, assign_time)
+        if len(claimed) != len(to_assign):
+            # Часть заказов уже взял другой процесс
+            db.rollback()
+            logger.warning('order index is stale for orders %s', order_ids)
+            index.refresh(db, order_ids)
+            return None
+        _commit(db)
+    except Exception:
+        db.rollback()
+        index.refresh(db, order_ids)
+        raise
+    return to_assign
+
+
+def _assign_answer(orders: List, assign_time: datetime.datetime) -> Dict:
+    answer = {'orders': [{'id': i.order_id} for i in orders]}
     # Если не удалось найти подходящих заказов, assign_time возвращать не нужно
     if answer['orders']:
-        answer['assign_time'] = assign_time
-
+        answer['assign_time'] = format_time(assign_time)
     return answer
 
 
-def get_delivery_time(db: Session, complete: schemas.OrdersComplete) -> int:
-    # Время окончания этого заказа
-    this_order_end_time = datetime.datetime.strptime(
-        complete.complete_time,
-        '%Y-%m-%dT%H:%M:%S.%fZ'
-    )
+def get_max_assigns_for_courier(db: Session, courier_id: int):
+    # Время назначения заказа
+    assign_time = datetime.datetime.now(datetime.timezone.utc)
+
+    # Сколько курьер еще может унести
+    courier, = _lock_couriers(db, [courier_id])
+    capacity = _free_capacity(courier)
+
+    # Какие из подходящих заказов взять, решает выбранная стратегия
+    strategy = assignment.strategy
+
+    if order_index.index.enabled:
+        to_assign = _assign_from_index(
+            db, courier, capacity, strategy, assign_time)
+        if to_assign is not None:
+            return _assign_answer(to_assign, assign_time)
+        courier, = _lock_couriers(db, [courier_id])
+
+    # Если часть выбранных заказов параллельно занял другой запрос,
+    # добираем вместо них другие на освободившееся место
+    assigned = []
+    for _ in range(ASSIGN_CLAIM_ATTEMPTS):
+        capacity = _free_capacity(courier)
+        candidates = strategy.prepare(
+            _fitting_orders_query(db, courier_id, capacity), capacity).all()
+        to_assign = strategy.select(candidates, capacity)
+        if not to_assign:
+            break
+
+        claimed = _save_assignment(db, courier, to_assign, assign_time)
+        assigned += claimed
+        if len(claimed) == len(to_assign):
+            break
+
+    _commit(db)
+    _index_changed(db, [i.order_id for i in assigned])
+    order_index.index.discard(i.order_id for i in assigned)
+
+    return _assign_answer(assigned, assign_time)
 
-    # Находим все предыдущие заказы курьера
-    orders = db.query(models.CouriersOrders).filter(
-        models.CouriersOrders.courier_id == complete.courier_id,
-        models.CouriersOrders.complete_time != None
-    ).all()
 
+def get_max_assigns_for_couriers(db: Session, courier_ids: List[int]):
+    # Назначение сразу нескольким курьерам: кандидаты загружаются одним
+    # запросом, заказы распределяются между курьерами совместно,
+    # и все назначения фиксируются одной транзакцией
+    assign_time = datetime.datetime.now(datetime.timezone.utc)
+
+    couriers = _lock_couriers(db, courier_ids)
+    capacities = {i.courier_id: _free_capacity(i) for i in couriers}
+
+    candidates = _fitting_pairs_query(
+        db, courier_ids, max(capacities.values())).all()
+    to_assign = assignment.match_batch(candidates, capacities)
+
+    # Заказы, которые успел занять параллельный запрос, просто не попадут
+    # в ответ
+    for courier in couriers:
+        if to_assign[courier.courier_id]:
+            to_assign[courier.courier_id] = _save_assignment(
+                db, courier, to_assign[courier.courier_id], assign_time)
+    db.commit()
+    order_index.index.discard(
+        i.order_id for orders in to_assign.values() for i in orders)
+
+    return {'couriers': [
+        dict(courier_id=i, **_assign_answer(to_assign[i], assign_time))
+        for i in courier_ids
+    ]}
+
+
+def parse_time(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(
+        value, '%Y-%m-%dT%H:%M:%S.%fZ'
+    ).replace(tzinfo=datetime.timezone.utc)
+
+
+def format_time(value: datetime.datetime) -> str:
+    # Формат как в примерах API: 2021-01-10T09:32:14.42Z
+    return value.astimezone(datetime.timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S.%f')[:-4] + 'Z'
+
+
+def get_delivery_time(
+        courier: models.Courier,
+        courier_order: models.CouriersOrders,
+        complete_time: datetime.datetime) -> int:
     # Время доставки = разница между временем окончания этого заказа
-    # и временем окончания предыдущего
-    if orders:
-        orders_prev = [
-            datetime.datetime.strptime(
-                i.complete_time, '%Y-%m-%dT%H:%M:%S.%fZ')
-            for i in orders
-        ]
-        orders_prev.sort()
-        prev_order_end_time = orders_prev[-1]
-    # Если это первый выполненный заказ
-    else:
-        prev_order = db.query(models.CouriersOrders).filter(
-            models.CouriersOrders.order_id == complete.order_id
-        ).first()
-        prev_order_end_time = datetime.datetime.strptime(
-            prev_order.assign_time,
-            '%Y-%m-%dT%H:%M:%S.%fZ'
-        )
-    return (this_order_end_time - prev_order_end_time).seconds
+    # и временем окончания предыдущего, а для первого выполненного
+    # заказа — временем назначения
+    prev_order_end_time = courier.last_complete_time or courier_order.assign_time
+    return (complete_time - prev_order_end_time).seconds
+
+
+def _add_completed_to_stats(db: Session, courier: models.Courier, region: int, delivery_time: int):
+    stats = models.CourierStats
+    stmt = postgresql.insert(stats).values(
+        courier_id=courier.courier_id,
+        region=region,
+        completed=1,
+        delivery_time_sum=delivery_time,
+        earnings=500 * coefficients[courier.courier_type],
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[stats.courier_id, stats.region],
+        set_={
+            'completed': stats.completed + stmt.excluded.completed,
+            'delivery_time_sum': stats.delivery_time_sum + stmt.excluded.delivery_time_sum,
+            'earnings': stats.earnings + stmt.excluded.earnings,
+        }
+    ))
 
 
 def orders_complete(db: Session, complete: schemas.OrdersComplete):
-    # Обновляем таблицу couriers_orders
-    db.query(models.CouriersOrders).filter(
+    # Возвращает None, если заказ уже завершен параллельным запросом
+    complete_time = parse_time(complete.complete_time)
+
+    # Блокируем курьера, как при назначении: вес, версия и время последнего
+    # заказа считаются от его актуальной строки
+    courier, = _lock_couriers(db, [complete.courier_id])
+    courier_order = db.query(models.CouriersOrders).filter(
         models.CouriersOrders.courier_id == complete.courier_id,
-        models.CouriersOrders.order_id == complete.order_id
-    ).update(
-        {'complete_time': complete.complete_time,
-         'delivery_time': get_delivery_time(db, complete)},
-        synchronize_session=False
-    )
+        models.CouriersOrders.order_id == complete.order_id,
+        models.CouriersOrders.complete_time == None
+    ).populate_existing().first()
+    if courier_order is None:
+        return None
+
+    # Обновляем таблицу couriers_orders
+    delivery_time = get_delivery_time(courier, courier_order, complete_time)
+    courier_order.complete_time = complete_time
+    courier_order.delivery_time = delivery_time
+
+    # Запоминаем время последнего выполненного заказа курьера. Заказы могут
+    # завершать не по порядку, поэтому более раннее время не записываем
+    if courier.last_complete_time is None or complete_time > courier.last_complete_time:
+        courier.last_complete_time = complete_time
 
     # Получаем заказ
     order = db.query(models.Order).filter(
         models.Order.order_id == complete.order_id
     ).first()
 
-    # TODO зачем хз
-    # Удаляем записи из таблицы delivery_hours
-    # db.query(models.DeliveryHours).filter(
-    #    models.DeliveryHours.order_id == order.order_id
-    # ).delete(synchronize_session=False)
+    # Заказ и его delivery_hours остаются до архивации (archive_completed)
 
     # Обновляем вес курьера в таблице orders
-    courier = db.query(models.Courier).filter(
-        models.Courier.courier_id == complete.courier_id
-    ).first()
-
     current_weight = round(courier.orders_weight - order.weight, 2)
     courier.orders_weight = current_weight
 
-    db.commit()
+    # Учитываем заказ в статистике курьера
+    _add_completed_to_stats(db, courier, order.region, delivery_time)
+    _courier_changed(db, courier)
+
+    _commit(db)
+    _index_changed(db, [complete.order_id])
+    order_index.index.discard([complete.order_id])
 
     return schemas.OrderCompleteAnswer(order_id=complete.order_id)
 
 
+def backfill_courier_stats(db: Session) -> int:
+    # Пересчитываем статистику по всем завершенным заказам. Заработок
+    # считаем по текущему типу курьера: прежний тип в истории не хранится
+    archive = models.CouriersOrdersArchive
+    done = union_all(
+        select([
+            models.CouriersOrders.courier_id,
+            models.Order.region,
+            models.CouriersOrders.delivery_time,
+        ]).select_from(
+            models.CouriersOrders.__table__.join(
+                models.Order.__table__,
+                models.Order.order_id == models.CouriersOrders.order_id
+            )
+        ).where(
+            models.CouriersOrders.complete_time != None
+        ),
+        select([archive.courier_id, archive.region, archive.delivery_time]),
+    ).subquery('done')
+
+    completed = func.count()
+    rows = select([
+        done.c.courier_id,
+        done.c.region,
+        completed,
+        func.sum(done.c.delivery_time),
+        completed * 500 * case(coefficients, value=models.Courier.courier_type),
+    ]).select_from(
+        done.join(
+            models.Courier.__table__,
+            models.Courier.courier_id == done.c.courier_id
+        )
+    ).group_by(
+        done.c.courier_id,
+        done.c.region,
+        models.Courier.courier_type
+    )
+
+    db.query(models.CourierStats).delete(synchronize_session=False)
+    result = db.execute(models.CourierStats.__table__.insert().from_select(
+        ['courier_id', 'region', 'completed', 'delivery_time_sum', 'earnings'],
+        rows))
+    # Рейтинг и заработок могли измениться у любого курьера
+    db.query(models.Courier).update(
+        {models.Courier.version: models.Courier.version + 1},
+        synchronize_session=False)
+    cache.courier_changed(db, None)
+    db.commit()
+
+    return result.rowcount
+
+
+def _archive_batch(db: Session, before: datetime.datetime, batch_size: int) -> List[int]:
+    assigned = models.CouriersOrders.__table__
+    orders = models.Order.__table__
+    archive = models.CouriersOrdersArchive.__table__
+
+    # Одним запросом: забрать пачку завершенных назначений из couriers_orders
+    # и положить их в архив вместе с весом и регионом заказа
+    batch = select([assigned.c.id]).where(
+        assigned.c.complete_time < before
+    ).order_by(assigned.c.id).limit(batch_size).with_for_update(skip_locked=True)
+    moved = delete(assigned).where(
+        assigned.c.id.in_(batch)
+    ).returning(*assigned.c).cte('moved')
+    rows = select([
+        moved.c.id, moved.c.order_id, moved.c.courier_id, moved.c.assign_time,
+        moved.c.complete_time, moved.c.delivery_time, orders.c.weight,
+        orders.c.region,
+    ]).select_from(
+        moved.outerjoin(orders, orders.c.order_id == moved.c.order_id)
+    )
+    result = db.execute(archive.insert().from_select(
+        ['id', 'order_id', 'courier_id', 'assign_time', 'complete_time',
+         'delivery_time', 'weight', 'region'], rows
+    ).returning(archive.c.order_id))
+    order_ids = [i for i, in result]
+
+    if order_ids:
+        hours = models.DeliveryHours.__table__
+        db.execute(delete(hours).where(hours.c.order_id == models.ids_array(order_ids)))
+        db.execute(delete(orders).where(orders.c.order_id == models.ids_array(order_ids)))
+    return order_ids
+
+
+def archive_completed(db: Session, before: datetime.datetime,
+                      batch_size: int = 10000) -> int:
+    """
+    Переносит назначения, завершенные раньше before, в couriers_orders_archive
+    и удаляет сами заказы с их delivery_hours. Каждая пачка — отдельная
+    транзакция, чтобы не держать блокировки на время всего переноса.
+    Статистика курьеров не меняется: courier_stats уже учитывает эти заказы.
+    """
+    archived = 0
+    while True:
+        order_ids = _archive_batch(db, before, batch_size)
+        db.commit()
+        archived += len(order_ids)
+        logger.info('archived %d completed orders', len(order_ids))
+        if len(order_ids) < batch_size:
+            return archived
+
+
 def get_courier(db: Session, courier_id: int):
     courier = get_courier_by_id(db=db, id=courier_id)
 
@@ -428,38 +846,19 @@ def get_courier(db: Session, courier_id: int):
         'working_hours': courier.working_hours,
     }
 
-    # Заработок курьера
-    N = len(db.query(models.CouriersOrders).filter(
-        models.CouriersOrders.courier_id == courier_id,
-        models.CouriersOrders.complete_time != None
-    ).all())
-    sum = N * 500 * coefficients[courier.courier_type]
-
-    # Среднее время доставки по регионам
-    regions = [i.region_id for i in courier.regions]
-    avg_time = db.query(
-        models.Order.region,
-        func.avg(models.CouriersOrders.delivery_time)
-    ).filter(
-        models.Order.region.in_(regions)
-    ).join(
-        models.CouriersOrders,
-        models.CouriersOrders.order_id == models.Order.order_id
-    ).group_by(
-        models.Order.region
+    # Статистика курьера по регионам
+    stats = db.query(models.CourierStats).filter(
+        models.CourierStats.courier_id == courier_id,
+        models.CourierStats.completed > 0
     ).all()
 
-    completed_orders = len(db.query(models.CouriersOrders).filter(
-        models.CouriersOrders.courier_id == courier_id,
-        models.CouriersOrders.delivery_time != 0
-    ).all())
-
     # Если есть выполненные заказы, то добавляем в ответ
     # rating и earnings
-    if avg_time and completed_orders > 0:
-        t = float(min(avg_time, key=operator.itemgetter(1))[1])
+    if stats:
+        # Минимальное из средних времен доставки по районам
+        t = min(i.delivery_time_sum / i.completed for i in stats)
         rating = (60*60 - min(t, 60*60))/(60*60) * 5
         answer['rating'] = round(rating, 2)
-        answer['earnings'] = sum
+        answer['earnings'] = sum(i.earnings for i in stats)
 
     return answer
@@ -2,8 +2,8 @@ import os
 
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
@@ -16,9 +16,75 @@ SQLALCHEMY_DATABASE_URL = "postgresql://{}:{}@localhost:5432/{}".format(
     os.environ.get('DBNAME'),
 )
 
+SQLALCHEMY_ASYNC_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace(
+    'postgresql://', 'postgresql+asyncpg://', 1)
+
+# Реплика для обработчиков только для чтения (см. routing), по умолчанию нет
+DB_REPLICA_URL = os.environ.get('DB_REPLICA_URL')
+# Сколько секунд после изменения курьера читать его с основной базы
+DB_REPLICA_LAG_WINDOW = float(os.environ.get('DB_REPLICA_LAG_WINDOW', 5))
+
+# Режим работы обработчиков с базой: 'sync' — psycopg2 в пуле потоков,
+# 'async' — asyncpg в цикле событий
+DB_MODE = os.environ.get('DB_MODE', 'sync')
+
+# Пул подключений — свой у каждого процесса-воркера, так что всего
+# сервис открывает до workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) подключений
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', -1))
+
+pool_options = {
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+    'pool_recycle': DB_POOL_RECYCLE,
+}
+
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
+    SQLALCHEMY_DATABASE_URL, **pool_options
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = None
+AsyncSessionLocal = None
+if DB_MODE == 'async':
+    async_engine = create_async_engine(
+        SQLALCHEMY_ASYNC_DATABASE_URL, **pool_options
+    )
+    AsyncSessionLocal = sessionmaker(
+        autocommit=False, autoflush=False, bind=async_engine,
+        class_=AsyncSession)
+
+replica_engine = None
+ReplicaSessionLocal = None
+async_replica_engine = None
+AsyncReplicaSessionLocal = None
+if DB_REPLICA_URL:
+    replica_engine = create_engine(DB_REPLICA_URL, **pool_options)
+    ReplicaSessionLocal = sessionmaker(
+        autocommit=False, autoflush=False, bind=replica_engine)
+    if DB_MODE == 'async':
+        async_replica_engine = create_async_engine(
+            DB_REPLICA_URL.replace('postgresql://', 'postgresql+asyncpg://', 1),
+            **pool_options)
+        AsyncReplicaSessionLocal = sessionmaker(
+            autocommit=False, autoflush=False, bind=async_replica_engine,
+            class_=AsyncSession)
+
+
+def _after_fork():
+    # Подключения, открытые до fork, принадлежат родителю: дочерний
+    # процесс забывает о них, не закрывая, и открывает свои
+    for sync_engine in (engine, replica_engine):
+        if sync_engine is not None:
+            sync_engine.dispose(close=False)
+    for async_ in (async_engine, async_replica_engine):
+        if async_ is not None:
+            async_.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
 Base = declarative_base()
@@ -0,0 +1,196 @@
+"""
+Повторы запросов с заголовком Idempotency-Key.
+
+Клиент, не дождавшийся ответа на POST /orders/assign или /orders/complete,
+повторяет запрос с тем же ключом. Ответ на первый запрос сохраняется в
+таблице idempotency_keys, и повтор получает его одним поиском по ключу,
+не выполняя обработчик еще раз.
+
+Ключ действует для одного маршрута и одного тела запроса: повтор с другим
+телом получает 422. Пока первый запрос выполняется, ключ занят и повтор
+получает 409. Ответы 5xx не сохраняются: обработчик упал, и повтор
+выполнит его заново. Ключ живет IDEMPOTENCY_KEY_TTL секунд, потом его
+удаляет python manage.py purge-idempotency-keys.
+
+Ответ сохраняется в той же транзакции, что и изменения обработчика: если
+воркер упадет между ними, не останется ни того, ни другого, и повтор
+выполнит запрос заново. Пока транзакция открыта, строка ключа заблокирована,
+так что даже обработчик дольше IDEMPOTENCY_LOCK_TIMEOUT не выполнится
+дважды: повтор дождется ответа первого запроса.
+"""
+import datetime
+import hashlib
+import os
+from typing import Callable, Optional, Type
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+
+import crud
+import models
+
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+# Через сколько секунд ключ запроса, который так и не ответил (например,
+# воркер перезапустили), можно занять заново
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+
+MAX_KEY_LENGTH = 255
+
+keys = models.IdempotencyKey.__table__
+
+
+def _fingerprint(payload: BaseModel) -> str:
+    return hashlib.sha256(payload.json(sort_keys=True).encode()).hexdigest()
+
+
+def _older_than(seconds: int):
+    return keys.c.created_at < func.now() - datetime.timedelta(seconds=seconds)
+
+
+def _expired():
+    # Ключ с истекшим сроком или брошенный без ответа
+    return or_(
+        _older_than(IDEMPOTENCY_KEY_TTL),
+        and_(keys.c.status_code == None, _older_than(IDEMPOTENCY_LOCK_TIMEOUT)),
+    )
+
+
+def _find(db: Session, key: str, route: str):
+    return db.execute(select([
+        keys.c.fingerprint, keys.c.status_code, keys.c.media_type, keys.c.body,
+    ]).where(and_(
+        keys.c.key == key,
+        keys.c.route == route,
+        ~_expired(),
+    ))).first()
+
+
+def _reserve(db: Session, key: str, route: str, fingerprint: str):
+    # Занимаем ключ до выполнения обработчика. Истекший ключ занимаем заново.
+    # Возвращает время, когда ключ занят, или None, если он занят другим
+    stmt = postgresql.insert(keys).values(
+        key=key, route=route, fingerprint=fingerprint)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[keys.c.key, keys.c.route],
+        set_={
+            'fingerprint': stmt.excluded.fingerprint,
+            'status_code': None,
+            'media_type': None,
+            'body': None,
+            'created_at': func.now(),
+        },
+        where=_expired(),
+    ).returning(keys.c.created_at)
+    reserved = db.execute(stmt).scalar()
+    db.commit()
+    return reserved
+
+
+def _ours(key: str, route: str, reserved_at):
+    # Ключ все еще занят этим запросом, а не перехвачен как брошенный
+    return and_(keys.c.key == key, keys.c.route == route,
+                keys.c.status_code == None, keys.c.created_at == reserved_at)
+
+
+def _lock(db: Session, key: str, route: str, reserved_at) -> bool:
+    # Блокирует строку ключа до конца транзакции обработчика: повтор не
+    # перехватит ключ, пока она не зафиксирована или не откачена
+    return db.execute(select([keys.c.key]).where(
+        _ours(key, route, reserved_at)).with_for_update()).first() is not None
+
+
+def _release(db: Session, key: str, route: str):
+    db.execute(keys.delete().where(and_(
+        keys.c.key == key, keys.c.route == route, keys.c.status_code == None)))
+    db.commit()
+
+
+def _save(db: Session, key: str, route: str, reserved_at,
+          response: Response) -> bool:
+    # Записывает ответ, не фиксируя транзакцию. False, если ключ перехватили
+    result = db.execute(keys.update().where(
+        _ours(key, route, reserved_at)
+    ).values(
+        status_code=response.status_code,
+        media_type=response.media_type,
+        body=response.body,
+    ))
+    return result.rowcount == 1
+
+
+def _replay(stored, fingerprint: str) -> Response:
+    if stored.fingerprint != fingerprint:
+        return PlainTextResponse(status_code=422)
+    if stored.status_code is None:
+        return PlainTextResponse(status_code=409)
+    return Response(content=stored.body, status_code=stored.status_code,
+                    media_type=stored.media_type)
+
+
+def _to_response(result, response_model: Type[BaseModel],
+                 exclude_unset: bool) -> Response:
+    # Тот же ответ, который FastAPI собрал бы по response_model маршрута
+    if isinstance(result, Response):
+        return result
+    if not isinstance(result, BaseModel):
+        result = response_model.parse_obj(result)
+    return JSONResponse(jsonable_encoder(result, exclude_unset=exclude_unset))
+
+
+def handle(db: Session, key: Optional[str], route: str, payload: BaseModel,
+           handler: Callable, response_model: Type[BaseModel],
+           exclude_unset: bool = False):
+    """
+    Выполняет handler(db, payload) или, если ключ уже встречался,
+    возвращает сохраненный ответ. Без ключа просто выполняет handler.
+    """
+    if key is None:
+        return handler(db, payload)
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return PlainTextResponse(status_code=400)
+
+    fingerprint = _fingerprint(payload)
+    stored = _find(db, key, route)
+    if stored is not None:
+        return _replay(stored, fingerprint)
+    reserved_at = _reserve(db, key, route, fingerprint)
+    if reserved_at is None:
+        # Ключ только что занял параллельный запрос
+        stored = _find(db, key, route)
+        if stored is None:
+            return PlainTextResponse(status_code=409)
+        return _replay(stored, fingerprint)
+
+    # Обработчик только сбрасывает изменения, фиксируем их вместе с ответом
+    with crud.deferred_commit(db):
+        try:
+            if not _lock(db, key, route, reserved_at):
+                db.rollback()
+                return PlainTextResponse(status_code=409)
+            response = _to_response(handler(db, payload), response_model, exclude_unset)
+            if response.status_code >= 500:
+                db.commit()
+                _release(db, key, route)
+            elif _save(db, key, route, reserved_at, response):
+                db.commit()
+            else:
+                # Ключ перехватил повтор: изменения этого запроса не сохраняем
+                db.rollback()
+                return PlainTextResponse(status_code=409)
+        except Exception:
+            db.rollback()
+            _release(db, key, route)
+            raise
+    return response
+
+
+def purge(db: Session, ttl: int = None) -> int:
+    # Удаляет ключи старше ttl секунд
+    result = db.execute(keys.delete().where(
+        _older_than(IDEMPOTENCY_KEY_TTL if ttl is None else ttl)))
+    db.commit()
+    return result.rowcount
@@ -0,0 +1,109 @@
+"""
+Замеры запросов к сервису: время ответа, число SQL-запросов и время в базе.
+
+Middleware заводит на каждый HTTP-запрос объект RequestStats и кладет его
+в contextvar. Хуки before/after_cursor_execute на движке SQLAlchemy
+дописывают в него каждый выполненный запрос: contextvar виден и в пуле
+потоков (run_in_threadpool копирует контекст), и в AsyncSession.run_sync.
+По завершении запроса значения попадают в гистограммы по маршрутам,
+которые отдает GET /metrics.
+"""
+import contextvars
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+import database
+import metrics
+
+
+class RequestStats:
+    __slots__ = ('statements', 'db_time')
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+
+
+request_stats: contextvars.ContextVar[Optional[RequestStats]] = \
+    contextvars.ContextVar('request_stats', default=None)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENTS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+request_duration = metrics.Histogram(
+    'http_request_duration_seconds', 'Request latency',
+    ('method', 'route', 'status'), LATENCY_BUCKETS)
+request_statements = metrics.Histogram(
+    'http_request_db_statements', 'SQL statements per request',
+    ('method', 'route'), STATEMENTS_BUCKETS)
+request_db_time = metrics.Histogram(
+    'http_request_db_seconds', 'Time spent in SQL statements per request',
+    ('method', 'route'), LATENCY_BUCKETS)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def _handle_error(context):
+    # Упавший запрос не доходит до after_cursor_execute
+    if context.connection is not None:
+        started = context.connection.info.get('query_started')
+        if started:
+            started.pop()
+
+
+def instrument_engine(engine):
+    # Для AsyncEngine хуки вешаются на его синхронный движок
+    engine = getattr(engine, 'sync_engine', engine)
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+
+def route_name(request) -> str:
+    # Шаблон маршрута, а не сам путь: /couriers/{courier_id}, а не /couriers/1
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+async def middleware(request, call_next):
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        request_stats.reset(token)
+        method, route = request.method, route_name(request)
+        request_duration.observe(
+            time.perf_counter() - started,
+            method=method, route=route, status=status)
+        request_statements.observe(stats.statements, method=method, route=route)
+        request_db_time.observe(stats.db_time, method=method, route=route)
+
+
+instrument_engine(database.engine)
+for _engine in (database.async_engine, database.replica_engine,
+                database.async_replica_engine):
+    if _engine is not None:
+        instrument_engine(_engine)
@@ -1,71 +1,240 @@
+"""
+Нагрузочный сценарий для сервиса.
+
+Каждый обработчик — отдельная задача со своим весом, примерно как
+распределены запросы в работе: курьеров читают и назначают им заказы
+чаще, чем нанимают. Пользователь помнит своих курьеров и выданные им
+заказы, поэтому /orders/complete завершает действительно назначенные
+заказы, а не случайные пары.
+
+Идентификаторы раздаются блоками: у каждого процесса locust свой
+непересекающийся диапазон. При распределенном запуске каждому воркеру
+нужно указать свой номер:
+
+    locust -f locust.py --master --host=http://0.0.0.0:8080
+    LOCUST_WORKER_INDEX=0 locust -f locust.py --worker
+    LOCUST_WORKER_INDEX=1 locust -f locust.py --worker
+
+После завершения проверяются SLO по времени ответа и доле ошибок
+для каждого обработчика; при нарушении locust завершается с кодом 1.
+"""
 import datetime
+import itertools
 import json
-from random import randint
+import logging
+from random import choice, randint, random
 
-from locust import HttpUser, TaskSet, task
+from locust import HttpUser, between, events, task
+from locust.runners import WorkerRunner
 from tests.utils import generate_courier, generate_order
 
-j, i = 0, 0
-
-
-def post_couriers(l):
-    global i
-    i += 1
-    l.client.post(
-        '/couriers',
-        json.dumps({
-            'data': [generate_courier(courier_id=i)]
-        }))
-
-
-def post_orders(l):
-    global j
-    j += 1
-    l.client.post(
-        '/orders',
-        json.dumps({
-            'data': [generate_order(order_id=j)]
+# p95 времени ответа в миллисекундах
+SLO = {
+    'POST /couriers': 200,
+    'POST /orders': 200,
+    'PATCH /couriers/{courier_id}': 300,
+    'GET /couriers/{courier_id}': 100,
+    'POST /orders/assign': 300,
+    'POST /orders/complete': 100,
+    'POST /couriers [import]': 5000,
+    'POST /orders [import]': 5000,
+}
+
+logger = logging.getLogger(__name__)
+
+
+class IdBlock:
+    """
+    Диапазон идентификаторов одного процесса locust:
+    [offset + index * size + 1, offset + (index + 1) * size].
+    """
+
+    def __init__(self, offset: int, index: int, size: int):
+        start = offset + index * size + 1
+        self.end = start + size
+        self._couriers = itertools.count(start)
+        self._orders = itertools.count(start)
+
+    def _take(self, counter, n: int):
+        ids = [next(counter) for _ in range(n)]
+        if ids[-1] >= self.end:
+            raise RuntimeError('ID block exhausted, increase --id-block')
+        return ids
+
+    def couriers(self, n: int = 1):
+        return self._take(self._couriers, n)
+
+    def orders(self, n: int = 1):
+        return self._take(self._orders, n)
+
+
+ids: IdBlock = None
+
+
+@events.init_command_line_parser.add_listener
+def add_arguments(parser):
+    parser.add_argument('--worker-index', type=int, env_var='LOCUST_WORKER_INDEX',
+                        default=None, help='Номер процесса для блока ID')
+    parser.add_argument('--id-block', type=int, env_var='LOCUST_ID_BLOCK',
+                        default=10_000_000, help='Размер блока ID на процесс')
+    parser.add_argument('--id-offset', type=int, env_var='LOCUST_ID_OFFSET',
+                        default=0, help='ID меньше этого уже заняты')
+    parser.add_argument('--regions', type=int, env_var='LOCUST_REGIONS',
+                        default=20, help='Число районов')
+    parser.add_argument('--couriers-batch', type=int, env_var='LOCUST_COURIERS_BATCH',
+                        default=1, help='Курьеров в обычном POST /couriers')
+    parser.add_argument('--orders-batch', type=int, env_var='LOCUST_ORDERS_BATCH',
+                        default=10, help='Заказов в обычном POST /orders')
+    parser.add_argument('--import-batch', type=int, env_var='LOCUST_IMPORT_BATCH',
+                        default=1000, help='Сущностей в одном импорте')
+    parser.add_argument('--max-fail-ratio', type=float,
+                        env_var='LOCUST_MAX_FAIL_RATIO', default=0.01,
+                        help='Допустимая доля ошибок для каждого обработчика')
+
+
+@events.init.add_listener
+def allocate_ids(environment, **kwargs):
+    global ids
+    options = environment.parsed_options
+    index = options.worker_index
+    if index is None:
+        index = 0
+        if isinstance(environment.runner, WorkerRunner):
+            # Без номера воркеры выдают одинаковые ID, берем случайный блок
+            index = randint(1, (2 ** 31 - options.id_offset) // options.id_block - 1)
+            logger.warning('LOCUST_WORKER_INDEX is not set, using random ID block %d',
+                           index)
+    ids = IdBlock(options.id_offset, index, options.id_block)
+
+
+def now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(
+        timespec='milliseconds').replace('+00:00', 'Z')
+
+
+class ServiceUser(HttpUser):
+    weight = 10
+    wait_time = between(0.5, 2)
+
+    def on_start(self):
+        self.options = self.environment.parsed_options
+        self.couriers = []
+        # Назначенные и еще не завершенные заказы: (курьер, заказ)
+        self.assigned = []
+        self.post_couriers()
+        self.post_orders()
+
+    def region(self) -> int:
+        return randint(1, self.options.regions)
+
+    @task(1)
+    def post_couriers(self):
+        batch = ids.couriers(self.options.couriers_batch)
+        response = self.client.post('/couriers', data=json.dumps({'data': [
+            generate_courier(courier_id=i,
+                             regions=[self.region() for _ in range(4)])
+            for i in batch]}), name='/couriers')
+        if response.status_code == 201:
+            self.couriers += batch
+
+    @task(3)
+    def post_orders(self):
+        self.client.post('/orders', data=json.dumps({'data': [
+            generate_order(order_id=i, region=self.region())
+            for i in ids.orders(self.options.orders_batch)]}), name='/orders')
+
+    @task(5)
+    def get_courier(self):
+        if not self.couriers:
+            return self.post_couriers()
+        self.client.get(f'/couriers/{choice(self.couriers)}',
+                        name='/couriers/{courier_id}')
+
+    @task(1)
+    def patch_courier(self):
+        if not self.couriers:
+            return self.post_couriers()
+        courier_id = choice(self.couriers)
+        if random() < 0.5:
+            patch = {'regions': [self.region() for _ in range(4)]}
+        else:
+            patch = {'working_hours': generate_courier()['working_hours']}
+        self.client.patch(f'/couriers/{courier_id}', data=json.dumps(patch),
+                          name='/couriers/{courier_id}')
+        # Неподходящие заказы сняты с курьера, какие — ответ не говорит
+        self.assigned = [i for i in self.assigned if i[0] != courier_id]
+
+    @task(4)
+    def orders_assign(self):
+        if not self.couriers:
+            return self.post_couriers()
+        courier_id = choice(self.couriers)
+        response = self.client.post(
+            '/orders/assign', data=json.dumps({'courier_id': courier_id}))
+        if response.status_code == 200:
+            self.assigned += [(courier_id, i['id'])
+                              for i in response.json()['orders']]
+
+    @task(4)
+    def orders_complete(self):
+        if not self.assigned:
+            return self.orders_assign()
+        courier_id, order_id = self.assigned.pop(randint(0, len(self.assigned) - 1))
+        self.client.post('/orders/complete', data=json.dumps({
+            'courier_id': courier_id,
+            'order_id': order_id,
+            'complete_time': now(),
         }))
 
 
-def patch_courier(l):
-    global i
-    l.client.patch(
-        f'/couriers/{randint(1, i)}', data=json.dumps({'regions': [randint(1, 20) for i in range(4)]}))
-
+class ImportUser(HttpUser):
+    """Редкие большие загрузки, как выгрузка из внешней системы."""
 
-def post_orders_assign(l):
-    global i
-    l.client.post('/orders/assign', data=json.dumps({'courier_id': i}))
-
-
-def post_orders_complete(l):
-    global i
-    global j
-    l.client.post('/orders/complete', data=json.dumps({
-        'courier_id': randint(1, i),
-        'order_id': randint(1, j),
-        'complete_time': datetime.datetime.now().isoformat('T')+'Z',
-    }))
-
-
-def get_couriers(l):
-    global i
-    l.client.get(f'/couriers/{randint(1, i)}')
+    weight = 1
+    wait_time = between(10, 30)
 
+    @task
+    def import_couriers(self):
+        options = self.environment.parsed_options
+        self.client.post('/couriers', data=json.dumps({'data': [
+            generate_courier(courier_id=i, regions=[
+                randint(1, options.regions) for _ in range(4)])
+            for i in ids.couriers(options.import_batch)]}),
+            name='/couriers [import]')
 
-class UserBehavior(TaskSet):
     @task
-    def workflow(self):
-        post_couriers(self)
-        post_orders(self)
-        patch_courier(self)
-        post_orders_assign(self)
-        post_orders_complete(self)
-        get_couriers(self)
-
-
-class WebsiteUser(HttpUser):
-    tasks = [UserBehavior]
-    min_wait = 5000
-    max_wait = 9000
+    def import_orders(self):
+        options = self.environment.parsed_options
+        self.client.post('/orders', data=json.dumps({'data': [
+            generate_order(order_id=i, region=randint(1, options.regions))
+            for i in ids.orders(options.import_batch)]}),
+            name='/orders [import]')
+
+
+@events.quitting.add_listener
+def check_slo(environment, **kwargs):
+    # Статистика всех воркеров собирается на мастере
+    if isinstance(environment.runner, WorkerRunner):
+        return
+
+    max_fail_ratio = environment.parsed_options.max_fail_ratio
+    violations = []
+    print('{:<34} {:>9} {:>9} {:>9} {:>8}'.format(
+        'endpoint', 'requests', 'p95, ms', 'SLO, ms', 'fails'))
+    for name, slo in SLO.items():
+        method, path = name.split(' ', 1)
+        entry = environment.stats.entries.get((path, method))
+        if entry is None or not entry.num_requests:
+            print(f'{name:<34} {0:>9}')
+            continue
+        p95 = entry.get_response_time_percentile(0.95)
+        failed = p95 > slo or entry.fail_ratio > max_fail_ratio
+        if failed:
+            violations.append(name)
+        print('{:<34} {:>9} {:>9.0f} {:>9} {:>7.1%}{}'.format(
+            name, entry.num_requests, p95, slo, entry.fail_ratio,
+            '  SLO VIOLATED' if failed else ''))
+
+    if violations:
+        print(f'SLO violated: {", ".join(violations)}')
+        environment.process_exit_code = 1
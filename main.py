@@ -1,27 +1,71 @@
 import re
-from typing import Dict, Tuple
+from array import array
+from typing import Dict, List, Optional, Tuple
 
-from fastapi import Depends, FastAPI, Path, status
+from fastapi import Depends, FastAPI, Header, Path, Request, status
 from fastapi.exceptions import RequestValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from starlette.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse, Response
 
+import bulk_import
+import cache
 import crud
+import idempotency
+import instrumentation
+import metrics
 import models
+import order_index
+import routing
 import schemas
-from database import SessionLocal, engine
+from database import DB_MODE, SessionLocal, engine
 
 models.Base.metadata.create_all(bind=engine)
 
 app = FastAPI()
+app.middleware('http')(instrumentation.middleware)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@app.on_event('startup')
+def start_cache_listener():
+    # Изменения курьеров в других воркерах приходят через LISTEN/NOTIFY
+    cache.start_listener(engine)
+
+
+@app.on_event('shutdown')
+def stop_cache_listener():
+    cache.stop_listener()
+
+
+# Сессия основной базы или, для обработчиков только для чтения, реплики
+if DB_MODE == 'async':
+    async def get_db(request: Request):
+        async with routing.router.session_factory(request)() as db:
+            yield db
+else:
+    def get_db(request: Request):
+        db = routing.router.session_factory(request)()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+async def run(db, fn, *args):
+    # Обработчики работают с синхронной сессией: в режиме sync — в пуле
+    # потоков, в режиме async — поверх asyncpg через AsyncSession.run_sync
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args)
+    return await run_in_threadpool(fn, db, *args)
+
+
+def validation_error(who: str, ids: List[int]) -> PlainTextResponse:
+    invalid_data = {who: [{'id': i} for i in ids]}
+    return PlainTextResponse(
+        content=str({'validation_error': invalid_data}),
+        status_code=status.HTTP_400_BAD_REQUEST
+    )
 
 
 class ValidationErrorHandler:
@@ -31,13 +75,7 @@ class ValidationErrorHandler:
 
     @classmethod
     def invalid_post(cls, exc, who: str, who_id: str, db: SessionLocal = SessionLocal()):
-        invalid_data = {who: []}
-        for i in exc.body['data']:
-            invalid_data[who].append({'id': i[who_id]})
-        return PlainTextResponse(
-            content=str({'validation_error': invalid_data}),
-            status_code=status.HTTP_400_BAD_REQUEST
-        )
+        return validation_error(who, [i[who_id] for i in exc.body['data']])
 
 
 handlers = {
@@ -45,6 +83,7 @@ handlers = {
     'couriers_patch': ValidationErrorHandler.http400,
     'orders': ValidationErrorHandler.invalid_post,
     'orders/assign': ValidationErrorHandler.http400,
+    'orders/assign/batch': ValidationErrorHandler.http400,
     'orders/complete': ValidationErrorHandler.http400
 }
 
@@ -59,7 +98,7 @@ def parse_url(request: str) -> Tuple[str, Dict[str, str]]:
         answer['who'] = 'orders'
         answer['who_id'] = 'order_id'
         return path, answer
-    if path in ('couriers', 'orders/assign', 'orders/complete'):
+    if path in ('couriers', 'orders/assign', 'orders/assign/batch', 'orders/complete'):
         return path, answer
     raise Exception(f'URL NOT VALID {path}')
 
@@ -70,23 +109,23 @@ def validation_exception_handler(request, exc):
     return handlers[path](exc, **kwargs)
 
 
-def any_courier_in_db(db: Session, couriers: schemas.CouriersPostRequest):
-    for item in couriers.data:
-        courier = crud.get_courier_by_id(db=db, id=item.courier_id)
-        if courier:
-            return True
-    return False
+def _duplicates(ids: List[int]) -> List[int]:
+    seen = set()
+    return [i for i in ids if i in seen or seen.add(i)]
+
+
+def conflicting_courier_ids(db: Session, couriers: schemas.CouriersPostRequest) -> List[int]:
+    # Курьеры, которые уже есть в бд или повторяются в самом запросе
+    ids = [i.courier_id for i in couriers.data]
+    return sorted(set(crud.get_existing_courier_ids(db=db, ids=ids)) |
+                  set(_duplicates(ids)))
 
 
-def any_order_in_db(db: Session, orders: schemas.OrdersPostRequest):
-    for item in orders.data:
-        order1 = crud.get_order_by_id(db=db, id=item.order_id)
-        order2 = db.query(models.CouriersOrders).filter(
-            models.CouriersOrders.order_id == item.order_id
-        ).first()
-        if order1 or order2:
-            return True
-    return False
+def conflicting_order_ids(db: Session, orders: schemas.OrdersPostRequest) -> List[int]:
+    # Заказы, которые уже есть в бд или повторяются в самом запросе
+    ids = [i.order_id for i in orders.data]
+    return sorted(set(crud.get_existing_order_ids(db=db, ids=ids)) |
+                  set(_duplicates(ids)))
 
 
 @app.post(
@@ -94,17 +133,18 @@ def any_order_in_db(db: Session, orders: schemas.OrdersPostRequest):
     response_model=schemas.CouriersIds,
     status_code=status.HTTP_201_CREATED,
     response_description='Import couriers')
-def add_couriers(
+async def add_couriers(
         couriers: schemas.CouriersPostRequest,
         db: Session = Depends(get_db)):
+    return await run(db, _add_couriers, couriers)
 
-    # Если какой-нибудь из курьеров уже есть в бд,
+
+def _add_couriers(db: Session, couriers: schemas.CouriersPostRequest):
+    # Если какие-то из курьеров уже есть в бд,
     # то возвращаем их id
-    if any_courier_in_db(db=db, couriers=couriers):
-        invalid_data = {'couriers': []}
-        for i in couriers.data:
-            invalid_data['couriers'].append({'id': i.courier_id})
-        return PlainTextResponse(content=str({'validation_error': invalid_data}), status_code=status.HTTP_400_BAD_REQUEST)
+    conflicts = conflicting_courier_ids(db=db, couriers=couriers)
+    if conflicts:
+        return validation_error('couriers', conflicts)
 
     answer = crud.add_couriers(
         db=db,
@@ -114,13 +154,85 @@ def add_couriers(
     return answer
 
 
+def _write_chunk(db: Session, chunk: List, id_field: str, existing_ids, write,
+                 skipped: set) -> List[int]:
+    # Пачку записываем, только если ни один id в ней не занят и write
+    # передан. Записанные раньше пачки уже видны в транзакции, так что
+    # повторы с ними находит тот же запрос к бд. id незаписанных пачек
+    # в бд нет, поэтому они копятся в skipped
+    ids = [getattr(i, id_field) for i in chunk]
+    conflicts = sorted(set(existing_ids(db=db, ids=ids)) | set(_duplicates(ids))
+                       | skipped.intersection(ids))
+    if conflicts or write is None:
+        skipped.update(ids)
+    else:
+        write(db, chunk)
+    return conflicts
+
+
+def _rollback(db: Session):
+    db.rollback()
+
+
+async def stream_import(request: Request, db, who: str, id_field: str, model,
+                        existing_ids, write, finish):
+    job = bulk_import.StreamingImport(model, id_field)
+    ids, conflicts, skipped = array('q'), [], set()
+    try:
+        async for chunk in job.chunks(request.stream()):
+            # После первой ошибки оставшиеся пачки только проверяем
+            failed = bool(job.invalid or conflicts)
+            found = await run(db, _write_chunk, chunk, id_field, existing_ids,
+                              None if failed else write, skipped)
+            conflicts.extend(found)
+            if not (failed or found):
+                ids.extend(getattr(i, id_field) for i in chunk)
+    except bulk_import.MalformedJSON:
+        await run(db, _rollback)
+        return PlainTextResponse(status_code=status.HTTP_400_BAD_REQUEST)
+
+    if job.invalid or conflicts:
+        await run(db, _rollback)
+        # id может повториться в нескольких пачках, в ответе он один раз
+        return validation_error(who, list(dict.fromkeys(job.invalid + conflicts)))
+
+    await run(db, finish, ids)
+    # Ответ собираем сразу строкой: проверка через response_model создала
+    # бы по объекту pydantic на каждый id
+    return Response(
+        content='{"%s": [%s]}' % (who, ', '.join('{"id": %d}' % i for i in ids)),
+        status_code=status.HTTP_201_CREATED,
+        media_type='application/json')
+
+
+@app.post(
+    '/couriers/import',
+    response_model=schemas.CouriersIds,
+    status_code=status.HTTP_201_CREATED,
+    response_description='Import couriers from a streamed request body')
+async def import_couriers(request: Request, db=Depends(get_db)):
+    return await stream_import(
+        request, db, 'couriers', 'courier_id', schemas.CourierBase,
+        crud.get_existing_courier_ids, crud.write_couriers, _finish_couriers_import)
+
+
+def _finish_couriers_import(db: Session, ids: List[int]):
+    db.commit()
+
+
 @app.patch('/couriers/{courier_id}', response_model=schemas.CourierPatch)
-def patch_courier(data: schemas.CourierPatchInput,
-                  courier_id: int = Path(..., gt=0), db=Depends(get_db)):
+async def patch_courier(data: schemas.CourierPatchInput,
+                        courier_id: int = Path(..., gt=0), db=Depends(get_db)):
+    return await run(db, _patch_courier, courier_id, data)
+
+
+def _patch_courier(db: Session, courier_id: int, data: schemas.CourierPatchInput):
     c = crud.get_courier_by_id(db=db, id=courier_id)
     if not c:
         return PlainTextResponse(status_code=status.HTTP_400_BAD_REQUEST)
-    return crud.patch_courier(db=db, courier_id=courier_id, input=data)
+    # Собираем ответ, пока сессия открыта: связи курьера подгружаются лениво
+    return schemas.CourierPatch.from_orm(
+        crud.patch_courier(db=db, courier_id=courier_id, input=data))
 
 
 @app.post(
@@ -128,13 +240,15 @@ def patch_courier(data: schemas.CourierPatchInput,
     response_model=schemas.OrdersIds,
     status_code=status.HTTP_201_CREATED,
     response_description='Import orders')
-def post_orders(orders: schemas.OrdersPostRequest,
-                db: Session = Depends(get_db)):
-    if any_order_in_db(db=db, orders=orders):
-        invalid_data = {'orders': []}
-        for i in orders.data:
-            invalid_data['orders'].append({'id': i.order_id})
-        return PlainTextResponse(content=str({'validation_error': invalid_data}), status_code=status.HTTP_400_BAD_REQUEST)
+async def post_orders(orders: schemas.OrdersPostRequest,
+                      db: Session = Depends(get_db)):
+    return await run(db, _post_orders, orders)
+
+
+def _post_orders(db: Session, orders: schemas.OrdersPostRequest):
+    conflicts = conflicting_order_ids(db=db, orders=orders)
+    if conflicts:
+        return validation_error('orders', conflicts)
 
     answer = crud.add_orders(
         db=db,
@@ -144,17 +258,84 @@ def post_orders(orders: schemas.OrdersPostRequest,
     return answer
 
 
+@app.post(
+    '/orders/import',
+    response_model=schemas.OrdersIds,
+    status_code=status.HTTP_201_CREATED,
+    response_description='Import orders from a streamed request body')
+async def import_orders(request: Request, db=Depends(get_db)):
+    return await stream_import(
+        request, db, 'orders', 'order_id', schemas.OrderBase,
+        crud.get_existing_order_ids, crud.write_orders, _finish_orders_import)
+
+
+def _finish_orders_import(db: Session, ids: List[int]):
+    db.commit()
+    # Новые заказы подгружаем в индекс одним запросом по id
+    order_index.index.refresh(db, ids)
+
+
 @app.get('/couriers/{courier_id}', response_model=schemas.CourierRating, response_model_exclude_unset=True)
-def get_courier(courier_id: int, db: Session = Depends(get_db)):
+@routing.read_only
+async def get_courier(courier_id: int, response: Response,
+                      if_none_match: Optional[str] = Header(None),
+                      db: Session = Depends(get_db)):
+    return await run(db, _get_courier, courier_id, response, if_none_match)
+
+
+def _etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match сравнивает теги слабо: W/"1" совпадает с "1"
+    if if_none_match.strip() == '*':
+        return True
+    return any(i.strip().replace('W/', '', 1) == etag
+               for i in if_none_match.split(','))
+
+
+def _get_courier(db: Session, courier_id: int, response: Response,
+                 if_none_match: Optional[str]):
+    # В кэш смотрим один раз: и за версией для If-None-Match, и за ответом
+    cached = cache.couriers.get(courier_id) if cache.couriers.enabled else None
+    if if_none_match:
+        # Клиенту достаточно узнать, что курьер не менялся: берем версию
+        # из кэша или одним запросом, без подсчета статистики
+        version = cached[0] if cached else crud.get_courier_version(db=db, id=courier_id)
+        if version is not None and _etag_matches(if_none_match, _etag(version)):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                            headers={'ETag': _etag(version)})
+
+    if cached is None:
+        cached = cache.couriers.load(
+            courier_id, lambda: _load_courier_rating(db, courier_id))
+    if not cached:
+        return PlainTextResponse(status_code=status.HTTP_400_BAD_REQUEST)
+    version, rating = cached
+    response.headers['ETag'] = _etag(version)
+    return rating
+
+
+def _load_courier_rating(db: Session, courier_id: int):
+    # Версию читаем раньше статистики: если курьера изменят между
+    # запросами, ETag окажется старше ответа, а не наоборот
     courier = crud.get_courier_by_id(db=db, id=courier_id)
     if courier:
-        return crud.get_courier(db=db, courier_id=courier_id)
-    return PlainTextResponse(status_code=status.HTTP_400_BAD_REQUEST)
+        return courier.version, schemas.CourierRating(
+            **crud.get_courier(db=db, courier_id=courier_id))
 
 
 @app.post('/orders/assign', response_model=schemas.OrdersAssign, response_model_exclude_unset=True)
-def orders_assign(assign: schemas.OrderAssign,
-                  db: Session = Depends(get_db)):
+async def orders_assign(assign: schemas.OrderAssign,
+                        idempotency_key: Optional[str] = Header(None),
+                        db: Session = Depends(get_db)):
+    # Повтор с тем же Idempotency-Key получает сохраненный ответ
+    return await run(db, idempotency.handle, idempotency_key, 'POST /orders/assign',
+                     assign, _orders_assign, schemas.OrdersAssign, True)
+
+
+def _orders_assign(db: Session, assign: schemas.OrderAssign):
     # Если передан идентификатор несуществующего курьера
     courier = crud.get_courier_by_id(db=db, id=assign.courier_id)
     if not courier:
@@ -162,8 +343,33 @@ def orders_assign(assign: schemas.OrderAssign,
     return crud.get_max_assigns_for_courier(db=db, courier_id=assign.courier_id)
 
 
+@app.post('/orders/assign/batch', response_model=schemas.OrdersAssignBatch, response_model_exclude_unset=True)
+async def orders_assign_batch(assign: schemas.OrdersAssignBatchInput,
+                              db: Session = Depends(get_db)):
+    return await run(db, _orders_assign_batch, assign)
+
+
+def _orders_assign_batch(db: Session, assign: schemas.OrdersAssignBatchInput):
+    # Повторы в запросе не считаем ошибкой: каждый курьер встретится
+    # в ответе один раз
+    courier_ids = list(dict.fromkeys(assign.courier_ids))
+
+    # Если среди них есть несуществующие курьеры
+    existing = crud.get_existing_courier_ids(db=db, ids=courier_ids)
+    if len(existing) != len(courier_ids):
+        return PlainTextResponse(status_code=status.HTTP_400_BAD_REQUEST)
+    return crud.get_max_assigns_for_couriers(db=db, courier_ids=courier_ids)
+
+
 @app.post('/orders/complete', response_model=schemas.OrderCompleteAnswer)
-def orders_complete(complete: schemas.OrdersComplete, db: Session = Depends(get_db)):
+async def orders_complete(complete: schemas.OrdersComplete,
+                          idempotency_key: Optional[str] = Header(None),
+                          db: Session = Depends(get_db)):
+    return await run(db, idempotency.handle, idempotency_key, 'POST /orders/complete',
+                     complete, _orders_complete, schemas.OrderCompleteAnswer)
+
+
+def _orders_complete(db: Session, complete: schemas.OrdersComplete):
     # Проверка есть ли у курьера незавершенный заказ с таким номером
     order = db.query(models.CouriersOrders).filter(
         models.CouriersOrders.order_id == complete.order_id,
@@ -174,4 +380,23 @@ def orders_complete(complete: schemas.OrdersComplete, db: Session = Depends(get_
     if not order:
         return PlainTextResponse(status_code=status.HTTP_400_BAD_REQUEST)
 
-    return crud.orders_complete(db=db, complete=complete)
+    answer = crud.orders_complete(db=db, complete=complete)
+    # Заказ успел завершить параллельный запрос
+    if answer is None:
+        return PlainTextResponse(status_code=status.HTTP_400_BAD_REQUEST)
+    return answer
+
+
+@app.get('/internal/order-index')
+async def check_order_index(db: Session = Depends(get_db)):
+    # Сверка индекса свободных заказов этого процесса с базой. Маршрут без
+    # авторизации и читает все свободные заказы, поэтому включается отдельно
+    if order_index.ORDER_INDEX_CHECK != 'on':
+        return PlainTextResponse(status_code=status.HTTP_404_NOT_FOUND)
+    return await run(db, order_index.index.verify)
+
+
+@app.get('/metrics')
+async def get_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,78 @@
+"""
+Служебные команды.
+
+    python manage.py backfill-stats
+    python manage.py archive --older-than-hours 24
+    python manage.py purge-idempotency-keys
+"""
+import argparse
+import datetime
+
+import crud
+import idempotency
+from database import SessionLocal
+
+
+def backfill_stats(args):
+    db = SessionLocal()
+    try:
+        rows = crud.backfill_courier_stats(db)
+        print(f'courier_stats: {rows} rows')
+    finally:
+        db.close()
+
+
+def archive(args):
+    before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        hours=args.older_than_hours)
+    db = SessionLocal()
+    try:
+        rows = crud.archive_completed(db, before, args.batch_size)
+        print(f'couriers_orders_archive: {rows} rows')
+    finally:
+        db.close()
+
+
+def purge_idempotency_keys(args):
+    db = SessionLocal()
+    try:
+        rows = idempotency.purge(db, args.ttl)
+        print(f'idempotency_keys: {rows} rows deleted')
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backfill = commands.add_parser(
+        'backfill-stats',
+        help='Пересчитать courier_stats по завершенным заказам')
+    backfill.set_defaults(handler=backfill_stats)
+
+    archive_parser = commands.add_parser(
+        'archive',
+        help='Перенести завершенные заказы в couriers_orders_archive')
+    archive_parser.add_argument(
+        '--older-than-hours', type=float, default=24,
+        help='Архивировать заказы, завершенные раньше, чем столько часов назад')
+    archive_parser.add_argument(
+        '--batch-size', type=int, default=10000,
+        help='Сколько заказов переносить в одной транзакции')
+    archive_parser.set_defaults(handler=archive)
+
+    purge = commands.add_parser(
+        'purge-idempotency-keys',
+        help='Удалить ключи Idempotency-Key с истекшим сроком')
+    purge.add_argument(
+        '--ttl', type=int, default=idempotency.IDEMPOTENCY_KEY_TTL,
+        help='Удалять ключи старше стольких секунд')
+    purge.set_defaults(handler=purge_idempotency_keys)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Метрики сервиса в текстовом формате Prometheus для GET /metrics.
+
+Метрики собирают функции-коллекторы, зарегистрированные через @collector.
+Коллектор возвращает семейства метрик: (имя, тип, описание, [(метки, значение)]).
+Каждый воркер отдает свои метрики с меткой pid.
+
+Гистограммы (Histogram) регистрируются как коллекторы сами.
+"""
+import bisect
+import os
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+import database
+
+Sample = Tuple[Dict[str, str], float]
+Family = Tuple[str, str, str, List[Sample]]
+
+_collectors: List[Callable[[], Iterable[Family]]] = []
+
+
+def collector(fn: Callable[[], Iterable[Family]]):
+    _collectors.append(fn)
+    return fn
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    labels = dict(labels, pid=os.getpid())
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels.items()
+    ) + '}'
+
+
+def render() -> str:
+    lines = []
+    for fn in _collectors:
+        for name, kind, help, samples in fn():
+            # Семейства без типа продолжают предыдущее (корзины гистограммы)
+            if kind is not None:
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class Histogram:
+    """
+    Гистограмма с накопительными корзинами, как в клиентах Prometheus:
+    для каждого набора меток хранит счетчики корзин, сумму и количество.
+    """
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str],
+                 buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self._sums = defaultdict(float)
+        collector(self.collect)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[i] for i in self.labelnames)
+        # Последняя ячейка — корзина +Inf
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[key][i] += 1
+            self._sums[key] += value
+
+    def collect(self) -> Iterable[Family]:
+        with self._lock:
+            counts = {k: list(v) for k, v in self._counts.items()}
+            sums = dict(self._sums)
+
+        buckets, totals, counters = [], [], []
+        for key, values in sorted(counts.items()):
+            labels = dict(zip(self.labelnames, key))
+            total = 0
+            for le, count in zip(self.buckets + ('+Inf',), values):
+                total += count
+                buckets.append((dict(labels, le=le), total))
+            totals.append((labels, sums[key]))
+            counters.append((labels, total))
+
+        # Корзины, сумма и количество выводятся одним семейством
+        return [(self.name, 'histogram', self.help, [])] + [
+            (self.name + '_bucket', None, None, buckets),
+            (self.name + '_sum', None, None, totals),
+            (self.name + '_count', None, None, counters),
+        ]
+
+
+def _engines():
+    engines = {'sync': database.engine}
+    if database.async_engine is not None:
+        engines['async'] = database.async_engine.sync_engine
+    if database.replica_engine is not None:
+        engines['replica'] = database.replica_engine
+    if database.async_replica_engine is not None:
+        engines['replica-async'] = database.async_replica_engine.sync_engine
+    return engines
+
+
+@collector
+def pool_metrics() -> Iterable[Family]:
+    # Состояние пулов подключений этого воркера
+    pools = {name: engine.pool for name, engine in _engines().items()}
+
+    def gauge(name, help, value):
+        return (name, 'gauge', help, [
+            ({'engine': k}, value(pool)) for k, pool in pools.items()])
+
+    return [
+        gauge('db_pool_size', 'Configured number of pooled connections',
+              lambda pool: pool.size()),
+        gauge('db_pool_max_overflow', 'Configured overflow above pool size',
+              lambda pool: database.DB_MAX_OVERFLOW),
+        gauge('db_pool_checked_out', 'Connections in use',
+              lambda pool: pool.checkedout()),
+        gauge('db_pool_idle', 'Open connections waiting in the pool',
+              lambda pool: pool.checkedin()),
+        gauge('db_pool_overflow', 'Connections open above pool size',
+              lambda pool: max(pool.overflow(), 0)),
+    ]
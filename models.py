@@ -1,27 +1,79 @@
+import logging
+
 import psycopg2.extras
-from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, String
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, Float,
+                        ForeignKey, Index, Integer, LargeBinary, String, any_,
+                        bindparam, event, func)
 from sqlalchemy import types as sqltypes
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship
 
-from database import Base, engine
+from database import Base, engine, replica_engine
+
+logger = logging.getLogger(__name__)
 
 
 class TimeRange(psycopg2.extras.Range):
     pass
 
 
-conn = engine.raw_connection()
-cur = conn.cursor()
-psycopg2.extras.register_range('timerange', TimeRange, cur, globally=True)
-cur.close()
-conn.close()
+def register_timerange(dbapi_connection, connection_record=None):
+    # Тип timerange регистрируется на каждом новом подключении psycopg2:
+    # так он работает в любом воркере и в подключениях, открытых после fork
+    try:
+        psycopg2.extras.register_range(
+            'timerange', TimeRange, dbapi_connection)
+    except psycopg2.ProgrammingError:
+        # Тип еще не создан, например до первой миграции
+        logger.warning('timerange type is not registered: type not found')
+
+
+event.listen(engine, 'connect', register_timerange)
+if replica_engine is not None:
+    event.listen(replica_engine, 'connect', register_timerange)
+
+
+def ids_array(ids):
+    # Список id передаем одним параметром-массивом для = ANY(...): в IN
+    # каждый id — отдельный параметр, а у asyncpg их не больше 32767
+    return any_(bindparam('ids', list(ids), type_=postgresql.ARRAY(Integer)))
 
 
 class TIMERANGE(postgresql.ranges.RangeOperators, sqltypes.UserDefinedType):
+    cache_ok = True
+
     def get_col_spec(self, **kw):
         return 'timerange'
 
+    # psycopg2 сам приводит TimeRange, а для asyncpg переводим
+    # промежутки в asyncpg.Range и обратно
+    def bind_processor(self, dialect):
+        if dialect.driver != 'asyncpg':
+            return None
+
+        import asyncpg
+
+        def process(value):
+            if isinstance(value, TimeRange):
+                return asyncpg.Range(
+                    value.lower, value.upper,
+                    lower_inc=value.lower_inc, upper_inc=value.upper_inc)
+            return value
+        return process
+
+    def result_processor(self, dialect, coltype):
+        if dialect.driver != 'asyncpg':
+            return None
+
+        def process(value):
+            if value is None:
+                return None
+            return TimeRange(
+                value.lower, value.upper,
+                ('[' if value.lower_inc else '(') +
+                (']' if value.upper_inc else ')'))
+        return process
+
 
 postgresql.base.ischema_names['timerange'] = TIMERANGE
 
@@ -32,6 +84,9 @@ class Courier(Base):
     courier_id = Column(Integer, primary_key=True)
     courier_type = Column(String(20))
     orders_weight = Column(Float(2), default=0)
+    last_complete_time = Column(DateTime(timezone=True), nullable=True)
+    # Растет при каждом изменении курьера, отдается как ETag
+    version = Column(BigInteger, nullable=False, default=1, server_default='1')
     regions = relationship("Region", back_populates="region_owner")
     working_hours = relationship("WorkingHours", back_populates="wh_owner")
 
@@ -41,7 +96,7 @@ class Region(Base):
 
     id = Column(Integer, primary_key=True)
     region_id = Column(Integer)
-    courier_id = Column(Integer, ForeignKey('couriers.courier_id'))
+    courier_id = Column(Integer, ForeignKey('couriers.courier_id'), index=True)
 
     region_owner = relationship("Courier", back_populates="regions")
 
@@ -50,11 +105,16 @@ class WorkingHours(Base):
     __tablename__ = 'working_hours'
 
     id = Column(Integer, primary_key=True)
-    courier_id = Column(Integer, ForeignKey('couriers.courier_id'))
+    courier_id = Column(Integer, ForeignKey('couriers.courier_id'), index=True)
     working_hours = Column(TIMERANGE())
 
     wh_owner = relationship("Courier", back_populates="working_hours")
 
+    __table_args__ = (
+        Index('ix_working_hours_working_hours',
+              working_hours, postgresql_using='gist'),
+    )
+
 
 class Order(Base):
     __tablename__ = 'orders'
@@ -65,24 +125,84 @@ class Order(Base):
     taken = Column(Boolean, default=False)
     delivery_hours = relationship("DeliveryHours", back_populates="dh_owner")
 
+    __table_args__ = (
+        # Поиск свободных заказов по региону и весу при назначении
+        Index('ix_orders_untaken_region_weight',
+              region, weight, postgresql_where=(taken == False)),
+    )
+
 
 class DeliveryHours(Base):
     __tablename__ = 'delivery_hours'
 
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.order_id'))
+    order_id = Column(Integer, ForeignKey('orders.order_id'), index=True)
     delivery_hours = Column(TIMERANGE())
 
     dh_owner = relationship("Order", back_populates="delivery_hours")
 
+    __table_args__ = (
+        Index('ix_delivery_hours_delivery_hours',
+              delivery_hours, postgresql_using='gist'),
+    )
+
 
 class CouriersOrders(Base):
     __tablename__ = 'couriers_orders'
 
     id = Column(Integer, primary_key=True)
 
-    order_id = Column(Integer)
+    order_id = Column(Integer, index=True)
     courier_id = Column(Integer)
-    assign_time = Column(String)
-    complete_time = Column(String, nullable=True)
+    assign_time = Column(DateTime(timezone=True))
+    complete_time = Column(DateTime(timezone=True), nullable=True)
     delivery_time = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index('ix_couriers_orders_courier_id_complete_time',
+              courier_id, complete_time),
+    )
+
+
+class CouriersOrdersArchive(Base):
+    __tablename__ = 'couriers_orders_archive'
+
+    # Завершенные назначения, перенесенные из couriers_orders
+    # (python manage.py archive). Вес и регион заказа копируются сюда,
+    # а сам заказ и его промежутки доставки удаляются
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, nullable=False, index=True)
+    courier_id = Column(Integer, nullable=False, index=True)
+    assign_time = Column(DateTime(timezone=True))
+    complete_time = Column(DateTime(timezone=True), nullable=False)
+    delivery_time = Column(Integer)
+    weight = Column(Float)
+    region = Column(Integer)
+
+
+class CourierStats(Base):
+    __tablename__ = 'courier_stats'
+
+    # Статистика завершенных заказов курьера по регионам,
+    # обновляется при каждом завершении заказа
+    courier_id = Column(Integer, ForeignKey(
+        'couriers.courier_id'), primary_key=True)
+    region = Column(Integer, primary_key=True)
+    completed = Column(Integer, nullable=False, default=0)
+    delivery_time_sum = Column(BigInteger, nullable=False, default=0)
+    earnings = Column(BigInteger, nullable=False, default=0)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_keys'
+
+    # Сохраненные ответы на запросы с заголовком Idempotency-Key (см.
+    # idempotency). Пока запрос выполняется, status_code пустой
+    key = Column(String(255), primary_key=True)
+    route = Column(String, primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(Integer)
+    media_type = Column(String)
+    body = Column(LargeBinary)
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        server_default=func.now(), index=True)
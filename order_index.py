@@ -0,0 +1,228 @@
+"""
+Индекс свободных заказов в памяти процесса.
+
+Хранит для каждого региона свободные заказы, отсортированные по весу, вместе
+с уже разобранными промежутками доставки и их маской (см. schedule). С ним назначение заказов курьеру
+выбирает кандидатов без запросов к orders и delivery_hours, а в базу ходит
+только чтобы записать результат.
+
+Индекс загружается из базы при первом обращении и дальше обновляется после
+каждого коммита, который меняет набор свободных заказов. Он свой у каждого
+процесса, и об изменениях в других процессах не знает. Заказы, взятые
+другими процессами, обнаруживаются при записи назначения. Заказы, которые
+другие процессы загрузили или сняли с курьеров, в индекс не попадают до
+перезапуска: если в индексе не нашлось подходящих заказов, назначение ищет
+их запросом к базе (см. crud.get_max_assigns_for_courier). Включается
+переменной окружения ORDER_INDEX=on.
+"""
+import bisect
+import heapq
+import itertools
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+from sqlalchemy.orm import Session
+
+import models
+import schedule
+
+ORDER_INDEX = os.environ.get('ORDER_INDEX', 'off')
+# 'on' — включить GET /internal/order-index. Сверка читает все свободные
+# заказы, поэтому по умолчанию маршрут выключен
+ORDER_INDEX_CHECK = os.environ.get('ORDER_INDEX_CHECK', 'off')
+
+
+class OpenOrder(NamedTuple):
+    order_id: int
+    weight: float
+    region: int
+    # Промежутки доставки: пары (начало, конец)
+    delivery_hours: Tuple
+
+
+class OpenOrderIndex:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._orders: Dict[int, OpenOrder] = {}
+        # region -> [(weight, order_id)] по возрастанию
+        self._regions: Dict[int, List[Tuple[float, int]]] = defaultdict(list)
+        # order_id -> маска промежутков доставки
+        self._masks = schedule.MaskTable()
+        # Изменения, пришедшие во время загрузки
+        self._pending = None
+
+    def __len__(self):
+        return len(self._orders)
+
+    @property
+    def active(self) -> bool:
+        # Индекс загружен или загружается, и его нужно обновлять
+        return self.loaded or self._pending is not None
+
+    # Под блокировкой не ходим в базу: в режиме async все запросы
+    # выполняются в одном потоке, и блокировка не должна пережидать I/O
+
+    def _add(self, orders: List[OpenOrder]):
+        # Новые заказы дописываем в конец и сортируем затронутые регионы
+        # целиком: при импорте большой пачки это быстрее вставок по одной
+        self._discard([i.order_id for i in orders])
+        regions = set()
+        for order in orders:
+            self._orders[order.order_id] = order
+            self._masks.put(order.order_id, schedule.delivery_mask(order.delivery_hours))
+            self._regions[order.region].append((order.weight, order.order_id))
+            regions.add(order.region)
+        for region in regions:
+            self._regions[region].sort()
+
+    def _discard(self, order_ids: Iterable[int]):
+        for order_id in order_ids:
+            order = self._orders.pop(order_id, None)
+            if order is None:
+                continue
+            self._masks.discard(order_id)
+            orders = self._regions[order.region]
+            del orders[bisect.bisect_left(orders, (order.weight, order.order_id))]
+
+    def _apply(self, fn, arg):
+        # Пока индекс не загружен, изменения не нужны: загрузка прочитает
+        # актуальное состояние из базы. Во время загрузки они запоминаются
+        if self._pending is not None:
+            self._pending.append((fn, arg))
+        elif not self.loaded:
+            return
+        fn(arg)
+
+    def add(self, orders: Iterable[OpenOrder]):
+        with self._lock:
+            self._apply(self._add, list(orders))
+
+    def discard(self, order_ids: Iterable[int]):
+        with self._lock:
+            self._apply(self._discard, list(order_ids))
+
+    def load(self, db: Session):
+        with self._lock:
+            self._pending = []
+        try:
+            orders = load_open_orders(db)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._orders = {}
+            self._regions = defaultdict(list)
+            self._masks = schedule.MaskTable()
+            self._add(orders)
+            # Повторяем то, что изменилось, пока шла загрузка
+            for fn, arg in pending:
+                fn(arg)
+            self.loaded = True
+
+    def ensure_loaded(self, db: Session):
+        if not self.loaded:
+            self.load(db)
+
+    def candidates(self, regions: Iterable[int], working_hours: Sequence,
+                   capacity: float) -> List[OpenOrder]:
+        # Свободные заказы из регионов курьера, которые он может унести
+        # и которые подходят по графику, по возрастанию веса
+        with self._lock:
+            return self._candidates(regions, working_hours, capacity)
+
+    def _candidates(self, regions, working_hours, capacity):
+        # График проверяем сразу для всех подходящих по весу заказов
+        # региона: одно побитовое И масок на весь регион
+        wanted = schedule.working_mask(working_hours)
+        by_region = []
+        for region in set(regions):
+            orders = self._regions.get(region, [])
+            orders = orders[:bisect.bisect_right(orders, (capacity, float('inf')))]
+            if orders:
+                fit = self._masks.fits([i for _, i in orders], wanted)
+                by_region.append(list(itertools.compress(orders, fit)))
+
+        return [self._orders[i] for _, i in heapq.merge(*by_region)]
+
+    def claim(self, regions: Iterable[int], working_hours: Sequence,
+              capacity: float, select) -> List[OpenOrder]:
+        """
+        Выбирает заказы функцией select(candidates) и сразу убирает их из
+        индекса, чтобы параллельный запрос не выбрал их же. Если записать
+        назначение не удалось, заказы нужно вернуть через refresh.
+        """
+        with self._lock:
+            chosen = select(self._candidates(regions, working_hours, capacity))
+            self._apply(self._discard, [i.order_id for i in chosen])
+            return chosen
+
+    def refresh(self, db: Session, order_ids: List[int]):
+        # Перечитывает из базы состояние заказов: свободные возвращаются
+        # в индекс, остальные из него убираются
+        if not order_ids or not self.active:
+            return
+        open_orders = load_open_orders(db, order_ids)
+        with self._lock:
+            self._apply(self._discard, list(order_ids))
+            self._apply(self._add, open_orders)
+
+    def verify(self, db: Session) -> Dict:
+        """
+        Сверяет индекс с базой. missing — свободные в базе заказы, которых
+        нет в индексе; stale — заказы в индексе, которые в базе уже взяты или
+        отличаются весом, регионом или промежутками доставки.
+        """
+        actual = {i.order_id: i for i in load_open_orders(db)}
+        with self._lock:
+            indexed = dict(self._orders)
+
+        return {
+            'enabled': self.enabled,
+            'loaded': self.loaded,
+            'orders': len(indexed),
+            'missing': sorted(set(actual) - set(indexed)),
+            'stale': sorted(
+                i for i, order in indexed.items()
+                if actual.get(i) != order),
+        }
+
+
+def to_open_order(order_id: int, weight: float, region: int,
+                  delivery_hours: Iterable) -> OpenOrder:
+    return OpenOrder(order_id, weight, region, tuple(sorted(
+        (i.lower, i.upper) for i in delivery_hours)))
+
+
+def load_open_orders(db: Session, order_ids: List[int] = None) -> List[OpenOrder]:
+    # Два запроса на все заказы: сами заказы и их промежутки доставки
+    orders = db.query(
+        models.Order.order_id, models.Order.weight, models.Order.region
+    ).filter(models.Order.taken == False)
+    hours = db.query(
+        models.DeliveryHours.order_id, models.DeliveryHours.delivery_hours
+    ).join(
+        models.Order, models.Order.order_id == models.DeliveryHours.order_id
+    ).filter(models.Order.taken == False)
+
+    if order_ids is not None:
+        orders = orders.filter(models.Order.order_id == models.ids_array(order_ids))
+        hours = hours.filter(models.Order.order_id == models.ids_array(order_ids))
+
+    delivery_hours = defaultdict(list)
+    for order_id, dh in hours:
+        delivery_hours[order_id].append(dh)
+
+    return [
+        to_open_order(i.order_id, i.weight, i.region, delivery_hours[i.order_id])
+        for i in orders
+    ]
+
+
+index = OpenOrderIndex(enabled=ORDER_INDEX == 'on')
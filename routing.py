@@ -0,0 +1,139 @@
+"""
+Чтение с реплики.
+
+Если задан DB_REPLICA_URL, обработчики, отмеченные @read_only, получают в
+get_db сессию реплики, а все остальные — основной базы. Реплика отстает от
+основной базы, поэтому курьера, измененного за последние
+DB_REPLICA_LAG_WINDOW секунд, читаем с основной базы: клиент должен увидеть
+свою запись. Курьера берем из параметра пути courier_id.
+
+Об изменениях курьеров процесс узнает так же, как кэш курьеров (см. cache):
+из своих коммитов и через NOTIFY courier_changed от других воркеров.
+Решения пишутся в лог на уровне DEBUG и считаются в метрике db_route_total.
+"""
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Iterable, Optional, Tuple
+
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Обработчики, которые ничего не пишут в базу
+_read_only = set()
+
+
+def read_only(endpoint):
+    _read_only.add(endpoint)
+    return endpoint
+
+
+class RecentWrites:
+    """Курьеры, измененные за последние window секунд."""
+
+    def __init__(self, window: float, maxsize: int = 100000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.maxsize = maxsize
+        self._clock = clock
+        self._lock = threading.Lock()
+        # courier_id -> до какого момента читать с основной базы. Окно у всех
+        # одинаковое, так что записи упорядочены по сроку
+        self._until: OrderedDict = OrderedDict()
+        # До какого момента все курьеры считаются измененными
+        self._all_until = float('-inf')
+
+    def __len__(self):
+        return len(self._until)
+
+    def _expire(self, now: float):
+        while self._until and next(iter(self._until.values())) <= now:
+            self._until.popitem(last=False)
+
+    def mark(self, courier_ids: Optional[Iterable[int]]):
+        # None — изменились все курьеры
+        with self._lock:
+            now = self._clock()
+            until = now + self.window
+            if courier_ids is None:
+                self._all_until = until
+                self._until.clear()
+                return
+            for courier_id in courier_ids:
+                self._until[courier_id] = until
+                self._until.move_to_end(courier_id)
+            self._expire(now)
+            while len(self._until) > self.maxsize:
+                self._until.popitem(last=False)
+
+    def __contains__(self, courier_id: int) -> bool:
+        with self._lock:
+            now = self._clock()
+            if self._all_until > now:
+                return True
+            until = self._until.get(courier_id)
+            return until is not None and until > now
+
+
+class Router:
+    def __init__(self, primary, replica=None,
+                 window: float = database.DB_REPLICA_LAG_WINDOW,
+                 clock: Callable[[], float] = time.monotonic):
+        # primary и replica — фабрики сессий
+        self.primary = primary
+        self.replica = replica
+        self.recent = RecentWrites(window, clock=clock)
+        self._lock = threading.Lock()
+        # (target, reason) -> сколько запросов
+        self.decisions: Counter = Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.replica is not None
+
+    def route(self, request) -> Tuple[str, str]:
+        # Куда отправить запрос и почему
+        if not self.enabled:
+            return 'primary', 'no_replica'
+        if request.scope.get('endpoint') not in _read_only:
+            return 'primary', 'write'
+        courier_id = request.path_params.get('courier_id')
+        if str(courier_id).isdigit() and int(courier_id) in self.recent:
+            return 'primary', 'recent_write'
+        return 'replica', 'read'
+
+    def session_factory(self, request):
+        target, reason = self.route(request)
+        if self.enabled:
+            with self._lock:
+                self.decisions[target, reason] += 1
+            logger.debug('%s %s -> %s (%s)', request.method,
+                         request.url.path, target, reason)
+        return self.replica if target == 'replica' else self.primary
+
+    def written(self, courier_ids: Optional[Iterable[int]]):
+        if self.enabled:
+            self.recent.mark(courier_ids)
+
+
+if database.DB_MODE == 'async':
+    router = Router(database.AsyncSessionLocal, database.AsyncReplicaSessionLocal)
+else:
+    router = Router(database.SessionLocal, database.ReplicaSessionLocal)
+
+
+@metrics.collector
+def routing_metrics():
+    with router._lock:
+        decisions = dict(router.decisions)
+    return [
+        ('db_route_total', 'counter', 'Requests by chosen database and reason',
+         [({'target': target, 'reason': reason}, value)
+          for (target, reason), value in sorted(decisions.items())]),
+        ('db_route_recent_writes', 'gauge',
+         'Couriers read from the primary after a recent change',
+         [({}, len(router.recent))]),
+    ]
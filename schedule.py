@@ -0,0 +1,92 @@
+"""
+Графики в виде битовых масок по минутам суток.
+
+Промежутки доставки и рабочие часы задаются с точностью до минуты, поэтому
+график можно хранить маской: подходит ли заказ курьеру — одно побитовое И
+масок вместо перебора всех пар промежутков.
+
+На каждую минуту m приходится два бита: 2m — сам момент m, 2m + 1 —
+открытый интервал (m, m + 1). Так маски повторяют условие из запроса
+(crud._fits_schedule): открытый промежуток доставки (start, stop)
+пересекается с закрытым промежутком графика [start, stop]. Промежуток
+доставки, который только касается графика границей, не подходит, а график
+из одной точки подходит, если точка лежит внутри промежутка доставки.
+Маска — MASK_WORDS слов numpy.uint64.
+"""
+import datetime
+from typing import Dict, Hashable, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+MINUTES = 24 * 60
+MASK_BITS = 2 * MINUTES
+MASK_WORDS = MASK_BITS // 64
+
+Hours = Iterable[Tuple[datetime.time, datetime.time]]
+
+
+def _minute(value: datetime.time) -> int:
+    return value.hour * 60 + value.minute
+
+
+def _mask(bits: List[Tuple[int, int]]) -> np.ndarray:
+    # bits — включительные диапазоны номеров битов
+    flags = np.zeros(MASK_BITS, dtype=bool)
+    for first, last in bits:
+        flags[first:last + 1] = True
+    return np.packbits(flags, bitorder='little').view(np.uint64)
+
+
+def delivery_mask(hours: Hours) -> np.ndarray:
+    # Открытые промежутки: без концов, пустой промежуток не дает битов
+    return _mask([(2 * _minute(start) + 1, 2 * _minute(stop) - 1)
+                  for start, stop in hours])
+
+
+def working_mask(hours: Hours) -> np.ndarray:
+    # Закрытые промежутки: вместе с концами
+    return _mask([(2 * _minute(start), 2 * _minute(stop))
+                  for start, stop in hours])
+
+
+def fits(masks: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Для каждой маски из masks (N × MASK_WORDS) — пересекается ли она с mask."""
+    return (masks & mask).any(axis=1)
+
+
+class MaskTable:
+    """
+    Маски по ключам в одном массиве, чтобы проверять сразу много ключей.
+    Строки удаленных ключей переиспользуются.
+    """
+
+    def __init__(self):
+        self._masks = np.zeros((0, MASK_WORDS), dtype=np.uint64)
+        self._rows: Dict[Hashable, int] = {}
+        self._free: List[int] = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def put(self, key: Hashable, mask: np.ndarray):
+        row = self._rows.get(key)
+        if row is None:
+            if not self._free:
+                # Растим массив вдвое, как list
+                size = len(self._masks)
+                self._masks = np.concatenate([
+                    self._masks,
+                    np.zeros((max(size, 64), MASK_WORDS), dtype=np.uint64)])
+                self._free = list(range(len(self._masks) - 1, size - 1, -1))
+            row = self._rows[key] = self._free.pop()
+        self._masks[row] = mask
+
+    def discard(self, key: Hashable):
+        row = self._rows.pop(key, None)
+        if row is not None:
+            self._free.append(row)
+
+    def fits(self, keys: Sequence[Hashable], mask: np.ndarray) -> np.ndarray:
+        rows = np.fromiter((self._rows[i] for i in keys), dtype=np.intp,
+                           count=len(keys))
+        return fits(self._masks[rows], mask)
@@ -87,6 +87,8 @@ class CourierRating(BaseModel):
         for i in v:
             if hasattr(i, 'region_id'):
                 answer.append(i.region_id)
+            elif isinstance(i, int):
+                answer.append(i)
         return answer
 
     @validator('working_hours')
@@ -96,6 +98,8 @@ class CourierRating(BaseModel):
             if hasattr(i, 'working_hours'):
                 answer.append(
                     '-'.join(re.findall(r'(?:[01]\d|2[0-3]):(?:[0-5]\d)', str(i.working_hours))))
+            elif isinstance(i, str):
+                answer.append(i)
         return answer
 
 
@@ -132,6 +136,8 @@ class CourierPatch(BaseModel):
         for i in v:
             if hasattr(i, 'region_id'):
                 answer.append(i.region_id)
+            elif isinstance(i, int):
+                answer.append(i)
         return answer
 
     @validator('working_hours')
@@ -141,6 +147,8 @@ class CourierPatch(BaseModel):
             if hasattr(i, 'working_hours'):
                 answer.append(
                     '-'.join(re.findall(r'(?:[01]\d|2[0-3]):(?:[0-5]\d)', str(i.working_hours))))
+            elif isinstance(i, str):
+                answer.append(i)
         return answer
 
     class Config:
@@ -228,6 +236,23 @@ class OrderAssign(BaseModel):
     courier_id: int = Field(..., gt=0)
 
 
+class OrdersAssignBatchInput(BaseModel):
+    courier_ids: conlist(int, min_items=1)
+
+    @validator('courier_ids', each_item=True)
+    def check_courier_ids(cls, v):
+        assert v > 0, 'Courier id must be greater than 0.'
+        return v
+
+
+class CourierOrdersAssign(OrdersAssign):
+    courier_id: int
+
+
+class OrdersAssignBatch(BaseModel):
+    couriers: List[CourierOrdersAssign]
+
+
 class OrdersComplete(BaseModel):
     courier_id: int = Field(..., gt=0)
     order_id: int = Field(..., gt=0)
@@ -0,0 +1,66 @@
+"""
+Запуск сервиса в нескольких процессах-воркерах.
+
+    python server.py --workers 4 --port 8080
+
+У каждого воркера свой пул подключений к базе (DB_POOL_SIZE, DB_MAX_OVERFLOW),
+поэтому перед запуском проверяется, что все воркеры вместе укладываются
+в max_connections сервера Postgres.
+"""
+import argparse
+import logging
+import os
+
+import uvicorn
+
+import cache
+import database
+
+logger = logging.getLogger('server')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+
+def check_connections(workers: int):
+    per_worker = database.DB_POOL_SIZE + database.DB_MAX_OVERFLOW
+    if cache.tracking_changes():
+        # Подключение, которое слушает изменения курьеров
+        per_worker += 1
+    try:
+        with database.engine.connect() as conn:
+            max_connections = int(
+                conn.execute('SHOW max_connections').scalar())
+    except Exception as e:
+        logger.warning('cannot check max_connections: %s', e)
+        return
+    finally:
+        # Воркеры откроют свои подключения
+        database.engine.dispose()
+
+    if workers * per_worker > max_connections:
+        logger.warning(
+            '%d workers may open %d connections, max_connections is %d',
+            workers, workers * per_worker, max_connections)
+    else:
+        logger.info(
+            '%d workers may open %d of %d connections',
+            workers, workers * per_worker, max_connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int,
+                        default=int(os.environ.get('PORT', 8080)))
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('WORKERS', 1)))
+    args = parser.parse_args()
+
+    check_connections(args.workers)
+
+    uvicorn.run('main:app', host=args.host, port=args.port,
+                workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
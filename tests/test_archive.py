@@ -0,0 +1,85 @@
+import datetime
+import json
+
+import crud
+import models
+
+from .test_base import client, db, postgres
+from .utils import generate_courier, generate_order
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+def complete(client, order_id, complete_time):
+    response = client.post('/orders/complete', data=json.dumps({
+        'courier_id': 1,
+        'order_id': order_id,
+        'complete_time': crud.format_time(complete_time),
+    }))
+    assert response.status_code == 200
+
+
+def prepare(client):
+    # Четыре заказа назначены курьеру: два завершены давно,
+    # один только что, один еще в пути
+    client.post('/couriers', data=json.dumps({'data': [generate_courier(
+        courier_id=1, courier_type='bike', regions=[1, 2],
+        working_hours=['00:00-23:59'])]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=1, region=1 + i % 2,
+                       delivery_hours=['00:00-23:59'])
+        for i in range(1, 6)
+    ]}))
+    client.post('/orders/assign', data=json.dumps({'courier_id': 1}))
+    complete(client, 1, NOW - datetime.timedelta(days=2))
+    complete(client, 2, NOW - datetime.timedelta(days=2))
+    complete(client, 3, NOW)
+
+
+def test_archive_completed(client, db):
+    prepare(client)
+    expected = client.get('/couriers/1').json()
+
+    assert crud.archive_completed(
+        db, NOW - datetime.timedelta(days=1), batch_size=1) == 2
+
+    archived = db.query(models.CouriersOrdersArchive).order_by(
+        models.CouriersOrdersArchive.order_id).all()
+    assert [(i.order_id, i.courier_id, i.weight, i.region) for i in archived] == [
+        (1, 1, 1, 2), (2, 1, 1, 1)]
+    assert all(i.delivery_time is not None for i in archived)
+
+    # Недавно завершенный и незавершенные заказы остались на месте
+    assert sorted(i for i, in db.query(models.CouriersOrders.order_id)) == [3, 4, 5]
+    assert sorted(i for i, in db.query(models.Order.order_id)) == [3, 4, 5]
+    assert sorted({i for i, in db.query(models.DeliveryHours.order_id)}) == [3, 4, 5]
+
+    assert client.get('/couriers/1').json() == expected
+    complete(client, 4, NOW)
+
+
+def test_backfill_after_archive(client, db):
+    prepare(client)
+    expected = client.get('/couriers/1').json()
+    crud.archive_completed(db, NOW + datetime.timedelta(minutes=1))
+
+    db.query(models.CourierStats).delete()
+    db.commit()
+    assert crud.backfill_courier_stats(db) == 2
+    assert client.get('/couriers/1').json() == expected
+
+
+def test_archived_order_id_is_taken(client, db):
+    prepare(client)
+    crud.archive_completed(db, NOW + datetime.timedelta(minutes=1))
+
+    response = client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i) for i in (1, 6)]}))
+
+    assert response.status_code == 400
+    assert response.text == str({'validation_error': {'orders': [{'id': 1}]}})
+
+    # Повторно завершить архивный заказ нельзя
+    response = client.post('/orders/complete', data=json.dumps({
+        'courier_id': 1, 'order_id': 1, 'complete_time': crud.format_time(NOW)}))
+    assert response.status_code == 400
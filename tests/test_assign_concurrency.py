@@ -0,0 +1,160 @@
+import datetime
+import multiprocessing
+from random import Random
+
+import crud
+import models
+import schemas
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from .test_base import SQLALCHEMY_DATABASE_URL, postgres
+from .utils import generate_courier, generate_order
+
+PROCESSES = 8
+COURIERS = 20
+ORDERS = 400
+# Мало курьеров, чтобы запросы к одному курьеру чаще пересекались
+COMPLETE_COURIERS = 3
+ROUNDS = 40
+
+
+def assign_worker(args):
+    seed, barrier = args
+    # У каждого процесса свои подключения к базе
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+    courier_ids = list(range(1, COURIERS + 1))
+    Random(seed).shuffle(courier_ids)
+
+    barrier.wait()
+    assigned = []
+    for courier_id in courier_ids:
+        answer = crud.get_max_assigns_for_courier(db, courier_id)
+        assigned += [i['id'] for i in answer['orders']]
+
+    db.close()
+    engine.dispose()
+    return assigned
+
+
+def test_concurrent_assign_no_duplicates(postgres):
+    db = postgres()
+    crud.add_couriers(db, schemas.CouriersPostRequest(data=[
+        generate_courier(courier_id=i, regions=[1, 2],
+                         working_hours=['09:00-18:00'])
+        for i in range(1, COURIERS + 1)
+    ]))
+    crud.add_orders(db, schemas.OrdersPostRequest(data=[
+        generate_order(order_id=i, region=1 + i % 2,
+                       delivery_hours=['10:00-11:00'])
+        for i in range(1, ORDERS + 1)
+    ]))
+    db.close()
+    # Дочерним процессам не должны достаться подключения родителя
+    db.bind.dispose()
+
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Manager().Barrier(PROCESSES)
+    with ctx.Pool(PROCESSES) as pool:
+        results = pool.map(
+            assign_worker, [(i, barrier) for i in range(PROCESSES)])
+
+    # Ни один заказ не выдан дважды
+    assigned = [i for result in results for i in result]
+    assert assigned
+    assert len(assigned) == len(set(assigned))
+
+    db = postgres()
+    pairs = db.query(models.CouriersOrders.order_id).all()
+    assert sorted(i for i, in pairs) == sorted(assigned)
+
+    taken = db.query(models.Order.order_id).filter(models.Order.taken == True)
+    assert sorted(i for i, in taken) == sorted(assigned)
+
+    # Вес каждого курьера совпадает с весом его заказов и не больше допустимого
+    weights = dict(db.query(
+        models.CouriersOrders.courier_id, func.sum(models.Order.weight)
+    ).join(
+        models.Order, models.Order.order_id == models.CouriersOrders.order_id
+    ).group_by(models.CouriersOrders.courier_id))
+    for courier in db.query(models.Courier):
+        assert round(weights.get(courier.courier_id, 0), 2) == courier.orders_weight
+        assert courier.orders_weight <= crud.carrying_capacity[courier.courier_type]
+    db.close()
+
+
+def assign_complete_worker(args):
+    seed, barrier = args
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    rnd = Random(seed)
+
+    barrier.wait()
+    completed = []
+    for _ in range(ROUNDS):
+        # Назначения и завершения одним и тем же курьерам идут вперемешку
+        courier_id = rnd.randint(1, COMPLETE_COURIERS)
+        crud.get_max_assigns_for_courier(db, courier_id)
+        open_orders = [i for i, in db.query(models.CouriersOrders.order_id).filter(
+            models.CouriersOrders.courier_id == courier_id,
+            models.CouriersOrders.complete_time == None)]
+        db.commit()
+        if not open_orders:
+            continue
+        order_id = rnd.choice(open_orders)
+        answer = crud.orders_complete(db, schemas.OrdersComplete(
+            courier_id=courier_id, order_id=order_id,
+            complete_time=crud.format_time(datetime.datetime.now(datetime.timezone.utc))))
+        db.rollback()
+        if answer is not None:
+            completed.append(order_id)
+
+    db.close()
+    engine.dispose()
+    return completed
+
+
+def test_concurrent_assign_and_complete(postgres):
+    db = postgres()
+    crud.add_couriers(db, schemas.CouriersPostRequest(data=[
+        generate_courier(courier_id=i, courier_type='car', regions=[1],
+                         working_hours=['09:00-18:00'])
+        for i in range(1, COMPLETE_COURIERS + 1)
+    ]))
+    crud.add_orders(db, schemas.OrdersPostRequest(data=[
+        generate_order(order_id=i, region=1, delivery_hours=['10:00-11:00'])
+        for i in range(1, ORDERS + 1)
+    ]))
+    db.close()
+    db.bind.dispose()
+
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Manager().Barrier(PROCESSES)
+    with ctx.Pool(PROCESSES) as pool:
+        results = pool.map(
+            assign_complete_worker, [(i, barrier) for i in range(PROCESSES)])
+
+    # Каждый заказ завершен один раз
+    completed = [i for result in results for i in result]
+    assert completed
+    assert len(completed) == len(set(completed))
+
+    db = postgres()
+    done = db.query(models.CouriersOrders.order_id).filter(
+        models.CouriersOrders.complete_time != None)
+    assert sorted(i for i, in done) == sorted(completed)
+    assert db.query(func.sum(models.CourierStats.completed)).scalar() == len(completed)
+
+    # Вес курьера — вес его незавершенных заказов
+    weights = dict(db.query(
+        models.CouriersOrders.courier_id, func.sum(models.Order.weight)
+    ).join(
+        models.Order, models.Order.order_id == models.CouriersOrders.order_id
+    ).filter(
+        models.CouriersOrders.complete_time == None
+    ).group_by(models.CouriersOrders.courier_id))
+    for courier in db.query(models.Courier):
+        assert round(weights.get(courier.courier_id, 0), 2) == courier.orders_weight
+    db.close()
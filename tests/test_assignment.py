@@ -0,0 +1,60 @@
+from collections import namedtuple
+
+import pytest
+
+from ..assignment import GreedyStrategy, KnapsackStrategy, match_batch
+
+Candidate = namedtuple('Candidate', ['order_id', 'weight'])
+Pair = namedtuple('Pair', ['courier_id', 'order_id', 'weight'])
+
+
+def ids(orders):
+    return sorted(i.order_id for i in orders)
+
+
+CANDIDATES = [Candidate(i, w) for i, w in enumerate([3, 3, 3, 5, 5], 1)]
+
+
+def test_greedy():
+    assert ids(GreedyStrategy().select(CANDIDATES, 10)) == [1, 2, 3]
+
+
+def test_knapsack_weight():
+    assert ids(KnapsackStrategy('weight').select(CANDIDATES, 10)) == [4, 5]
+
+
+def test_knapsack_count():
+    assert ids(KnapsackStrategy('count').select(CANDIDATES, 10)) == [1, 2, 3]
+
+
+def test_knapsack_fractional_weights():
+    candidates = [Candidate(1, 0.34), Candidate(2, 0.33), Candidate(3, 0.5)]
+    assert ids(KnapsackStrategy('weight').select(candidates, 0.84)) == [1, 3]
+
+
+def test_knapsack_falls_back_to_greedy():
+    strategy = KnapsackStrategy('weight', time_budget=0)
+    assert ids(strategy.select(CANDIDATES, 10)) == [1, 2, 3]
+
+
+@pytest.mark.parametrize('strategy', [
+    GreedyStrategy(), KnapsackStrategy('weight'), KnapsackStrategy('count')])
+def test_nothing_fits(strategy):
+    assert strategy.select([Candidate(1, 12)], 10) == []
+
+
+def test_match_batch_best_fit():
+    # Курьер 1 — единственный, кому подходят заказы 3 и 4
+    pairs = [Pair(c, o, w) for c, o, w in [
+        (1, 1, 5), (2, 1, 5), (1, 2, 5), (2, 2, 5), (1, 3, 5), (1, 4, 5)]]
+    answer = match_batch(pairs, {1: 10, 2: 10})
+    assert ids(answer[1]) == [3, 4]
+    assert ids(answer[2]) == [1, 2]
+
+
+def test_match_batch_capacity():
+    pairs = [Pair(1, 1, 4), Pair(2, 1, 4), Pair(2, 2, 7), Pair(1, 3, 12)]
+    answer = match_batch(pairs, {1: 5, 2: 10})
+    # Заказ 1 уходит туда, где после него останется меньше места
+    assert ids(answer[1]) == [1]
+    assert ids(answer[2]) == [2]
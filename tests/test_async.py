@@ -0,0 +1,107 @@
+import datetime
+import json
+
+import bulk_import
+import crud
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from ..main import app, get_db
+from .test_base import SQLALCHEMY_DATABASE_URL, postgres
+from .utils import generate_courier, generate_order
+
+
+@pytest.fixture
+def async_client(postgres):
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL.replace(
+            'postgresql://', 'postgresql+asyncpg://', 1),
+        poolclass=NullPool
+    )
+    AsyncTestingSessionLocal = sessionmaker(
+        autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+
+    async def override_get_db():
+        async with AsyncTestingSessionLocal() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    with TestClient(app) as tc:
+        yield tc
+
+
+def test_async_workflow(async_client: TestClient):
+    courier = generate_courier(courier_id=1,
+                               courier_type='foot',
+                               regions=[7],
+                               working_hours=['12:00-20:00'])
+    response = async_client.post('/couriers',
+                                 data=json.dumps({'data': [courier]}))
+    assert response.status_code == 201
+
+    response = async_client.post(
+        '/orders',
+        data=json.dumps({
+            'data': [generate_order(order_id=4,
+                                    region=7,
+                                    delivery_hours=['11:00-13:00']),
+                     generate_order(order_id=5,
+                                    region=7,
+                                    delivery_hours=['21:00-21:30']),
+                     ]
+        }))
+    assert response.status_code == 201
+
+    response = async_client.post('/orders/assign',
+                                 data=json.dumps({'courier_id': 1}))
+    assert response.status_code == 200
+    assert response.json()['orders'] == [{'id': 4}]
+
+    complete = json.dumps({
+        'courier_id': 1,
+        'order_id': 4,
+        'complete_time': crud.format_time(datetime.datetime.now(datetime.timezone.utc))
+    })
+    response = async_client.post('/orders/complete', data=complete,
+                                 headers={'Idempotency-Key': 'complete-4'})
+    assert response.status_code == 200
+    assert response.json() == {'order_id': 4}
+
+    # Повтор с тем же ключом получает сохраненный ответ
+    response = async_client.post('/orders/complete', data=complete,
+                                 headers={'Idempotency-Key': 'complete-4'})
+    assert response.status_code == 200
+    assert response.json() == {'order_id': 4}
+
+    response = async_client.patch('/couriers/1',
+                                  data=json.dumps({'regions': [7, 8]}))
+    assert response.status_code == 200
+    assert response.json()['regions'] == [7, 8]
+
+    response = async_client.get('/couriers/1')
+    assert response.status_code == 200
+    assert response.json()['working_hours'] == ['12:00-20:00']
+
+
+def test_async_import(async_client: TestClient, monkeypatch):
+    monkeypatch.setattr(bulk_import, 'IMPORT_CHUNK_SIZE', 3)
+
+    orders = [generate_order(order_id=i) for i in range(1, 11)]
+    response = async_client.post('/orders/import',
+                                 data=json.dumps({'data': orders}))
+    assert response.status_code == 201
+    assert len(response.json()['orders']) == 10
+
+    # Повтор уже записанного заказа откатывает весь импорт
+    orders = [generate_order(order_id=i) for i in (11, 12, 13, 1)]
+    response = async_client.post('/orders/import',
+                                 data=json.dumps({'data': orders}))
+    assert response.status_code == 400
+    assert response.text == str({'validation_error': {'orders': [{'id': 1}]}})
+
+    response = async_client.post('/orders/import', data=json.dumps({'data': [
+        generate_order(order_id=11)]}))
+    assert response.status_code == 201
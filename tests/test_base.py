@@ -1,11 +1,13 @@
 import os
+from contextlib import contextmanager
 
+import instrumentation
 import models
 import psycopg2.extras
 import pytest
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
 from sqlalchemy_utils import create_database, drop_database
@@ -34,6 +36,7 @@ def postgres():
     engine = create_engine(
         SQLALCHEMY_DATABASE_URL
     )
+    instrumentation.instrument_engine(engine)
     TestingSessionLocal = sessionmaker(
         autocommit=False, autoflush=False, bind=engine)
 
@@ -58,11 +61,52 @@ def postgres():
             db.close()
 
     app.dependency_overrides[get_db] = override_get_db
-    yield
+    yield TestingSessionLocal
+    engine.dispose()
     drop_database(SQLALCHEMY_DATABASE_URL)
 
 
+@pytest.fixture
+def db(postgres):
+    db = postgres()
+    yield db
+    db.close()
+
+
 @pytest.fixture
 def client(postgres):
     with TestClient(app) as tc:
         yield tc
+
+
+class QueryCounter:
+    """Запоминает SQL-запросы, выполненные на движке внутри capture()."""
+
+    def __init__(self):
+        self.statements = []
+        self._active = False
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self._active:
+            self.statements.append(statement)
+
+    def __len__(self):
+        return len(self.statements)
+
+    @contextmanager
+    def capture(self):
+        self.statements = []
+        self._active = True
+        try:
+            yield self
+        finally:
+            self._active = False
+
+
+@pytest.fixture
+def queries(postgres):
+    engine = postgres.kw['bind']
+    counter = QueryCounter()
+    event.listen(engine, 'after_cursor_execute', counter)
+    yield counter
+    event.remove(engine, 'after_cursor_execute', counter)
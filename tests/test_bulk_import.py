@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+import bulk_import
+import crud
+import models
+import pytest
+import schemas
+
+from .test_base import client, db, postgres
+from .utils import generate_courier, generate_order
+
+
+def body(items) -> bytes:
+    return json.dumps({'data': items}).encode()
+
+
+def test_chunks_from_split_stream():
+    orders = [generate_order(order_id=i) for i in range(1, 11)]
+    orders[3]['weight'] = 100
+    data = body(orders)
+
+    async def stream():
+        # Тело приходит кусками, которые режут элементы посередине
+        for start in range(0, len(data), 7):
+            yield data[start:start + 7]
+
+    async def collect():
+        job = bulk_import.StreamingImport(schemas.OrderBase, 'order_id', chunk_size=4)
+        return job, [chunk async for chunk in job.chunks(stream())]
+
+    # asyncio.run сбросил бы цикл событий потока, нужный TestClient
+    loop = asyncio.new_event_loop()
+    try:
+        job, chunks = loop.run_until_complete(collect())
+    finally:
+        loop.close()
+
+    assert [len(i) for i in chunks] == [4, 4, 1]
+    assert [i.order_id for chunk in chunks for i in chunk] == [
+        1, 2, 3, 5, 6, 7, 8, 9, 10]
+    assert job.invalid == [4]
+
+
+def test_import_orders(client, db, monkeypatch):
+    monkeypatch.setattr(bulk_import, 'IMPORT_CHUNK_SIZE', 7)
+    orders = [generate_order(order_id=i, region=1, delivery_hours=['10:00-11:00'])
+              for i in range(1, 51)]
+
+    # Тело передаем генератором, как его отдал бы клиент без буферизации
+    data = body(orders)
+    response = client.post('/orders/import', data=(
+        data[i:i + 100] for i in range(0, len(data), 100)))
+
+    assert response.status_code == 201
+    assert response.json() == {'orders': [{'id': i['order_id']} for i in orders]}
+    assert db.query(models.Order).count() == 50
+
+    # Импортированные заказы можно назначать
+    client.post('/couriers', data=json.dumps({'data': [generate_courier(
+        courier_id=1, courier_type='car', regions=[1],
+        working_hours=['09:00-18:00'])]}))
+    response = client.post('/orders/assign', data=json.dumps({'courier_id': 1}))
+    assert response.json()['orders']
+
+
+def test_import_couriers(client, monkeypatch):
+    monkeypatch.setattr(bulk_import, 'IMPORT_CHUNK_SIZE', 3)
+    couriers = [generate_courier(courier_id=i) for i in range(1, 11)]
+
+    response = client.post('/couriers/import', data=body(couriers))
+
+    assert response.status_code == 201
+    assert response.json() == {'couriers': [{'id': i} for i in range(1, 11)]}
+    assert client.get('/couriers/10').status_code == 200
+
+
+@pytest.mark.parametrize('url, generate, id_field', [
+    ('/couriers/import', generate_courier, 'courier_id'),
+    ('/orders/import', generate_order, 'order_id'),
+])
+def test_import_invalid_items(client, db, monkeypatch, url, generate, id_field):
+    monkeypatch.setattr(bulk_import, 'IMPORT_CHUNK_SIZE', 2)
+    items = [generate(**{id_field: i}) for i in range(1, 8)]
+    del items[1]['region' if id_field == 'order_id' else 'regions']
+    items[5][id_field] = -6
+
+    response = client.post(url, data=body(items))
+
+    # Ошибки во всех пачках, а в базу ничего не записано
+    who = url.split('/')[1]
+    assert response.status_code == 400
+    assert response.text == str({'validation_error': {who: [{'id': 2}, {'id': -6}]}})
+    assert db.query(models.Courier).count() == 0
+    assert db.query(models.Order).count() == 0
+
+
+@pytest.mark.parametrize('mode', ['copy', 'rows'])
+def test_import_conflicts(client, db, monkeypatch, mode):
+    # Пачки до конфликта уже записаны в транзакции и должны откатиться
+    monkeypatch.setattr(bulk_import, 'IMPORT_CHUNK_SIZE', 2)
+    monkeypatch.setattr(crud, 'ORDERS_IMPORT_MODE', mode)
+    client.post('/orders', data=body([generate_order(order_id=100)]))
+
+    # Повтор внутри пачки, между пачками и с заказом из бд
+    orders = [generate_order(order_id=i) for i in (1, 2, 3, 3, 4, 1)]
+    response = client.post('/orders/import', data=body(orders))
+    assert response.status_code == 400
+    assert response.text == str({'validation_error': {'orders': [{'id': 3}, {'id': 1}]}})
+
+    # После первой ошибки пачки не пишутся, но проверяются, в том числе
+    # на повторы с другими незаписанными пачками
+    orders = [generate_order(order_id=i) for i in (1, 100, 5, 6, 5)]
+    response = client.post('/orders/import', data=body(orders))
+    assert response.status_code == 400
+    assert response.text == str({'validation_error': {'orders': [{'id': 100}, {'id': 5}]}})
+
+    orders = [generate_order(order_id=i) for i in (1, 2, 3, 100)]
+    response = client.post('/orders/import', data=body(orders))
+    assert response.status_code == 400
+    assert response.text == str({'validation_error': {'orders': [{'id': 100}]}})
+
+    orders = [generate_order(order_id=i) for i in (1, 2, 3, 1)]
+    response = client.post('/orders/import', data=body(orders))
+    assert response.status_code == 400
+    assert response.text == str({'validation_error': {'orders': [{'id': 1}]}})
+
+    assert db.query(models.Order.order_id).all() == [(100,)]
+    assert [i for i, in db.query(models.DeliveryHours.order_id)] == [100]
+
+
+def test_import_malformed_json(client, db):
+    data = body([generate_order(order_id=i) for i in range(1, 4)])
+
+    response = client.post('/orders/import', data=data[:-10])
+
+    assert response.status_code == 400
+    assert db.query(models.Order).count() == 0
+
+
+@pytest.mark.parametrize('data', ['{}', '[]', '{"data": 5}', '{"other": [1]}',
+                                  '{"data": {"item": {"order_id": 1}}}'])
+@pytest.mark.parametrize('url', ['/orders/import', '/couriers/import'])
+def test_import_without_data_array(client, url, data):
+    assert client.post(url, data=data).status_code == 400
+
+
+def test_import_empty(client):
+    response = client.post('/orders/import', data='{"data": []}')
+    assert response.status_code == 201
+    assert response.json() == {'orders': []}
@@ -0,0 +1,184 @@
+import datetime
+import json
+import time
+
+import cache
+import crud
+import pytest
+from sqlalchemy import func, select
+
+from .test_base import client, db, postgres, queries
+from .utils import Clock, generate_courier, generate_order
+
+
+@pytest.fixture
+def courier_cache(monkeypatch):
+    courier_cache = cache.LRUCache(100, 60)
+    monkeypatch.setattr(cache, 'couriers', courier_cache)
+    return courier_cache
+
+
+def test_lru_eviction_and_ttl():
+    clock = Clock()
+    lru = cache.LRUCache(2, 10, clock=clock)
+    lru.put(1, 'a')
+    lru.put(2, 'b')
+    assert lru.get(1) == 'a'
+
+    # Вытесняется запись, к которой дольше всего не обращались
+    lru.put(3, 'c')
+    assert lru.get(2) is None
+    assert lru.get(1) == 'a'
+
+    clock.now = 10
+    assert lru.get(3) is None
+    assert lru.stats() == {'size': 1, 'hits': 2, 'misses': 2, 'evictions': 1,
+                           'expirations': 1, 'invalidations': 0}
+
+
+def test_load_racing_with_invalidation():
+    lru = cache.LRUCache(10, 60)
+
+    def load():
+        # Курьера изменили, пока мы читали его из базы
+        lru.invalidate([1])
+        return 'old'
+
+    assert lru.get_or_load(1, load) == 'old'
+    assert lru.get(1) is None
+
+    def load_and_clear():
+        lru.clear()
+        return 'old'
+
+    assert lru.get_or_load(2, load_and_clear) == 'old'
+    assert lru.get(2) is None
+
+    assert lru.get_or_load(1, lambda: 'new') == 'new'
+    assert lru.get(1) == 'new'
+
+
+def test_versions_are_bounded():
+    lru = cache.LRUCache(2, 60)
+    version = lru.version(1)
+    lru.invalidate(range(100))
+    assert len(lru._versions) == 2
+
+    # Загрузка, начатая до сброса уже вытесненного ключа, не попадает в кэш
+    lru.put(1, 'old', version)
+    assert lru.get(1) is None
+    lru.put(1, 'new', lru.version(1))
+    assert lru.get(1) == 'new'
+
+
+def post_courier(client):
+    response = client.post('/couriers', data=json.dumps({'data': [generate_courier(
+        courier_id=1, courier_type='foot', regions=[1],
+        working_hours=['09:00-18:00'])]}))
+    assert response.status_code == 201
+
+
+def test_get_courier_from_cache(client, queries, courier_cache):
+    post_courier(client)
+
+    first = client.get('/couriers/1').json()
+    with queries.capture():
+        assert client.get('/couriers/1').json() == first
+    assert len(queries) == 0
+    assert courier_cache.stats()['hits'] == 1
+
+    # Версию для If-None-Match тоже берем из кэша
+    etag = client.get('/couriers/1').headers['ETag']
+    with queries.capture():
+        response = client.get('/couriers/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert len(queries) == 0
+
+    # Несуществующий курьер не кэшируется
+    assert client.get('/couriers/2').status_code == 400
+    assert len(courier_cache) == 1
+
+    # Запрос с устаревшим ETag мимо кэша — один промах, а не два
+    courier_cache.clear()
+    misses = courier_cache.stats()['misses']
+    response = client.get('/couriers/1', headers={'If-None-Match': '"0"'})
+    assert response.status_code == 200
+    assert courier_cache.stats()['misses'] == misses + 1
+    assert len(courier_cache) == 1
+
+
+def test_invalidation_on_change(client, db, courier_cache):
+    post_courier(client)
+    client.post('/orders', data=json.dumps({'data': [generate_order(
+        order_id=i, weight=1, region=1, delivery_hours=['10:00-11:00'])
+        for i in (1, 2)]}))
+
+    def cached():
+        client.get('/couriers/1')
+        return 1 in courier_cache._data
+
+    assert cached()
+    response = client.patch('/couriers/1', data=json.dumps({'regions': [1, 2]}))
+    assert response.status_code == 200
+    assert 1 not in courier_cache._data
+    assert client.get('/couriers/1').json()['regions'] == [1, 2]
+
+    client.post('/orders/assign', data=json.dumps({'courier_id': 1}))
+    assert 1 not in courier_cache._data
+
+    # Повторное назначение без новых заказов курьера не меняет
+    assert cached()
+    client.post('/orders/assign', data=json.dumps({'courier_id': 1}))
+    assert 1 in courier_cache._data
+
+    response = client.post('/orders/complete', data=json.dumps({
+        'courier_id': 1, 'order_id': 1,
+        'complete_time': crud.format_time(
+            datetime.datetime.now(datetime.timezone.utc))}))
+    assert response.status_code == 200
+    assert 1 not in courier_cache._data
+    assert 'rating' in client.get('/couriers/1').json()
+
+    assert cached()
+    crud.backfill_courier_stats(db)
+    assert len(courier_cache) == 0
+
+
+def test_rollback_keeps_cache(db, courier_cache):
+    courier_cache.put(1, 'cached')
+    cache.courier_changed(db, [1])
+    db.rollback()
+    assert courier_cache.get(1) == 'cached'
+
+
+def test_invalidation_from_other_workers(postgres, db, courier_cache):
+    listener = cache.Listener(postgres.kw['bind'], poll_interval=0.05)
+    listener.start()
+    try:
+        assert listener.listening.wait(5)
+        courier_cache.put(1, 'a')
+        courier_cache.put(2, 'b')
+        courier_cache.put(3, 'c')
+
+        # Уведомления другого воркера приходят только после коммита
+        db.execute(select([func.pg_notify(cache.CHANNEL, '1,2')]))
+        time.sleep(0.2)
+        assert len(courier_cache) == 3
+        db.commit()
+
+        for _ in range(100):
+            if len(courier_cache) == 1:
+                break
+            time.sleep(0.05)
+        assert courier_cache.get(3) == 'c'
+        assert courier_cache.get(1) is None
+
+        db.execute(select([func.pg_notify(cache.CHANNEL, '*')]))
+        db.commit()
+        for _ in range(100):
+            if not len(courier_cache):
+                break
+            time.sleep(0.05)
+        assert len(courier_cache) == 0
+    finally:
+        listener.stop()
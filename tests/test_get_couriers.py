@@ -1,9 +1,12 @@
+import datetime
 import json
 
+import crud
+import models
 import pytest
 
-from .test_base import client, postgres
-from .utils import generate_courier
+from .test_base import client, db, postgres
+from .utils import generate_courier, generate_order
 
 
 @pytest.mark.parametrize(
@@ -19,3 +22,96 @@ def test_get_couriers(client, courier):
 
     assert response.status_code == 200
     assert response.json() == courier
+
+
+def complete_orders(client, courier):
+    client.post('/couriers', data=json.dumps({'data': [courier]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i,
+                       weight=1,
+                       region=courier['regions'][0],
+                       delivery_hours=courier['working_hours'])
+        for i in range(1, 4)
+    ]}))
+    client.post('/orders/assign',
+                data=json.dumps({'courier_id': courier['courier_id']}))
+    for i in range(1, 3):
+        response = client.post('/orders/complete', data=json.dumps({
+            'courier_id': courier['courier_id'],
+            'order_id': i,
+            'complete_time': crud.format_time(datetime.datetime.now(datetime.timezone.utc)),
+        }))
+        assert response.status_code == 200
+
+
+def test_get_couriers_rating(client):
+    courier = generate_courier(courier_id=1, courier_type='car')
+    complete_orders(client, courier)
+
+    response = client.get('/couriers/1')
+
+    assert response.status_code == 200
+    assert response.json()['earnings'] == 2 * 500 * 9
+    assert 0 <= response.json()['rating'] <= 5
+
+
+def test_backfill_courier_stats(client, db):
+    courier = generate_courier(courier_id=1, courier_type='bike')
+    complete_orders(client, courier)
+    expected = client.get('/couriers/1').json()
+
+    db.query(models.CourierStats).delete()
+    db.commit()
+    assert 'earnings' not in client.get('/couriers/1').json()
+
+    assert crud.backfill_courier_stats(db) == 1
+    assert client.get('/couriers/1').json() == expected
+
+
+def test_get_courier_etag(client):
+    courier = generate_courier(courier_id=1, courier_type='foot', regions=[1],
+                               working_hours=['09:00-18:00'])
+    client.post('/couriers', data=json.dumps({'data': [courier]}))
+
+    def etag():
+        response = client.get('/couriers/1')
+        assert response.status_code == 200
+        return response.headers['ETag']
+
+    def not_modified(tag):
+        return client.get('/couriers/1', headers={'If-None-Match': tag}).status_code == 304
+
+    tag = etag()
+    response = client.get('/couriers/1', headers={'If-None-Match': tag})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['ETag'] == tag
+    assert not_modified(f'"0", W/{tag}')
+    assert not_modified('*')
+    assert not not_modified('"0"')
+
+    # Версия растет после каждого изменения курьера
+    client.patch('/couriers/1', data=json.dumps({'regions': [1, 2]}))
+    assert not not_modified(tag)
+    tag = etag()
+
+    client.post('/orders', data=json.dumps({'data': [generate_order(
+        order_id=1, weight=1, region=1, delivery_hours=['10:00-11:00'])]}))
+    client.post('/orders/assign', data=json.dumps({'courier_id': 1}))
+    assert not not_modified(tag)
+    tag = etag()
+
+    # Назначение без новых заказов курьера не меняет
+    client.post('/orders/assign', data=json.dumps({'courier_id': 1}))
+    assert not_modified(tag)
+
+    client.post('/orders/complete', data=json.dumps({
+        'courier_id': 1, 'order_id': 1,
+        'complete_time': crud.format_time(
+            datetime.datetime.now(datetime.timezone.utc))}))
+    assert not not_modified(tag)
+    assert 'rating' in client.get('/couriers/1', headers={'If-None-Match': tag}).json()
+
+    # Несуществующий курьер
+    response = client.get('/couriers/2', headers={'If-None-Match': tag})
+    assert response.status_code == 400
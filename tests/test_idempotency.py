@@ -0,0 +1,185 @@
+import datetime
+import json
+
+import crud
+import idempotency
+import models
+import order_index
+import pytest
+import schemas
+from sqlalchemy import update
+
+from .test_base import client, db, postgres
+from .utils import generate_courier, generate_order
+
+
+def prepare(client, orders=range(1, 4)):
+    client.post('/couriers', data=json.dumps({'data': [generate_courier(
+        courier_id=1, courier_type='car', regions=[1],
+        working_hours=['09:00-18:00'])]}))
+    post_orders(client, orders)
+
+
+def post_orders(client, orders):
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=1, region=1,
+                       delivery_hours=['10:00-11:00'])
+        for i in orders]}))
+
+
+def assign(client, key, courier_id=1):
+    return client.post('/orders/assign', data=json.dumps({'courier_id': courier_id}),
+                       headers={'Idempotency-Key': key})
+
+
+def complete(client, key, order_id=1):
+    return client.post('/orders/complete', data=json.dumps({
+        'courier_id': 1, 'order_id': order_id,
+        'complete_time': '2021-01-10T10:33:01.42Z'}),
+        headers={'Idempotency-Key': key})
+
+
+def test_assign_retry(client):
+    prepare(client)
+    first = assign(client, 'a1')
+    assert first.status_code == 200
+    assert len(first.json()['orders']) == 3
+
+    # Повтор возвращает тот же ответ, даже если появились новые заказы
+    post_orders(client, [4])
+    retry = assign(client, 'a1')
+    assert retry.status_code == 200
+    assert retry.content == first.content
+    assert retry.headers['content-type'] == first.headers['content-type']
+
+    # Новый ключ — новый запрос
+    assert assign(client, 'a2').json()['orders'] == [{'id': 4}]
+
+
+def test_complete_retry(client):
+    prepare(client)
+    assign(client, 'a1')
+
+    first = complete(client, 'c1')
+    assert first.status_code == 200
+    assert first.json() == {'order_id': 1}
+    assert complete(client, 'c1').json() == {'order_id': 1}
+
+    # Без ключа повтор — уже ошибка: заказ завершен
+    response = client.post('/orders/complete', data=json.dumps({
+        'courier_id': 1, 'order_id': 1,
+        'complete_time': '2021-01-10T10:33:01.42Z'}))
+    assert response.status_code == 400
+
+    # Ошибочный ответ тоже сохраняется
+    assert complete(client, 'c2', order_id=100).status_code == 400
+    assign(client, 'a2')
+    assert complete(client, 'c2', order_id=100).status_code == 400
+
+
+def test_key_reused_with_other_request(client):
+    prepare(client)
+    assert assign(client, 'k').status_code == 200
+    # Тот же ключ с другим телом или на другом маршруте
+    assert assign(client, 'k', courier_id=2).status_code == 422
+    assert complete(client, 'k').status_code == 200
+
+
+def test_key_in_progress(client, db):
+    prepare(client)
+    db.execute(idempotency.keys.insert().values(
+        key='k', route='POST /orders/assign',
+        fingerprint=idempotency._fingerprint(
+            schemas.OrderAssign(courier_id=1))))
+    db.commit()
+    assert assign(client, 'k').status_code == 409
+
+    # Брошенный ключ через IDEMPOTENCY_LOCK_TIMEOUT можно занять заново
+    db.execute(update(idempotency.keys).values(
+        created_at=datetime.datetime.now(datetime.timezone.utc)
+        - datetime.timedelta(minutes=5)))
+    db.commit()
+    assert assign(client, 'k').status_code == 200
+
+
+def test_failed_request_releases_key(client, db, monkeypatch):
+    prepare(client)
+    assign(client, 'a1')
+
+    def fail(db, complete):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(crud, 'orders_complete', fail)
+    with pytest.raises(RuntimeError):
+        complete(client, 'c1')
+    assert db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.key == 'c1').count() == 0
+
+    monkeypatch.undo()
+    assert complete(client, 'c1').status_code == 200
+
+
+def test_response_saved_with_changes(client, db, monkeypatch):
+    prepare(client)
+
+    def fail(*args):
+        raise RuntimeError('boom')
+
+    # Ответ не сохранился — не сохранилось и назначение
+    monkeypatch.setattr(idempotency, '_save', fail)
+    with pytest.raises(RuntimeError):
+        assign(client, 'a1')
+    assert db.query(models.CouriersOrders).count() == 0
+    assert db.query(models.IdempotencyKey).count() == 0
+
+    monkeypatch.undo()
+    assert len(assign(client, 'a1').json()['orders']) == 3
+
+
+@pytest.mark.parametrize('save', ['fail', 'taken over'])
+def test_rollback_restores_order_index(client, db, monkeypatch, save):
+    index = order_index.OpenOrderIndex(enabled=True)
+    monkeypatch.setattr(order_index, 'index', index)
+    prepare(client)
+    index.load(db)
+
+    def fail(*args):
+        raise RuntimeError('boom')
+
+    # Индекс отдал заказы назначению, но транзакция откатилась
+    with monkeypatch.context() as m:
+        if save == 'fail':
+            m.setattr(idempotency, '_save', fail)
+            with pytest.raises(RuntimeError):
+                assign(client, 'a1')
+        else:
+            m.setattr(idempotency, '_save', lambda *args: False)
+            assert assign(client, 'a1').status_code == 409
+    assert index.verify(db)['missing'] == []
+    assert len(index) == 3
+
+    assert len(assign(client, 'a2').json()['orders']) == 3
+    assert len(index) == 0
+
+
+def test_purge(client, db):
+    prepare(client)
+    assign(client, 'old')
+    assign(client, 'new')
+    db.execute(update(idempotency.keys).where(
+        idempotency.keys.c.key == 'old'
+    ).values(created_at=datetime.datetime.now(datetime.timezone.utc)
+             - datetime.timedelta(days=2)))
+    db.commit()
+
+    # Истекший ключ уже не действует, даже если еще не удален
+    post_orders(client, [4])
+    assert assign(client, 'old').json()['orders'] == [{'id': 4}]
+
+    db.execute(update(idempotency.keys).where(
+        idempotency.keys.c.key == 'old'
+    ).values(created_at=datetime.datetime.now(datetime.timezone.utc)
+             - datetime.timedelta(days=2)))
+    db.commit()
+    assert idempotency.purge(db) == 1
+    assert [i for i, in db.query(models.IdempotencyKey.key)] == ['new']
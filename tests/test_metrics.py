@@ -0,0 +1,73 @@
+import json
+import multiprocessing
+
+import database
+import models
+from fastapi.testclient import TestClient
+
+from .test_base import client, postgres
+from .utils import generate_courier
+
+
+def test_metrics(client: TestClient):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+
+    lines = response.text.splitlines()
+    for name in ('db_pool_size', 'db_pool_max_overflow', 'db_pool_checked_out',
+                 'db_pool_idle', 'db_pool_overflow'):
+        assert f'# TYPE {name} gauge' in lines
+        assert any(i.startswith(name + '{engine="sync",pid=') for i in lines)
+
+
+def read_range(queue):
+    with database.engine.connect() as conn:
+        value = conn.execute("SELECT '[10:00,11:00]'::timerange").scalar()
+    queue.put(type(value).__name__)
+
+
+def test_timerange_registered_after_fork():
+    # Подключение открыто до fork и лежит в пуле
+    read_range(multiprocessing.Queue())
+
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=read_range, args=(queue,))
+    process.start()
+    process.join()
+
+    assert process.exitcode == 0
+    assert queue.get(timeout=5) == models.TimeRange.__name__
+
+
+def sample(client: TestClient, prefix: str) -> float:
+    lines = client.get('/metrics').text.splitlines()
+    return sum(float(i.split()[-1]) for i in lines if i.startswith(prefix))
+
+
+def test_request_metrics(client: TestClient):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=i) for i in range(1, 4)]}))
+
+    # Маршрут подписан шаблоном пути, а не самим путем. Метрики общие
+    # на процесс, поэтому смотрим на прирост
+    labels = 'method="PATCH",route="/couriers/{courier_id}"'
+    names = [
+        f'http_request_db_statements_count{{{labels}',
+        f'http_request_db_statements_sum{{{labels}',
+        f'http_request_db_seconds_sum{{{labels}',
+        f'http_request_duration_seconds_bucket{{{labels},status="200",le="+Inf"',
+    ]
+    before = [sample(client, i) for i in names]
+    client.patch('/couriers/1', data=json.dumps({'regions': [1]}))
+    after = [sample(client, i) for i in names]
+
+    count, statements, db_time, requests = [a - b for a, b in zip(after, before)]
+    assert count == 1
+    assert statements > 0
+    assert db_time > 0
+    assert requests == 1
+
+    assert '# TYPE http_request_duration_seconds histogram' in \
+        client.get('/metrics').text.splitlines()
@@ -1,5 +1,6 @@
 import json
 
+import assignment
 from fastapi.testclient import TestClient
 
 from .test_base import client, postgres
@@ -36,3 +37,132 @@ def test_order_assign(client: TestClient):
 
     assert response.status_code == 200
     assert response.json()['orders'] == [{'id': 4}]
+
+
+def test_order_assign_capacity_and_schedule(client: TestClient):
+    response = client.post(
+        '/couriers',
+        data=json.dumps({
+            'data': [generate_courier(courier_id=1,
+                                      courier_type='foot',
+                                      regions=[1],
+                                      working_hours=['09:00-12:00'])]
+        }))
+    assert response.status_code == 201
+
+    response = client.post(
+        '/orders',
+        data=json.dumps({
+            'data': [generate_order(order_id=i,
+                                    weight=3,
+                                    region=1,
+                                    delivery_hours=['10:00-11:00'])
+                     for i in range(1, 5)] + [
+                # Окно доставки только касается графика курьера
+                generate_order(order_id=5,
+                               weight=0.5,
+                               region=1,
+                               delivery_hours=['12:00-13:00']),
+                # Регион, в котором курьер не работает
+                generate_order(order_id=6,
+                               weight=0.5,
+                               region=2,
+                               delivery_hours=['10:00-11:00']),
+            ]
+        }))
+    assert response.status_code == 201
+
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+
+    assert response.status_code == 200
+    assert response.json()['orders'] == [{'id': 1}, {'id': 2}, {'id': 3}]
+    assert response.json()['assign_time']
+
+    # Больше ничего не помещается
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+
+    assert response.status_code == 200
+    assert response.json() == {'orders': []}
+
+
+def test_order_assign_knapsack(client: TestClient, monkeypatch):
+    monkeypatch.setattr(assignment, 'strategy',
+                        assignment.KnapsackStrategy('weight'))
+
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1, courier_type='foot', regions=[1],
+                         working_hours=['09:00-18:00'])
+    ]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=w, region=1,
+                       delivery_hours=['10:00-11:00'])
+        for i, w in enumerate([3, 3, 3, 5, 5], 1)
+    ]}))
+
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+
+    assert response.status_code == 200
+    assert response.json()['orders'] == [{'id': 4}, {'id': 5}]
+
+
+def test_order_assign_batch(client: TestClient):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1, courier_type='foot', regions=[1, 2],
+                         working_hours=['09:00-18:00']),
+        generate_courier(courier_id=2, courier_type='foot', regions=[1, 1],
+                         working_hours=['09:00-18:00']),
+        # Работает вечером, утренние заказы ему не подходят
+        generate_courier(courier_id=3, courier_type='car', regions=[1, 2],
+                         working_hours=['19:00-21:00']),
+    ]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=5, region=r,
+                       delivery_hours=['10:00-11:00'])
+        for i, r in enumerate([1, 1, 2, 2], 1)
+    ]}))
+
+    # По очереди первый курьер забрал бы заказы 1 и 2, и второму
+    # ничего бы не досталось
+    response = client.post('/orders/assign/batch',
+                           data=json.dumps({'courier_ids': [1, 2, 3]}))
+
+    assert response.status_code == 200
+    couriers = response.json()['couriers']
+    assert [i['courier_id'] for i in couriers] == [1, 2, 3]
+    assert couriers[0]['orders'] == [{'id': 3}, {'id': 4}]
+    assert couriers[1]['orders'] == [{'id': 1}, {'id': 2}]
+    assert couriers[0]['assign_time'] == couriers[1]['assign_time']
+    assert couriers[2] == {'courier_id': 3, 'orders': []}
+
+    # Назначения сохранены: заказы заняты, курьеры загружены
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 2}))
+    assert response.json() == {'orders': []}
+    response = client.post('/orders/complete', data=json.dumps({
+        'courier_id': 2, 'order_id': 1,
+        'complete_time': '2021-01-10T10:33:01.42Z'}))
+    assert response.status_code == 200
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 3}))
+    assert response.json() == {'orders': []}
+
+
+def test_order_assign_batch_invalid(client: TestClient):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1),
+    ]}))
+
+    response = client.post('/orders/assign/batch',
+                           data=json.dumps({'courier_ids': [1, 2]}))
+    assert response.status_code == 400
+
+    response = client.post('/orders/assign/batch',
+                           data=json.dumps({'courier_ids': []}))
+    assert response.status_code == 400
+
+    response = client.post('/orders/assign/batch',
+                           data=json.dumps({'courier_ids': [0]}))
+    assert response.status_code == 400
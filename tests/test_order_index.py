@@ -0,0 +1,157 @@
+import datetime
+import json
+
+import order_index
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from .test_base import client, db, postgres
+from .utils import generate_courier, generate_order
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = order_index.OpenOrderIndex(enabled=True)
+    monkeypatch.setattr(order_index, 'index', index)
+    monkeypatch.setattr(order_index, 'ORDER_INDEX_CHECK', 'on')
+    return index
+
+
+def check(client: TestClient):
+    response = client.get('/internal/order-index')
+    assert response.status_code == 200
+    assert response.json()['missing'] == []
+    assert response.json()['stale'] == []
+    return response.json()
+
+
+def test_check_disabled_by_default(client: TestClient):
+    assert client.get('/internal/order-index').status_code == 404
+
+
+def test_candidates():
+    def t(hours):
+        return datetime.time(hours)
+
+    index = order_index.OpenOrderIndex(enabled=True)
+    index.loaded = True
+    index.add([
+        order_index.OpenOrder(1, 5, 1, ((t(10), t(11)),)),
+        order_index.OpenOrder(2, 1, 1, ((t(10), t(11)),)),
+        # Касается графика только границей
+        order_index.OpenOrder(3, 1, 1, ((t(12), t(13)),)),
+        order_index.OpenOrder(4, 2, 2, ((t(9), t(10)), (t(11), t(12)))),
+        order_index.OpenOrder(5, 20, 2, ((t(10), t(11)),)),
+    ])
+
+    candidates = index.candidates([1, 2], [(t(10), t(12))], 10)
+    assert [i.order_id for i in candidates] == [2, 4, 1]
+
+    index.discard([2])
+    assert [i.order_id for i in index.candidates([1], [(t(10), t(12))], 10)] == [1]
+
+
+def test_order_index_workflow(client: TestClient, index):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1, courier_type='car', regions=[1, 2],
+                         working_hours=['09:00-18:00']),
+    ]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=i, region=1 + i % 2,
+                       delivery_hours=['10:00-11:00'])
+        for i in range(1, 7)
+    ]}))
+
+    # Индекс загружается при первом назначении
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+    assert response.json()['orders'] == [{'id': i} for i in range(1, 7)]
+    assert index.loaded
+
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=7, weight=1, region=1,
+                       delivery_hours=['10:00-11:00']),
+    ]}))
+    assert check(client)['orders'] == 1
+
+    # Заказы, снятые с курьера, снова попадают в индекс
+    client.patch('/couriers/1', data=json.dumps({'regions': [1]}))
+    assert check(client)['orders'] == 4
+
+    response = client.post('/orders/complete', data=json.dumps({
+        'courier_id': 1, 'order_id': 2,
+        'complete_time': '2021-01-10T10:33:01.42Z'}))
+    assert response.status_code == 200
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+    assert response.json()['orders'] == [{'id': 7}]
+    assert check(client)['orders'] == 3
+
+
+def test_order_index_stale(client: TestClient, db, index):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1, courier_type='foot', regions=[1],
+                         working_hours=['09:00-18:00']),
+    ]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=1, region=1,
+                       delivery_hours=['10:00-11:00'])
+        for i in range(1, 4)
+    ]}))
+    index.load(db)
+
+    # Заказ взят другим процессом в обход индекса
+    db.execute('UPDATE orders SET taken = true WHERE order_id = 1')
+    db.commit()
+    assert client.get('/internal/order-index').json()['stale'] == [1]
+
+    # Назначение замечает расхождение и берет заказы из базы
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+    assert response.json()['orders'] == [{'id': 2}, {'id': 3}]
+    assert check(client)['orders'] == 0
+
+
+def test_orders_from_other_workers(client: TestClient, db, index, monkeypatch):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1, courier_type='foot', regions=[1],
+                         working_hours=['09:00-18:00']),
+    ]}))
+    index.load(db)
+
+    # Заказ загружен другим процессом, в индекс этого он не попал
+    other = order_index.OpenOrderIndex(enabled=True)
+    other.loaded = True
+    with monkeypatch.context() as m:
+        m.setattr(order_index, 'index', other)
+        client.post('/orders', data=json.dumps({'data': [
+            generate_order(order_id=1, weight=1, region=1,
+                           delivery_hours=['10:00-11:00'])]}))
+    assert index.verify(db)['missing'] == [1]
+
+    # В индексе ничего не нашлось: назначение ищет заказы в базе
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+    assert response.json()['orders'] == [{'id': 1}]
+
+
+def test_load_open_orders_many_ids(client: TestClient, db):
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=1, weight=1, region=1,
+                       delivery_hours=['10:00-11:00'])]}))
+
+    params = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        params.append(parameters)
+
+    # Больше id, чем asyncpg разрешает параметров в одном запросе
+    event.listen(db.get_bind(), 'before_cursor_execute', before_execute)
+    try:
+        orders = order_index.load_open_orders(db, [1] + list(range(100, 40000)))
+    finally:
+        event.remove(db.get_bind(), 'before_cursor_execute', before_execute)
+    assert [i.order_id for i in orders] == [1]
+    # Все id уходят одним параметром-массивом
+    assert [len(i) for i in params] == [1, 1]
@@ -1,7 +1,10 @@
 import datetime
 import json
 
-from .test_base import client, postgres
+import crud
+import models
+
+from .test_base import client, db, postgres
 from .utils import generate_courier, generate_order
 
 
@@ -41,8 +44,63 @@ def test_order_complete(client):
         data=json.dumps({
             'courier_id': 1,
             'order_id': 4,
-            'complete_time': datetime.datetime.now().isoformat('T')+'Z'
+            'complete_time': crud.format_time(datetime.datetime.now(datetime.timezone.utc))
         }))
 
     assert response.status_code == 200
     assert response.json() == {'order_id': 4}
+
+
+def test_order_complete_delivery_time(client):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1, regions=[1], working_hours=['00:00-23:59'])
+    ]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=1, region=1,
+                       delivery_hours=['00:00-23:59'])
+        for i in (1, 2)
+    ]}))
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+    assign_time = crud.parse_time(response.json()['assign_time'])
+
+    # Первый заказ — через 20 минут после назначения,
+    # второй — через 10 минут после первого
+    for order_id, minutes in ((1, 20), (2, 30)):
+        complete_time = assign_time + datetime.timedelta(minutes=minutes)
+        response = client.post('/orders/complete', data=json.dumps({
+            'courier_id': 1,
+            'order_id': order_id,
+            'complete_time': crud.format_time(complete_time),
+        }))
+        assert response.status_code == 200
+
+    # Среднее время доставки 15 минут
+    response = client.get('/couriers/1')
+    assert response.json()['rating'] == 3.75
+
+
+def test_order_complete_out_of_order(client, db):
+    client.post('/couriers', data=json.dumps({'data': [generate_courier(
+        courier_id=1, courier_type='car', regions=[1],
+        working_hours=['00:00-23:59'])]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=1, region=1,
+                       delivery_hours=['00:00-23:59'])
+        for i in (1, 2)]}))
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': 1}))
+    assign_time = crud.parse_time(response.json()['assign_time'])
+
+    # Второй заказ завершен позже первого, но сообщили о нем раньше
+    for order_id, minutes in ((2, 30), (1, 20)):
+        response = client.post('/orders/complete', data=json.dumps({
+            'courier_id': 1,
+            'order_id': order_id,
+            'complete_time': crud.format_time(
+                assign_time + datetime.timedelta(minutes=minutes)),
+        }))
+        assert response.status_code == 200
+
+    courier = db.query(models.Courier).get(1)
+    assert courier.last_complete_time == assign_time + datetime.timedelta(minutes=30)
@@ -1,11 +1,12 @@
 import json
 from random import randint
 
+import models
 import pytest
 from fastapi.testclient import TestClient
 
-from .test_base import client, postgres
-from .utils import generate_courier
+from .test_base import client, db, postgres
+from .utils import generate_courier, generate_order
 
 
 @pytest.mark.parametrize(
@@ -56,3 +57,48 @@ def test_change_courier_working_hours(client: TestClient, wh):
         '/couriers/1', data=json.dumps({'working_hours': wh}))
 
     assert response.json()['working_hours'] == wh
+
+
+def test_patch_releases_unfitting_orders(client: TestClient, db):
+    client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=1, courier_type='car', regions=[1, 2],
+                         working_hours=['09:00-18:00'])]}))
+    client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=1, weight=10, region=1,
+                       delivery_hours=['10:00-11:00']),
+        generate_order(order_id=2, weight=10, region=2,
+                       delivery_hours=['10:00-11:00']),
+        generate_order(order_id=3, weight=5, region=1,
+                       delivery_hours=['16:00-17:00']),
+        # Подходит по одному из двух промежутков доставки
+        generate_order(order_id=4, weight=3, region=1,
+                       delivery_hours=['08:00-09:30', '17:00-18:00']),
+        generate_order(order_id=5, weight=8, region=1,
+                       delivery_hours=['10:00-11:00']),
+    ]}))
+    response = client.post('/orders/assign', data=json.dumps({'courier_id': 1}))
+    assert len(response.json()['orders']) == 5
+
+    def open_orders():
+        return sorted(i for i, in db.query(models.CouriersOrders.order_id))
+
+    def taken():
+        return sorted(i for i, in db.query(models.Order.order_id).filter(
+            models.Order.taken == True))
+
+    def weight():
+        db.expire_all()
+        return db.query(models.Courier).get(1).orders_weight
+
+    client.patch('/couriers/1', data=json.dumps({'regions': [1]}))
+    assert open_orders() == taken() == [1, 3, 4, 5]
+    assert weight() == 26
+
+    client.patch('/couriers/1', data=json.dumps({'working_hours': ['09:00-12:00']}))
+    assert open_orders() == taken() == [1, 4, 5]
+    assert weight() == 21
+
+    # Остаются самые легкие заказы, которые помещаются
+    client.patch('/couriers/1', data=json.dumps({'courier_type': 'foot'}))
+    assert open_orders() == taken() == [4]
+    assert weight() == 3
@@ -29,3 +29,33 @@ def test_post_couriers_negative(client, courier):
     response = client.post('/couriers', data=json.dumps({'data': [courier]}))
 
     assert response.status_code == 400
+
+
+def test_post_couriers_bulk(client):
+    couriers = [generate_courier(courier_id=i) for i in range(1, 1501)]
+    response = client.post('/couriers', data=json.dumps({'data': couriers}))
+
+    assert response.status_code == 201
+    assert response.json() == {
+        'couriers': [{'id': i['courier_id']} for i in couriers]}
+
+    for courier in (couriers[0], couriers[-1]):
+        response = client.get(f'/couriers/{courier["courier_id"]}')
+        assert response.json() == courier
+
+
+def test_post_couriers_conflicts(client):
+    response = client.post(
+        '/couriers', data=json.dumps({'data': [generate_courier(courier_id=1)]}))
+    assert response.status_code == 201
+
+    couriers = [generate_courier(courier_id=i) for i in (3, 1, 2, 3)]
+    response = client.post('/couriers', data=json.dumps({'data': couriers}))
+
+    assert response.status_code == 400
+    assert response.text == str(
+        {'validation_error': {'couriers': [{'id': 1}, {'id': 3}]}})
+
+    # Ничего из отклоненного запроса не записалось
+    response = client.get('/couriers/2')
+    assert response.status_code == 400
@@ -1,8 +1,10 @@
 import json
 
+import crud
+import models
 import pytest
 
-from .test_base import client, postgres
+from .test_base import client, db, postgres
 from .utils import generate_order
 
 
@@ -30,3 +32,39 @@ def test_post_orders_negative(client, order):
 
     assert response.status_code == 400
 
+
+@pytest.mark.parametrize('mode', ['copy', 'rows'])
+def test_post_orders_bulk(client, db, monkeypatch, mode):
+    monkeypatch.setattr(crud, 'ORDERS_IMPORT_MODE', mode)
+    monkeypatch.setattr(crud, 'ORDERS_COPY_CHUNK_SIZE', 7)
+
+    orders = [generate_order(order_id=i) for i in range(1, 51)]
+    response = client.post('/orders', data=json.dumps({'data': orders}))
+
+    assert response.status_code == 201
+    assert response.json() == {'orders': [{'id': i['order_id']} for i in orders]}
+
+    # Заказы и их промежутки доставки записаны в обоих режимах
+    assert sorted(db.query(models.Order.order_id, models.Order.weight,
+                           models.Order.region)) == [
+        (i['order_id'], i['weight'], i['region']) for i in orders]
+    assert db.query(models.DeliveryHours).count() == sum(
+        len(i['delivery_hours']) for i in orders)
+
+    # Повторный импорт уже загруженного заказа отклоняется
+    response = client.post('/orders', data=json.dumps({'data': orders[-1:]}))
+
+    assert response.status_code == 400
+
+
+def test_post_orders_conflicts(client):
+    response = client.post(
+        '/orders', data=json.dumps({'data': [generate_order(order_id=1)]}))
+    assert response.status_code == 201
+
+    orders = [generate_order(order_id=i) for i in (3, 1, 2, 3)]
+    response = client.post('/orders', data=json.dumps({'data': orders}))
+
+    assert response.status_code == 400
+    assert response.text == str(
+        {'validation_error': {'orders': [{'id': 1}, {'id': 3}]}})
@@ -0,0 +1,208 @@
+"""
+Бюджеты SQL-запросов для каждого обработчика из main.py.
+
+Число запросов не должно зависеть от размера запроса и от того, сколько
+заказов у курьера: каждый обработчик проверяется на маленьком и большом
+наборе данных с одним и тем же бюджетом. Если тест упал — скорее всего,
+в crud.py появился запрос в цикле (N+1).
+
+COPY в обход SQLAlchemy (импорт заказов) в счетчик не попадает.
+"""
+import json
+
+import order_index
+import pytest
+from fastapi.testclient import TestClient
+
+from .test_base import client, postgres, queries
+from .utils import generate_courier, generate_order
+
+SIZES = [1, 100]
+
+BUDGETS = {
+    'POST /couriers': 4,
+    'PATCH /couriers/{courier_id}': 13,
+    'POST /orders': 1,
+    'POST /couriers/import': 4,
+    'POST /orders/import': 1,
+    'GET /couriers/{courier_id}': 5,
+    'GET /couriers/{courier_id} If-None-Match': 1,
+    'POST /orders/assign': 6,
+    'POST /orders/assign/batch': 6,
+    'POST /orders/complete': 7,
+    # Первый запрос с ключом: поиск, захват и сохранение ответа
+    'POST /orders/assign Idempotency-Key': 10,
+    'POST /orders/complete Idempotency-Key': 11,
+    # Повтор: только поиск ответа
+    'Idempotency-Key retry': 1,
+    'GET /internal/order-index': 2,
+    'GET /metrics': 0,
+}
+
+
+def post_couriers(client: TestClient, n: int, **kwargs):
+    response = client.post('/couriers', data=json.dumps({'data': [
+        generate_courier(courier_id=i, courier_type='car', regions=[1, 2],
+                         working_hours=['09:00-18:00'], **kwargs)
+        for i in range(1, n + 1)
+    ]}))
+    assert response.status_code == 201
+
+
+def post_orders(client: TestClient, n: int):
+    response = client.post('/orders', data=json.dumps({'data': [
+        generate_order(order_id=i, weight=0.1, region=1 + i % 2,
+                       delivery_hours=['10:00-11:00', '12:00-13:00'])
+        for i in range(1, n + 1)
+    ]}))
+    assert response.status_code == 201
+
+
+def assign(client: TestClient, courier_id: int = 1):
+    response = client.post('/orders/assign',
+                           data=json.dumps({'courier_id': courier_id}))
+    assert response.status_code == 200
+    return response.json()
+
+
+def check(queries, endpoint: str):
+    assert len(queries) <= BUDGETS[endpoint], '\n'.join(queries.statements)
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_post_couriers(client: TestClient, queries, n):
+    with queries.capture():
+        post_couriers(client, n)
+    check(queries, 'POST /couriers')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_patch_courier(client: TestClient, queries, n):
+    post_couriers(client, 1)
+    post_orders(client, n)
+    assign(client)
+
+    with queries.capture():
+        response = client.patch('/couriers/1', data=json.dumps({
+            'courier_type': 'foot',
+            'regions': [1, 3],
+            'working_hours': ['10:30-11:30'],
+        }))
+        assert response.status_code == 200
+    check(queries, 'PATCH /couriers/{courier_id}')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_post_orders(client: TestClient, queries, n):
+    with queries.capture():
+        post_orders(client, n)
+    check(queries, 'POST /orders')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_import(client: TestClient, queries, n):
+    with queries.capture():
+        response = client.post('/couriers/import', data=json.dumps({'data': [
+            generate_courier(courier_id=i) for i in range(1, n + 1)]}))
+        assert response.status_code == 201
+    check(queries, 'POST /couriers/import')
+
+    with queries.capture():
+        response = client.post('/orders/import', data=json.dumps({'data': [
+            generate_order(order_id=i) for i in range(1, n + 1)]}))
+        assert response.status_code == 201
+    check(queries, 'POST /orders/import')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_get_courier(client: TestClient, queries, n):
+    post_couriers(client, 1)
+    post_orders(client, n)
+    assign(client)
+    for i in range(1, n + 1):
+        client.post('/orders/complete', data=json.dumps({
+            'courier_id': 1, 'order_id': i,
+            'complete_time': '2021-01-10T10:33:01.42Z'}))
+
+    with queries.capture():
+        response = client.get('/couriers/1')
+        assert response.status_code == 200
+    check(queries, 'GET /couriers/{courier_id}')
+
+    with queries.capture():
+        response = client.get('/couriers/1', headers={
+            'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+    check(queries, 'GET /couriers/{courier_id} If-None-Match')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_orders_assign(client: TestClient, queries, n):
+    post_couriers(client, 1)
+    post_orders(client, n)
+
+    with queries.capture():
+        assert len(assign(client)['orders']) == n
+    check(queries, 'POST /orders/assign')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_orders_assign_batch(client: TestClient, queries, n):
+    post_couriers(client, n)
+    post_orders(client, n)
+
+    with queries.capture():
+        response = client.post('/orders/assign/batch', data=json.dumps({
+            'courier_ids': list(range(1, n + 1))}))
+        assert response.status_code == 200
+    check(queries, 'POST /orders/assign/batch')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_orders_complete(client: TestClient, queries, n):
+    post_couriers(client, 1)
+    post_orders(client, n)
+    assign(client)
+
+    with queries.capture():
+        response = client.post('/orders/complete', data=json.dumps({
+            'courier_id': 1, 'order_id': 1,
+            'complete_time': '2021-01-10T10:33:01.42Z'}))
+        assert response.status_code == 200
+    check(queries, 'POST /orders/complete')
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_idempotency_key(client: TestClient, queries, n):
+    post_couriers(client, 1)
+    post_orders(client, n)
+
+    requests = [
+        ('POST /orders/assign', '/orders/assign', {'courier_id': 1}),
+        ('POST /orders/complete', '/orders/complete', {
+            'courier_id': 1, 'order_id': 1,
+            'complete_time': '2021-01-10T10:33:01.42Z'}),
+    ]
+    for endpoint, url, body in requests:
+        with queries.capture():
+            response = client.post(url, data=json.dumps(body),
+                                   headers={'Idempotency-Key': 'key'})
+            assert response.status_code == 200
+        check(queries, f'{endpoint} Idempotency-Key')
+
+        with queries.capture():
+            retry = client.post(url, data=json.dumps(body),
+                                headers={'Idempotency-Key': 'key'})
+            assert retry.content == response.content
+        check(queries, 'Idempotency-Key retry')
+
+
+def test_internal_endpoints(client: TestClient, queries, monkeypatch):
+    monkeypatch.setattr(order_index, 'ORDER_INDEX_CHECK', 'on')
+    with queries.capture():
+        assert client.get('/metrics').status_code == 200
+    check(queries, 'GET /metrics')
+
+    with queries.capture():
+        assert client.get('/internal/order-index').status_code == 200
+    check(queries, 'GET /internal/order-index')
@@ -0,0 +1,116 @@
+import json
+
+import cache
+import crud
+import models
+import pytest
+import routing
+import schemas
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy_utils import create_database, drop_database
+from sqlalchemy_utils.functions.database import database_exists
+
+from ..main import app, get_db
+from .test_base import SQLALCHEMY_DATABASE_URL, client, postgres
+from .utils import Clock, generate_courier
+
+REPLICA_URL = SQLALCHEMY_DATABASE_URL + '_replica'
+
+
+@pytest.fixture
+def replica():
+    # Вторая база вместо настоящей реплики: в нее попадает только то,
+    # что тест скопирует сам, то есть она «отстает» сколько нужно
+    if database_exists(REPLICA_URL):
+        drop_database(REPLICA_URL)
+    create_database(REPLICA_URL)
+    engine = create_engine(REPLICA_URL)
+    engine.execute('create type timerange as range (subtype = time);')
+    models.Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+    drop_database(REPLICA_URL)
+
+
+@pytest.fixture
+def router(postgres, replica, monkeypatch):
+    clock = Clock()
+    router = routing.Router(postgres, replica, window=5, clock=clock)
+    router.clock = clock
+    monkeypatch.setattr(routing, 'router', router)
+    # Сессии выдает настоящий get_db
+    monkeypatch.delitem(app.dependency_overrides, get_db)
+    return router
+
+
+def courier(**kwargs):
+    return generate_courier(courier_id=1, courier_type='foot', regions=[1],
+                            working_hours=['09:00-18:00'], **kwargs)
+
+
+def replicate(replica, data):
+    db = replica()
+    try:
+        crud.write_couriers(db, [schemas.CourierBase(**data)])
+        db.commit()
+    finally:
+        db.close()
+
+
+def test_recent_writes():
+    clock = Clock()
+    recent = routing.RecentWrites(5, maxsize=2, clock=clock)
+    recent.mark([1])
+    clock.now = 3
+    recent.mark([2, 3])
+    # Лишние записи вытесняются, начиная с самых старых
+    assert 1 not in recent and 2 in recent and 3 in recent
+
+    clock.now = 8
+    assert 2 not in recent
+    recent.mark(None)
+    assert 4 in recent
+    clock.now = 13
+    assert 4 not in recent
+
+
+def test_read_your_writes(client, router, replica):
+    response = client.post('/couriers', data=json.dumps({'data': [courier()]}))
+    assert response.status_code == 201
+
+    # Курьера только что создали: читаем с основной базы
+    assert client.get('/couriers/1').status_code == 200
+
+    # Окно прошло, а реплика курьера еще не получила
+    router.clock.now = 10
+    assert client.get('/couriers/1').status_code == 400
+
+    replicate(replica, courier())
+    router.clock.now = 20
+    assert client.get('/couriers/1').json()['regions'] == [1]
+
+    response = client.patch('/couriers/1', data=json.dumps({'regions': [2]}))
+    assert response.status_code == 200
+    assert client.get('/couriers/1').json()['regions'] == [2]
+
+    # После окна видно отставание реплики
+    router.clock.now = 30
+    assert client.get('/couriers/1').json()['regions'] == [1]
+
+    assert router.decisions == {
+        ('primary', 'write'): 2,
+        ('primary', 'recent_write'): 2,
+        ('replica', 'read'): 3,
+    }
+    metrics = client.get('/metrics').text
+    assert 'db_route_total{target="replica",reason="read"' in metrics
+
+
+def test_changes_from_other_workers(router):
+    # Уведомление courier_changed от другого воркера
+    cache.Listener.handle('7,8')
+    assert 7 in router.recent and 8 in router.recent and 9 not in router.recent
+
+    cache.Listener.handle('*')
+    assert 9 in router.recent
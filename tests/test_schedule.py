@@ -0,0 +1,76 @@
+import datetime
+import random
+
+import numpy as np
+import schedule
+
+
+def t(value: str) -> datetime.time:
+    return datetime.time(*map(int, value.split(':')))
+
+
+def hours(*ranges):
+    return [(t(start), t(stop)) for start, stop in (i.split('-') for i in ranges)]
+
+
+def overlaps(delivery, working) -> bool:
+    # Условие из crud._fits_schedule: открытый промежуток доставки
+    # пересекается с закрытым промежутком графика
+    return any(
+        start < stop and start < wh_stop and stop > wh_start
+        for start, stop in delivery
+        for wh_start, wh_stop in working)
+
+
+def fits(delivery, working) -> bool:
+    masks = schedule.delivery_mask(delivery)[np.newaxis]
+    return bool(schedule.fits(masks, schedule.working_mask(working))[0])
+
+
+def test_boundaries():
+    working = hours('10:00-12:00')
+    assert fits(hours('11:59-13:00'), working)
+    assert fits(hours('09:00-10:01'), working)
+    assert fits(hours('09:00-13:00'), working)
+    # Касается только границей
+    assert not fits(hours('12:00-13:00'), working)
+    assert not fits(hours('09:00-10:00'), working)
+    # Пустой промежуток доставки не подходит никому
+    assert not fits(hours('11:00-11:00'), working)
+    # График из одной точки подходит, если она внутри промежутка доставки
+    assert fits(hours('10:00-12:00'), hours('11:00-11:00'))
+    assert not fits(hours('10:00-12:00'), hours('12:00-12:00'))
+    assert fits(hours('23:00-23:59'), hours('00:00-00:00', '23:58-23:58'))
+
+
+def test_same_as_ranges():
+    rnd = random.Random(0)
+
+    def ranges(n):
+        answer = []
+        for _ in range(n):
+            start = rnd.randrange(0, schedule.MINUTES)
+            stop = min(start + rnd.choice([0, 1, 2, 30, 600]), schedule.MINUTES - 1)
+            answer.append((datetime.time(start // 60, start % 60),
+                           datetime.time(stop // 60, stop % 60)))
+        return answer
+
+    for _ in range(2000):
+        delivery, working = ranges(rnd.randint(1, 3)), ranges(rnd.randint(1, 3))
+        assert fits(delivery, working) == overlaps(delivery, working)
+
+
+def test_mask_table():
+    table = schedule.MaskTable()
+    for i in range(100):
+        table.put(i, schedule.delivery_mask(hours('10:00-11:00' if i % 2 else '12:00-13:00')))
+    assert len(table) == 100
+
+    wanted = schedule.working_mask(hours('09:00-10:30'))
+    assert list(table.fits([1, 2, 3], wanted)) == [True, False, True]
+
+    # Строка удаленного ключа достается новому
+    table.discard(1)
+    table.put(100, schedule.delivery_mask(hours('12:00-13:00')))
+    assert len(table) == 100
+    assert list(table.fits([100, 3], wanted)) == [False, True]
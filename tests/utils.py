@@ -68,3 +68,13 @@ def generate_order(
         'region': region,
         'delivery_hours': delivery_hours,
     }
+
+
+class Clock:
+    """Часы для тестов: время меняется только присваиванием now."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now